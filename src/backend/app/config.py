@@ -1,3 +1,4 @@
+import os
 import secrets
 from functools import lru_cache
 from pydantic import (
@@ -85,6 +86,45 @@ class Settings(BaseSettings):
     S3_SECRET_KEY: Optional[str] = ""
     S3_BUCKET_NAME: str = "dtm-data"
     S3_DOWNLOAD_ROOT: Optional[str] = None
+    # Connections of the shared S3 client, and threads running S3 transfers
+    S3_POOL_MAXSIZE: int = 32
+    S3_MAX_WORKERS: int = 16
+    S3_CONNECT_TIMEOUT: int = 10  # seconds
+    S3_READ_TIMEOUT: int = 300  # seconds
+    # Part size of multipart uploads, buffered in memory one at a time
+    S3_PART_SIZE: int = 16 * 1024 * 1024
+
+    # Generated flight plans (KMZ and waypoints), cached per worker
+    FLIGHTPLAN_CACHE_MAX_MB: int = 256
+
+    # Task split previews, cached per worker
+    SPLIT_PREVIEW_CACHE_MAX_MB: int = 64
+    # Grid cells per process pool job when splitting large AOIs
+    SPLIT_BAND_CELLS: int = 50000
+    # Indexed no-fly zone layers and their unions, cached per worker
+    NO_FLY_CACHE_MAX_MB: int = 256
+    # Vector tiles of projects and tasks, cached per worker
+    TILE_CACHE_MAX_MB: int = 128
+
+    # Node-local cache of DEM windows for terrain following flight plans
+    DEM_CACHE_DIR: str = "/tmp/dtm-dem-cache"
+    DEM_CACHE_MAX_MB: int = 1024
+
+    # Process pool for CPU heavy geometry and flight plan jobs
+    WORKER_PROCESSES: int = os.cpu_count() or 1
+    WORKER_QUEUE_LIMIT: int = 16
+    WORKER_JOB_TIMEOUT: int = 120  # seconds
+    DEM_INGEST_TIMEOUT: int = 600  # seconds, for large DEM conversions
+
+    # Ingestion of uploaded images, reading their EXIF/XMP headers
+    IMAGE_INGEST_BATCH_SIZE: int = 64
+    IMAGE_INGEST_POLL_INTERVAL: int = 30  # seconds
+    IMAGE_INGEST_MAX_ATTEMPTS: int = 5
+    IMAGE_INGEST_RETRY_BACKOFF: int = 60  # seconds, doubled on each attempt
+    # Listing of the uploads for images without notification, 0 to disable
+    IMAGE_SCAN_INTERVAL: int = 15 * 60  # seconds
+    # Bearer token of the S3 bucket notification webhook, unset to disable it
+    IMAGE_WEBHOOK_TOKEN: Optional[str] = None
 
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 60 * 24 * 1  # 1 day
@@ -104,6 +144,13 @@ class Settings(BaseSettings):
     EMAILS_FROM_EMAIL: Optional[EmailStr] = None
     EMAILS_FROM_NAME: Optional[str] = "Drone Tasking Manager"
 
+    # Dispatch of the email outbox
+    EMAIL_BATCH_SIZE: int = 50
+    EMAIL_POLL_INTERVAL: int = 30  # seconds
+    EMAIL_MAX_ATTEMPTS: int = 8
+    EMAIL_RETRY_BACKOFF: int = 30  # seconds, doubled on each attempt
+    EMAIL_MAX_RETRY_BACKOFF: int = 60 * 60  # seconds
+
     @computed_field
     @property
     def emails_enabled(self) -> bool:
@@ -13,9 +13,11 @@ from sqlalchemy import (
     Index,
     ARRAY,
     LargeBinary,
+    BigInteger,
+    Text,
 )
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from geoalchemy2 import Geometry, WKBElement
 from app.models.enums import (
     FinalOutput,
@@ -74,6 +76,16 @@ class DbTask(Base):
     )
     project_task_index = cast(int, Column(Integer))
     outline = cast(WKBElement, Column(Geometry("POLYGON", srid=4326)))
+    # Elevation under the outline, from the project DEM
+    min_elevation = cast(float, Column(Float, nullable=True))
+    max_elevation = cast(float, Column(Float, nullable=True))
+    mean_elevation = cast(float, Column(Float, nullable=True))
+    area_m2 = cast(float, Column(Float, nullable=True))
+    perimeter_m = cast(float, Column(Float, nullable=True))
+    bbox = cast(list[float], Column(ARRAY(Float), nullable=True))
+    centroid = cast(WKBElement, Column(Geometry("POINT", srid=4326), nullable=True))
+    waypoint_count = cast(int, Column(Integer, nullable=True))
+    flight_time_minutes = cast(float, Column(Float, nullable=True))
 
 
 class DbProject(Base):
@@ -158,6 +170,8 @@ class DbProject(Base):
 
     __table_args__ = (
         Index("idx_geometry", outline, postgresql_using="gist"),
+        Index("idx_projects_author_id", author_id),
+        Index("idx_projects_created_at_id", created_at, id),
         {},
     )
 
@@ -214,9 +228,64 @@ class TaskEvent(Base):
     __table_args__ = (
         Index("idx_task_event_composite", "task_id", "project_id"),
         Index("idx_task_event_project_id_user_id", "user_id", "project_id"),
+        Index(
+            "idx_task_event_project_task_created",
+            "project_id",
+            "task_id",
+            created_at.desc(),
+        ),
     )
 
 
+class TaskCurrentState(Base):
+    """The latest event of each task, maintained by a trigger on task_events."""
+
+    __tablename__ = "task_current_state"
+
+    task_id = cast(
+        str,
+        Column(
+            UUID(as_uuid=True),
+            ForeignKey("tasks.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+    )
+    project_id = cast(
+        str,
+        Column(
+            UUID(as_uuid=True),
+            ForeignKey("projects.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+    )
+    event_id = cast(str, Column(UUID(as_uuid=True), nullable=False))
+    user_id = cast(str, Column(String(100)))
+    comment = cast(str, Column(String))
+    state = cast(State, Column(Enum(State), nullable=False))
+    created_at = cast(datetime, Column(DateTime))
+
+    __table_args__ = (
+        Index("idx_task_current_state_project_id", "project_id", "state"),
+    )
+
+
+class ProjectTaskStateCount(Base):
+    """Number of tasks per current state of a project, maintained by a trigger."""
+
+    __tablename__ = "project_task_state_counts"
+
+    project_id = cast(
+        str,
+        Column(
+            UUID(as_uuid=True),
+            ForeignKey("projects.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+    )
+    state = cast(State, Column(Enum(State), primary_key=True))
+    task_count = cast(int, Column(Integer, nullable=False, server_default="0"))
+
+
 class Drone(Base):
     __tablename__ = "drones"
 
@@ -271,6 +340,105 @@ class GroundControlPoint(Base):
     created_at = cast(datetime, Column(DateTime, default=timestamp))
 
 
+class NoFlyZone(Base):
+    """A no-fly zone of a project, from an imported airspace layer."""
+
+    __tablename__ = "no_fly_zones"
+
+    id = cast(int, Column(Integer, primary_key=True, autoincrement=True))
+    project_id = cast(
+        str,
+        Column(
+            UUID(as_uuid=True),
+            ForeignKey("projects.id", ondelete="CASCADE"),
+            nullable=False,
+            index=True,
+        ),
+    )
+    outline = cast(WKBElement, Column(Geometry("MULTIPOLYGON", srid=4326)))
+    created_at = cast(datetime, Column(DateTime, default=timestamp))
+
+    __table_args__ = (
+        Index("idx_no_fly_zones_outline", outline, postgresql_using="gist"),
+    )
+
+
+class EmailOutbox(Base):
+    """An email to send, written in the transaction of its notified change."""
+
+    __tablename__ = "email_outbox"
+
+    id = cast(int, Column(BigInteger, primary_key=True, autoincrement=True))
+    dedup_key = cast(str, Column(String, nullable=False))
+    email_to = cast(str, Column(String, nullable=False))
+    subject = cast(str, Column(String))
+    html_content = cast(str, Column(Text))
+    template_name = cast(str, Column(String))
+    context = cast(dict, Column(JSONB))
+    attempts = cast(int, Column(SmallInteger, nullable=False, server_default="0"))
+    last_error = cast(str, Column(String))
+    created_at = cast(datetime, Column(DateTime, default=timestamp))
+    next_attempt_at = cast(datetime, Column(DateTime, default=timestamp))
+    sent_at = cast(datetime, Column(DateTime))
+
+    __table_args__ = (
+        Index("idx_email_outbox_dedup_key", dedup_key, unique=True),
+        Index(
+            "idx_email_outbox_pending",
+            next_attempt_at,
+            postgresql_where=sent_at.is_(None),
+        ),
+    )
+
+
+class DbImage(Base):
+    """An uploaded image, with the metadata read from its EXIF/XMP header."""
+
+    __tablename__ = "images"
+
+    id = cast(str, Column(UUID(as_uuid=True), primary_key=True))
+    project_id = cast(
+        str,
+        Column(
+            UUID(as_uuid=True),
+            ForeignKey("projects.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+    )
+    # The task the image was uploaded for
+    task_id = cast(
+        str,
+        Column(UUID(as_uuid=True), ForeignKey("tasks.id", ondelete="SET NULL")),
+    )
+    s3_path = cast(str, Column(String, nullable=False))
+    etag = cast(str, Column(String))
+    size = cast(int, Column(BigInteger))
+
+    location = cast(WKBElement, Column(Geometry("POINT", srid=4326)))
+    altitude = cast(float, Column(Float))  # m above sea level
+    relative_altitude = cast(float, Column(Float))  # m above take off
+    gimbal_pitch = cast(float, Column(Float))  # degrees
+    captured_at = cast(datetime, Column(DateTime))  # camera local time
+    camera = cast(str, Column(String))
+
+    attempts = cast(int, Column(SmallInteger, nullable=False, server_default="0"))
+    last_error = cast(str, Column(String))
+    created_at = cast(datetime, Column(DateTime, default=timestamp))
+    next_attempt_at = cast(datetime, Column(DateTime, default=timestamp))
+    ingested_at = cast(datetime, Column(DateTime))
+
+    __table_args__ = (
+        Index("idx_images_s3_path", s3_path, unique=True),
+        Index("idx_images_project_id_task_id", project_id, task_id),
+        Index("idx_images_location", location, postgresql_using="gist"),
+        Index(
+            "idx_images_pending",
+            next_attempt_at,
+            postgresql_where=ingested_at.is_(None),
+        ),
+    )
+
+
 class DbUserProfile(Base):
     __tablename__ = "user_profile"
     user_id = cast(str, Column(String, ForeignKey("users.id"), primary_key=True))
@@ -0,0 +1,281 @@
+"""Digital Elevation Model ingestion and node-local cache of DEM windows."""
+
+import fcntl
+import os
+import uuid
+from datetime import timedelta
+from typing import IO, Optional
+
+import numpy as np
+import shapely
+from loguru import logger as log
+from osgeo import gdal
+
+from app.cache import content_hash
+from app.config import settings
+from app.s3 import s3_client
+
+gdal.UseExceptions()
+# Do not list the "directory" of a presigned URL when opening it
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+
+# Margin around a task, in degrees (~200 m), as flight lines overshoot its bbox
+DEM_WINDOW_BUFFER = 0.002
+
+COG_CREATION_OPTIONS = [
+    "COMPRESS=DEFLATE",
+    "PREDICTOR=YES",
+    "BLOCKSIZE=512",
+    "OVERVIEWS=AUTO",
+    "BIGTIFF=IF_SAFER",
+]
+
+
+def convert_to_cog(src_path: str, dst_path: str):
+    """Convert an uploaded DEM to a tiled cloud optimised GeoTIFF.
+
+    The DEM is reprojected to EPSG:4326 if needed, so that windows can be
+    read directly with task bounds. Overviews are generated by the COG driver.
+
+    Args:
+        src_path (str): Path of the uploaded raster.
+        dst_path (str): Path of the COG to write.
+    """
+    src = gdal.Open(src_path)
+    srs = src.GetSpatialRef()
+    if srs is None:
+        raise ValueError("The DEM has no coordinate reference system.")
+
+    if srs.GetAuthorityCode(None) == "4326":
+        gdal.Translate(
+            dst_path,
+            src,
+            options=gdal.TranslateOptions(
+                format="COG", creationOptions=COG_CREATION_OPTIONS
+            ),
+        )
+    else:
+        log.debug(f"Reprojecting DEM from {srs.GetName()} to EPSG:4326")
+        gdal.Warp(
+            dst_path,
+            src,
+            options=gdal.WarpOptions(
+                format="COG",
+                dstSRS="EPSG:4326",
+                resampleAlg="bilinear",
+                creationOptions=COG_CREATION_OPTIONS,
+            ),
+        )
+    src = None
+
+
+def task_elevation_stats(dem_path: str, tasks: list[tuple[str, str]]) -> list[dict]:
+    """Compute the min, max and mean elevation under each task outline.
+
+    Only the window under each task is read, and pixels are selected by
+    testing their centre against the outline.
+
+    Args:
+        dem_path (str): Path of a DEM in EPSG:4326.
+        tasks (list[tuple[str, str]]): Task ids and GeoJSON outlines.
+
+    Returns:
+        list[dict]: Elevation stats per task id, None where no data.
+    """
+    dataset = gdal.Open(dem_path)
+    band = dataset.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    origin_x, pixel_width, _, origin_y, _, pixel_height = dataset.GetGeoTransform()
+
+    stats = []
+    for task_id, outline in tasks:
+        polygon = shapely.from_geojson(outline)
+        minx, miny, maxx, maxy = polygon.bounds
+
+        # Pixel window under the task bounds, clipped to the raster
+        col_start = max(int((minx - origin_x) / pixel_width), 0)
+        col_end = min(int((maxx - origin_x) / pixel_width) + 1, dataset.RasterXSize)
+        row_start = max(int((maxy - origin_y) / pixel_height), 0)
+        row_end = min(int((miny - origin_y) / pixel_height) + 1, dataset.RasterYSize)
+
+        values = np.empty(0)
+        if col_end > col_start and row_end > row_start:
+            data = band.ReadAsArray(
+                col_start, row_start, col_end - col_start, row_end - row_start
+            ).astype(np.float64)
+            xs = origin_x + (np.arange(col_start, col_end) + 0.5) * pixel_width
+            ys = origin_y + (np.arange(row_start, row_end) + 0.5) * pixel_height
+            grid_x, grid_y = np.meshgrid(xs, ys)
+            mask = shapely.contains_xy(polygon, grid_x, grid_y) & np.isfinite(data)
+            if nodata is not None:
+                mask &= data != nodata
+            values = data[mask]
+
+        stats.append(
+            {
+                "id": task_id,
+                "min_elevation": float(values.min()) if values.size else None,
+                "max_elevation": float(values.max()) if values.size else None,
+                "mean_elevation": float(values.mean()) if values.size else None,
+            }
+        )
+
+    dataset = None
+    return stats
+
+
+class DemWindow:
+    """A DEM window in the cache, kept from eviction until closed.
+
+    The window file is held open with a shared lock, which eviction, by any
+    worker on the node, tests before removing a file. Used as a context
+    manager, it gives the path of the window and closes it on exit.
+    """
+
+    def __init__(self, path: str, file: IO[bytes]):
+        self.path = path
+        self._file = file
+
+    def close(self):
+        """Release the window, it may be evicted from now on."""
+        self._file.close()
+
+    def __enter__(self) -> str:
+        return self.path
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DemCache:
+    """Cache of DEM windows on local disk, with LRU eviction by disk quota.
+
+    Windows are keyed by the S3 ETag of the DEM and the requested bounds, so
+    a replaced DEM is never read from the cache. Only the window under the
+    requested bounds is read from S3, using HTTP range requests through
+    GDAL's /vsicurl/ driver, which is efficient for cloud optimised GeoTIFFs.
+    Windows in use are locked, see DemWindow, and never evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get_window(
+        self,
+        bucket_name: str,
+        s3_path: str,
+        etag: str,
+        bounds: tuple[float, float, float, float],
+    ) -> DemWindow:
+        """Return a local GeoTIFF covering the given bounds.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+            s3_path (str): The path to the DEM in the bucket.
+            etag (str): The current ETag of the DEM.
+            bounds (tuple): minx, miny, maxx, maxy in EPSG:4326.
+
+        Returns:
+            DemWindow: The cached window, to close once it has been read.
+        """
+        minx, miny, maxx, maxy = (
+            bounds[0] - DEM_WINDOW_BUFFER,
+            bounds[1] - DEM_WINDOW_BUFFER,
+            bounds[2] + DEM_WINDOW_BUFFER,
+            bounds[3] + DEM_WINDOW_BUFFER,
+        )
+        window_hash = content_hash([round(v, 6) for v in (minx, miny, maxx, maxy)])
+        etag = etag.strip('"')
+        window_path = os.path.join(self.directory, f"{etag}-{window_hash[:16]}.tif")
+
+        while True:
+            file = self._lock(window_path)
+            if file is not None:
+                break
+
+            os.makedirs(self.directory, exist_ok=True)
+            url = s3_client().presigned_get_object(
+                bucket_name, s3_path.lstrip("/"), expires=timedelta(hours=1)
+            )
+            tmp_path = f"{window_path}.{uuid.uuid4()}.tmp"
+            log.debug(f"Reading DEM window {minx, miny, maxx, maxy} of {s3_path}")
+            try:
+                gdal.Translate(
+                    tmp_path,
+                    f"/vsicurl/{url}",
+                    options=gdal.TranslateOptions(
+                        format="GTiff",
+                        projWin=[minx, maxy, maxx, miny],
+                        projWinSRS="EPSG:4326",
+                    ),
+                )
+                # Atomic, concurrent requests for the same window are harmless
+                os.replace(tmp_path, window_path)
+            finally:
+                # Left behind if the read failed
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        # Mark as recently used
+        os.utime(window_path)
+        self.evict(keep=window_path)
+        return DemWindow(window_path, file)
+
+    def _lock(self, path: str) -> Optional[IO[bytes]]:
+        """Open a cached window with a shared lock, None if not cached."""
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        fcntl.flock(file, fcntl.LOCK_SH)
+        try:
+            # Evicted between the open and the lock
+            if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                return file
+        except FileNotFoundError:
+            pass
+        file.close()
+        return None
+
+    def evict(self, keep: Optional[str] = None):
+        """Remove least recently used windows until under the disk quota.
+
+        Windows locked by a reader, in any worker, are skipped.
+
+        Args:
+            keep (str, optional): The path of a window never to remove.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".tif"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                file = open(path, "rb")
+            except FileNotFoundError:
+                # Already evicted by another worker
+                total -= size
+                continue
+            with file:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # In use
+                    continue
+                try:
+                    if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+dem_cache = DemCache(settings.DEM_CACHE_DIR, settings.DEM_CACHE_MAX_MB * 1024 * 1024)
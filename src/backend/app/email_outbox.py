@@ -0,0 +1,196 @@
+"""Transactional outbox for notification emails, drained over one SMTP session."""
+
+import asyncio
+import json
+from email.mime.text import MIMEText
+from email.utils import formataddr
+from typing import Optional
+
+from aiosmtplib import SMTP, SMTPException
+from databases import Database
+from jinja2 import TemplateError
+from loguru import logger as log
+
+from app.config import settings
+from app.db.database import db_connection
+from app.utils import render_email_template
+
+
+class EmailDispatcher:
+    """Background task sending the emails of the outbox.
+
+    Emails are queued by the SQL of the change they notify, in the same
+    statement, with a unique dedup key; templates are rendered when sent.
+    Emails are claimed in batches with SKIP LOCKED, so several workers can
+    drain the outbox concurrently, and are sent over a single SMTP session,
+    kept open while the outbox has pending emails. Failed emails are retried
+    with exponential backoff, up to `max_attempts`.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        poll_interval: float,
+        max_attempts: int,
+        backoff_seconds: float,
+        max_backoff_seconds: float,
+    ):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._smtp: Optional[SMTP] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+
+    def start(self):
+        """Start draining the outbox, if emails are configured."""
+        if not settings.emails_enabled:
+            log.debug("Emails are not configured, not starting the dispatcher")
+            return
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop draining the outbox, and close the SMTP session."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._disconnect()
+
+    def wake(self):
+        """Send newly committed emails now, rather than at the next poll."""
+        self._wake.set()
+
+    async def _run(self):
+        db = db_connection.database
+        while True:
+            try:
+                claimed = await self.dispatch(db)
+            except Exception as e:
+                log.exception(f"Failed to dispatch emails: {e}")
+                claimed = 0
+
+            if claimed >= self.batch_size:
+                # More emails may be pending
+                continue
+
+            await self._disconnect()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def dispatch(self, db: Database) -> int:
+        """Send one batch of pending emails.
+
+        Returns:
+            int: The number of emails claimed from the outbox.
+        """
+        async with db.transaction():
+            query = """
+                SELECT id, email_to, subject, html_content, template_name, context, attempts
+                FROM email_outbox
+                WHERE sent_at IS NULL
+                AND attempts < :max_attempts
+                AND next_attempt_at <= now()
+                ORDER BY id
+                LIMIT :batch_size
+                FOR UPDATE SKIP LOCKED;
+            """
+            emails = await db.fetch_all(
+                query,
+                {"max_attempts": self.max_attempts, "batch_size": self.batch_size},
+            )
+
+            sent, failed = [], []
+            for email in emails:
+                try:
+                    await self._send(
+                        email["email_to"], email["subject"], self._render(email)
+                    )
+                    sent.append(email["id"])
+                except (SMTPException, OSError, TemplateError) as e:
+                    log.warning(f"Failed to send email {email['id']}: {e}")
+                    delay = min(
+                        self.backoff_seconds * 2 ** email["attempts"],
+                        self.max_backoff_seconds,
+                    )
+                    failed.append({"id": email["id"], "error": str(e), "delay": delay})
+                    await self._disconnect()
+
+            if sent:
+                await db.execute(
+                    """
+                    UPDATE email_outbox
+                    SET sent_at = now(), attempts = attempts + 1
+                    WHERE id = ANY(:ids);
+                    """,
+                    {"ids": sent},
+                )
+            if failed:
+                await db.execute_many(
+                    """
+                    UPDATE email_outbox
+                    SET attempts = attempts + 1,
+                        last_error = :error,
+                        next_attempt_at = now() + make_interval(secs => :delay)
+                    WHERE id = :id;
+                    """,
+                    failed,
+                )
+
+        if emails:
+            log.debug(f"Sent {len(sent)} emails, {len(failed)} failed")
+        return len(emails)
+
+    @staticmethod
+    def _render(email) -> str:
+        if email["html_content"] is not None:
+            return email["html_content"]
+        context = email["context"]
+        if isinstance(context, str):
+            context = json.loads(context)
+        return render_email_template(email["template_name"], context or {})
+
+    async def _send(self, email_to: str, subject: str, html_content: str):
+        message = MIMEText(html_content, "html")
+        message["Subject"] = subject
+        message["From"] = formataddr(
+            (settings.EMAILS_FROM_NAME, settings.EMAILS_FROM_EMAIL)
+        )
+        message["To"] = email_to
+
+        if self._smtp is None or not self._smtp.is_connected:
+            self._smtp = SMTP(
+                hostname=settings.SMTP_HOST,
+                port=settings.SMTP_PORT,
+                username=settings.SMTP_USER,
+                password=settings.SMTP_PASSWORD,
+                use_tls=settings.SMTP_SSL,
+            )
+            await self._smtp.connect()
+        await self._smtp.send_message(message)
+
+    async def _disconnect(self):
+        if self._smtp is not None and self._smtp.is_connected:
+            try:
+                await self._smtp.quit()
+            except (SMTPException, OSError):
+                self._smtp.close()
+        self._smtp = None
+
+
+email_dispatcher = EmailDispatcher(
+    batch_size=settings.EMAIL_BATCH_SIZE,
+    poll_interval=settings.EMAIL_POLL_INTERVAL,
+    max_attempts=settings.EMAIL_MAX_ATTEMPTS,
+    backoff_seconds=settings.EMAIL_RETRY_BACKOFF,
+    max_backoff_seconds=settings.EMAIL_MAX_RETRY_BACKOFF,
+)
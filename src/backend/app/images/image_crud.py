@@ -0,0 +1,416 @@
+import json
+import uuid
+from typing import Any, Optional
+
+from databases import Database
+from loguru import logger as log
+from minio.error import S3Error
+
+from app.config import settings
+from app.images.image_metadata import (
+    IMAGE_EXTENSIONS,
+    MAX_HEADER_BYTES,
+    jpeg_header_end,
+)
+from app.s3 import async_s3, get_obj_range
+
+UPLOADS_PREFIX = "publicuploads/"
+# Bytes read by the first range request of an image, enough for most headers
+HEADER_READ_SIZE = 64 * 1024
+# Objects enqueued per statement when scanning the uploads
+ENQUEUE_BATCH_SIZE = 5000
+# Orphan images listed in the report of a task assignment
+ORPHAN_REPORT_LIMIT = 1000
+# Class of the advisory locks held while scanning a prefix of the uploads
+SCAN_LOCK_CLASS = 0x494D47  # "IMG"
+
+
+def parse_upload_path(s3_path: str) -> Optional[tuple[uuid.UUID, uuid.UUID]]:
+    """Return the (project id, task id) of an uploaded image, from its path.
+
+    Images are uploaded to publicuploads/{project_id}/{task_id}/{image_name};
+    None is returned for any other object.
+    """
+    parts = s3_path.lstrip("/").split("/", 3)
+    if (
+        len(parts) != 4
+        or f"{parts[0]}/" != UPLOADS_PREFIX
+        or not parts[3].lower().endswith(IMAGE_EXTENSIONS)
+    ):
+        return None
+    try:
+        return uuid.UUID(parts[1]), uuid.UUID(parts[2])
+    except ValueError:
+        return None
+
+
+def read_image_header(s3_path: str) -> bytes:
+    """Download the header of an uploaded image, by range requests.
+
+    The header is usually read by a single request; it is only extended by
+    further requests when its segments continue past the bytes read.
+
+    Raises:
+        ValueError: If the object is not a JPEG image, or is truncated.
+    """
+    data = b""
+    while True:
+        done, length = jpeg_header_end(data)
+        if done:
+            return data[:length]
+        if length > MAX_HEADER_BYTES:
+            raise ValueError(f"Image header larger than {MAX_HEADER_BYTES} bytes")
+
+        size = max(length - len(data), HEADER_READ_SIZE)
+        try:
+            chunk = get_obj_range(settings.S3_BUCKET_NAME, s3_path, len(data), size)
+        except S3Error as e:
+            if e.code != "InvalidRange":
+                raise
+            chunk = b""
+        if not chunk:
+            raise ValueError("Truncated image")
+        data += chunk
+
+
+async def enqueue_images(
+    db: Database, objects: list[tuple[str, Optional[str], Optional[int]]]
+) -> int:
+    """Add uploaded images to ingest, ignoring those already ingested.
+
+    Objects which are not images of an existing project are skipped; the task
+    of an image is only set if it belongs to the project. A replaced image,
+    with a different ETag, is ingested again.
+
+    Args:
+        db (Database): The database connection.
+        objects (list[tuple[str, Optional[str], Optional[int]]]): The
+            (S3 path, ETag, size) of the uploaded objects.
+
+    Returns:
+        int: The number of images added or replaced.
+    """
+    rows = []
+    for s3_path, etag, size in objects:
+        ids = parse_upload_path(s3_path)
+        if ids is not None:
+            rows.append((s3_path.lstrip("/"), str(ids[0]), str(ids[1]), etag, size))
+    if not rows:
+        return 0
+
+    query = """
+        WITH uploaded AS (
+            SELECT *
+            FROM unnest(
+                CAST(:s3_paths AS text[]),
+                CAST(:project_ids AS uuid[]),
+                CAST(:task_ids AS uuid[]),
+                CAST(:etags AS text[]),
+                CAST(:sizes AS bigint[])
+            ) AS uploaded(s3_path, project_id, task_id, etag, size)
+        ),
+        upserted AS (
+            INSERT INTO images (id, project_id, task_id, s3_path, etag, size, attempts, created_at, next_attempt_at)
+            SELECT gen_random_uuid(), projects.id, tasks.id, uploaded.s3_path, uploaded.etag, uploaded.size, 0, now(), now()
+            FROM uploaded
+            JOIN projects ON projects.id = uploaded.project_id
+            LEFT JOIN tasks ON tasks.id = uploaded.task_id AND tasks.project_id = uploaded.project_id
+            ON CONFLICT (s3_path) DO UPDATE
+            SET etag = EXCLUDED.etag,
+                size = EXCLUDED.size,
+                attempts = 0,
+                last_error = NULL,
+                ingested_at = NULL,
+                next_attempt_at = now()
+            WHERE images.etag IS DISTINCT FROM EXCLUDED.etag
+            RETURNING 1
+        )
+        SELECT count(*) FROM upserted;
+    """
+    count = 0
+    for start in range(0, len(rows), ENQUEUE_BATCH_SIZE):
+        s3_paths, project_ids, task_ids, etags, sizes = zip(
+            *rows[start : start + ENQUEUE_BATCH_SIZE]
+        )
+        count += await db.fetch_val(
+            query,
+            {
+                "s3_paths": list(s3_paths),
+                "project_ids": list(project_ids),
+                "task_ids": list(task_ids),
+                "etags": list(etags),
+                "sizes": list(sizes),
+            },
+        )
+    return count
+
+
+async def scan_uploads(
+    db: Database, project_id: Optional[uuid.UUID] = None
+) -> Optional[int]:
+    """List the uploaded images in S3, and add those not yet ingested.
+
+    The uploads are listed and enqueued batch by batch. A prefix is only
+    scanned by one worker at a time, holding a session advisory lock.
+
+    Args:
+        db (Database): The database connection.
+        project_id (uuid.UUID, optional): Only scan the uploads of a project.
+
+    Returns:
+        Optional[int]: The number of images added or replaced, None if the
+            uploads are already being scanned.
+    """
+    prefix = f"{UPLOADS_PREFIX}{project_id}/" if project_id else UPLOADS_PREFIX
+    lock = {"lock_class": SCAN_LOCK_CLASS, "prefix": prefix}
+    # The lock is held by the session, so both statements need its connection
+    async with db.connection():
+        locked = await db.fetch_val(
+            "SELECT pg_try_advisory_lock(:lock_class, hashtext(:prefix));", lock
+        )
+        if not locked:
+            log.debug(f"Uploads under {prefix} are already being scanned")
+            return None
+
+        listed = count = 0
+        try:
+            async for objects in async_s3.list_objs_in_bucket(
+                settings.S3_BUCKET_NAME, prefix, ENQUEUE_BATCH_SIZE
+            ):
+                listed += len(objects)
+                count += await enqueue_images(db, objects)
+        finally:
+            await db.execute(
+                "SELECT pg_advisory_unlock(:lock_class, hashtext(:prefix));", lock
+            )
+
+    log.debug(f"Scanned {listed} uploads under {prefix}, {count} to ingest")
+    return count
+
+
+async def claim_pending_images(
+    db: Database, batch_size: int, max_attempts: int, backoff_seconds: float
+) -> list[Any]:
+    """Claim a batch of images to ingest, counting the attempt at once.
+
+    The attempt is counted, and the next one scheduled with exponential
+    backoff, in the claiming statement, so that images are never held
+    locked while they are read. An attempt which never records its result,
+    e.g. stuck reading S3, is thus retried after the backoff, and abandoned
+    after `max_attempts`.
+
+    Returns:
+        list[Any]: The `id`, `s3_path` and `attempts`, including this one, of
+            each claimed image.
+    """
+    query = """
+        WITH pending AS (
+            SELECT id
+            FROM images
+            WHERE ingested_at IS NULL
+            AND attempts < :max_attempts
+            AND next_attempt_at <= now()
+            ORDER BY next_attempt_at
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE images
+        SET attempts = images.attempts + 1,
+            next_attempt_at = now() + make_interval(
+                secs => CAST(:backoff_seconds AS float8) * power(2, images.attempts)
+            )
+        FROM pending
+        WHERE images.id = pending.id
+        RETURNING images.id, images.s3_path, images.attempts;
+    """
+    return await db.fetch_all(
+        query,
+        {
+            "max_attempts": max_attempts,
+            "batch_size": batch_size,
+            "backoff_seconds": backoff_seconds,
+        },
+    )
+
+
+async def record_image_metadata(
+    db: Database, results: list[dict[str, Any]], max_attempts: int
+):
+    """Store the metadata read from a batch of claimed images, in one statement.
+
+    Failed images keep the retry scheduled when they were claimed. Results
+    of an attempt superseded meanwhile, by a later claim or a replaced
+    upload, are ignored.
+
+    Args:
+        db (Database): The database connection.
+        results (list[dict[str, Any]]): Per image, its `id`, the `attempts`
+            it was claimed with, and its metadata, see
+            image_metadata.parse_image_header; or its `error`, and if the
+            error is `permanent`.
+        max_attempts (int): The attempts after which images are abandoned,
+            set at once for permanent errors.
+    """
+    query = """
+        UPDATE images
+        SET location = CASE
+                WHEN result.longitude IS NOT NULL AND result.latitude IS NOT NULL
+                THEN ST_SetSRID(ST_MakePoint(result.longitude, result.latitude), 4326)
+            END,
+            altitude = result.altitude,
+            relative_altitude = result.relative_altitude,
+            gimbal_pitch = result.gimbal_pitch,
+            captured_at = result.captured_at,
+            camera = result.camera,
+            attempts = CASE
+                WHEN result.permanent THEN :max_attempts
+                ELSE images.attempts
+            END,
+            last_error = result.error,
+            ingested_at = CASE WHEN result.error IS NULL THEN now() END
+        FROM jsonb_to_recordset(CAST(:results AS jsonb)) AS result(
+            id uuid,
+            attempts int,
+            latitude float8,
+            longitude float8,
+            altitude float8,
+            relative_altitude float8,
+            gimbal_pitch float8,
+            captured_at timestamp,
+            camera text,
+            error text,
+            permanent boolean
+        )
+        WHERE images.id = result.id
+        AND images.attempts = result.attempts
+        AND images.ingested_at IS NULL;
+    """
+    await db.execute(
+        query,
+        {"results": json.dumps(results, default=str), "max_attempts": max_attempts},
+    )
+
+
+async def get_images_geojson(
+    db: Database, project_id: uuid.UUID, task_id: Optional[uuid.UUID] = None
+) -> Optional[str]:
+    """Return the ingested images of a project as a GeoJSON FeatureCollection.
+
+    The JSON is built by PostGIS and returned as is, see
+    project_crud.get_project_info_json.
+    """
+    query = """
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(json_agg(
+                json_build_object(
+                    'type', 'Feature',
+                    'id', images.id,
+                    'geometry', ST_AsGeoJSON(images.location)::json,
+                    'properties', json_build_object(
+                        'task_id', images.task_id,
+                        's3_path', images.s3_path,
+                        'altitude', images.altitude,
+                        'relative_altitude', images.relative_altitude,
+                        'gimbal_pitch', images.gimbal_pitch,
+                        'captured_at', images.captured_at,
+                        'camera', images.camera
+                    )
+                )
+                ORDER BY images.captured_at, images.s3_path
+            ), '[]'::json)
+        )::text
+        FROM images
+        WHERE images.project_id = :project_id
+        AND images.ingested_at IS NOT NULL
+        AND (CAST(:task_id AS uuid) IS NULL OR images.task_id = CAST(:task_id AS uuid));
+    """
+    return await db.fetch_val(query, {"project_id": project_id, "task_id": task_id})
+
+
+async def assign_images_to_tasks(db: Database, project_id: uuid.UUID) -> dict:
+    """Set the task of each ingested image of a project, from its position.
+
+    Images are matched to the task whose outline contains them by an inner
+    join driven from the tasks, which probes the GiST index of image
+    locations once per task, as tasks have no spatial index and are far
+    fewer than images. The matches are then joined back to every ingested
+    image, to find the orphans, and images are moved in the same statement.
+    Where tasks overlap, the first task is kept. Orphans, images without
+    position or outside every task, keep the task they were uploaded for.
+
+    Returns:
+        dict: The number of `images` matched, the number `moved` to another
+            task, the `orphan_count`, and the first ORPHAN_REPORT_LIMIT
+            `orphans` with their `id`, `s3_path`, `task_id` and `reason`.
+    """
+    query = """
+        WITH contained AS (
+            SELECT
+                images.id AS image_id,
+                tasks.id AS task_id,
+                tasks.project_task_index
+            FROM tasks
+            JOIN images
+                ON images.project_id = tasks.project_id
+                AND ST_Contains(tasks.outline, images.location)
+            WHERE tasks.project_id = :project_id
+            AND images.ingested_at IS NOT NULL
+        ),
+        matched AS (
+            SELECT DISTINCT ON (images.id)
+                images.id,
+                images.s3_path,
+                images.task_id AS uploaded_task_id,
+                images.location IS NULL AS no_location,
+                contained.task_id
+            FROM images
+            LEFT JOIN contained ON contained.image_id = images.id
+            WHERE images.project_id = :project_id
+            AND images.ingested_at IS NOT NULL
+            ORDER BY images.id, contained.project_task_index
+        ),
+        moved AS (
+            UPDATE images
+            SET task_id = matched.task_id
+            FROM matched
+            WHERE images.id = matched.id
+            AND matched.task_id IS NOT NULL
+            AND images.task_id IS DISTINCT FROM matched.task_id
+            RETURNING images.id
+        ),
+        orphans AS (
+            SELECT id, s3_path, uploaded_task_id, no_location
+            FROM matched
+            WHERE task_id IS NULL
+        )
+        SELECT
+            (SELECT count(*) FROM matched) AS images,
+            (SELECT count(*) FROM moved) AS moved,
+            (SELECT count(*) FROM orphans) AS orphan_count,
+            (
+                SELECT COALESCE(json_agg(
+                    json_build_object(
+                        'id', id,
+                        's3_path', s3_path,
+                        'task_id', uploaded_task_id,
+                        'reason', CASE WHEN no_location THEN 'no_location' ELSE 'outside_tasks' END
+                    )
+                    ORDER BY s3_path
+                ), '[]'::json)::text
+                FROM (SELECT * FROM orphans ORDER BY s3_path LIMIT :orphan_limit) AS listed
+            ) AS orphans;
+    """
+    result = await db.fetch_one(
+        query, {"project_id": project_id, "orphan_limit": ORPHAN_REPORT_LIMIT}
+    )
+    log.info(
+        f"Assigned {result['images']} images of project {project_id} to tasks: "
+        f"{result['moved']} moved, {result['orphan_count']} orphans"
+    )
+    return {
+        "images": result["images"],
+        "moved": result["moved"],
+        "orphan_count": result["orphan_count"],
+        "orphans": json.loads(result["orphans"]),
+    }
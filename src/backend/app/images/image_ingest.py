@@ -0,0 +1,165 @@
+"""Ingestion of uploaded images, indexing the metadata of their headers."""
+
+import asyncio
+import time
+from typing import Optional
+
+from databases import Database
+from fastapi import HTTPException
+from loguru import logger as log
+from minio.error import S3Error
+
+from app.config import settings
+from app.db.database import db_connection
+from app.images import image_crud
+from app.images.image_metadata import parse_image_headers
+from app.s3 import async_s3
+from app.workers import process_pool
+
+
+class ImageIngestor:
+    """Background task reading the metadata of uploaded images.
+
+    Images are added to the `images` table, as pending, by the bucket
+    notification webhook, by completed multipart uploads, or by a periodic
+    scan of the uploads. Pending images are claimed in batches with SKIP
+    LOCKED, so several workers can ingest concurrently, and their attempt is
+    counted as they are claimed. Their headers are then fetched by range
+    requests on the S3 threads, and parsed on the process pool, outside any
+    transaction. Failed images are retried with exponential backoff, up to
+    `max_attempts`, except images whose header is invalid.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        poll_interval: float,
+        scan_interval: float,
+        max_attempts: int,
+        backoff_seconds: float,
+    ):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.scan_interval = scan_interval
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._last_scan = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+
+    def start(self):
+        """Start ingesting uploaded images."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop ingesting uploaded images."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Ingest newly added images now, rather than at the next poll."""
+        self._wake.set()
+
+    async def _run(self):
+        db = db_connection.database
+        while True:
+            if self.scan_interval and (
+                time.monotonic() - self._last_scan >= self.scan_interval
+            ):
+                self._last_scan = time.monotonic()
+                try:
+                    await image_crud.scan_uploads(db)
+                except Exception as e:
+                    log.exception(f"Failed to scan the uploaded images: {e}")
+
+            try:
+                claimed = await self.ingest(db)
+            except Exception as e:
+                log.exception(f"Failed to ingest images: {e}")
+                claimed = 0
+
+            if claimed >= self.batch_size:
+                # More images may be pending
+                continue
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def ingest(self, db: Database) -> int:
+        """Read and store the metadata of one batch of pending images.
+
+        Returns:
+            int: The number of images claimed.
+        """
+        if process_pool.saturated:
+            # Not claimed, so that no attempt is counted; retry at next poll
+            log.warning("Deferred image ingestion, the process pool is busy")
+            return 0
+
+        images = await image_crud.claim_pending_images(
+            db, self.batch_size, self.max_attempts, self.backoff_seconds
+        )
+        if not images:
+            return 0
+
+        headers = await asyncio.gather(
+            *(
+                async_s3.run(image_crud.read_image_header, image["s3_path"])
+                for image in images
+            ),
+            return_exceptions=True,
+        )
+        readable = [header for header in headers if isinstance(header, bytes)]
+        try:
+            parsed = iter(
+                await process_pool.run(parse_image_headers, readable)
+                if readable
+                else []
+            )
+        except HTTPException as e:
+            # The attempt is counted, the images are retried after the backoff
+            log.warning(f"Failed to parse {len(readable)} image headers: {e.detail}")
+            return len(images)
+
+        results = []
+        for image, header in zip(images, headers):
+            if isinstance(header, bytes):
+                result = next(parsed)
+                permanent = "error" in result
+            elif isinstance(header, ValueError):
+                result = {"error": str(header)}
+                permanent = True
+            else:
+                result = {"error": str(header) or type(header).__name__}
+                # Deleted before it was ingested, otherwise S3 may recover
+                permanent = isinstance(header, S3Error) and header.code == "NoSuchKey"
+            if "error" in result:
+                log.warning(f"Failed to ingest {image['s3_path']}: {result['error']}")
+                result["permanent"] = permanent
+            results.append(
+                {"id": str(image["id"]), "attempts": image["attempts"], **result}
+            )
+
+        await image_crud.record_image_metadata(db, results, self.max_attempts)
+
+        failed = sum("error" in result for result in results)
+        log.debug(f"Ingested {len(results) - failed} images, {failed} failed")
+        return len(images)
+
+
+image_ingestor = ImageIngestor(
+    batch_size=settings.IMAGE_INGEST_BATCH_SIZE,
+    poll_interval=settings.IMAGE_INGEST_POLL_INTERVAL,
+    scan_interval=settings.IMAGE_SCAN_INTERVAL,
+    max_attempts=settings.IMAGE_INGEST_MAX_ATTEMPTS,
+    backoff_seconds=settings.IMAGE_INGEST_RETRY_BACKOFF,
+)
@@ -0,0 +1,266 @@
+"""Read the position and camera metadata of drone images from their header.
+
+Only the JPEG header, the segments before the compressed image data, is
+needed: EXIF holds the GPS position, altitude, capture time and camera, and
+DJI's XMP the gimbal pitch and relative altitude.
+"""
+
+import re
+import struct
+from datetime import datetime
+from typing import Any, Iterator, Optional
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+# Headers larger than this are not read, EXIF is limited to 64 KiB anyway
+MAX_HEADER_BYTES = 1024 * 1024
+
+EXIF_PREFIX = b"Exif\x00\x00"
+XMP_PREFIX = b"http://ns.adobe.com/xap/1.0/\x00"
+
+# EXIF tags
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_GPS_LATITUDE_REF = 0x0001
+TAG_GPS_LATITUDE = 0x0002
+TAG_GPS_LONGITUDE_REF = 0x0003
+TAG_GPS_LONGITUDE = 0x0004
+TAG_GPS_ALTITUDE_REF = 0x0005
+TAG_GPS_ALTITUDE = 0x0006
+
+# Size in bytes of the EXIF field types read, by type id
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+MAX_IFD_ENTRIES = 1000
+
+
+def jpeg_header_end(data: bytes) -> tuple[bool, int]:
+    """Find the end of the header of a JPEG image, from its first bytes.
+
+    Args:
+        data (bytes): The first bytes of the image.
+
+    Returns:
+        tuple[bool, int]: Whether the header is complete, and then its length;
+            otherwise the length needed to read further.
+
+    Raises:
+        ValueError: If the data is not a JPEG image.
+    """
+    if len(data) < 2:
+        return False, 2
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG image")
+
+    offset = 2
+    while True:
+        if offset + 4 > len(data):
+            return False, offset + 4
+        if data[offset] != 0xFF:
+            raise ValueError(f"Invalid JPEG marker at byte {offset}")
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+        elif marker in (0xDA, 0xD9):
+            # Start of the compressed data, or end of the image
+            return True, offset
+        elif 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            offset += 2
+        else:
+            offset += 2 + int.from_bytes(data[offset + 2 : offset + 4], "big")
+
+
+def _app1_segments(header: bytes) -> Iterator[bytes]:
+    """Yield the payload of each APP1 segment, holding EXIF or XMP."""
+    offset = 2
+    while offset + 4 <= len(header):
+        marker = header[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            offset += 2
+            continue
+        length = int.from_bytes(header[offset + 2 : offset + 4], "big")
+        if marker == 0xE1:
+            yield header[offset + 4 : offset + 2 + length]
+        offset += 2 + length
+
+
+def _read_ifd(tiff: bytes, order: str, offset: int) -> dict[int, Any]:
+    """Read the entries of an EXIF image file directory, by tag."""
+    (count,) = struct.unpack_from(f"{order}H", tiff, offset)
+    if count > MAX_IFD_ENTRIES:
+        raise ValueError("Invalid EXIF directory")
+
+    entries = {}
+    for index in range(count):
+        entry = offset + 2 + 12 * index
+        tag, field_type, length = struct.unpack_from(f"{order}HHI", tiff, entry)
+        size = TYPE_SIZES.get(field_type)
+        if size is None:
+            continue
+        total = size * length
+        if total <= 4:
+            raw = tiff[entry + 8 : entry + 8 + total]
+        else:
+            (value_offset,) = struct.unpack_from(f"{order}I", tiff, entry + 8)
+            raw = tiff[value_offset : value_offset + total]
+        if len(raw) < total:
+            continue
+
+        if field_type == 2:
+            value = raw.split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+        elif field_type in (1, 7):
+            value = tuple(raw)
+        elif field_type in (5, 10):
+            code = "I" if field_type == 5 else "i"
+            pairs = struct.unpack(f"{order}{2 * length}{code}", raw)
+            value = tuple(
+                num / den if den else None for num, den in zip(pairs[::2], pairs[1::2])
+            )
+        else:
+            code = {3: "H", 4: "I", 9: "i"}[field_type]
+            value = struct.unpack(f"{order}{length}{code}", raw)
+        entries[tag] = value
+    return entries
+
+
+def _degrees(dms: Optional[tuple], ref: Optional[str], negative_ref: str):
+    if not dms or len(dms) < 3 or None in dms[:3]:
+        return None
+    degrees = dms[0] + dms[1] / 60 + dms[2] / 3600
+    return -degrees if ref == negative_ref else degrees
+
+
+def _parse_exif(payload: bytes) -> dict[str, Any]:
+    """Read the position, capture time and camera from an EXIF payload."""
+    tiff = payload[len(EXIF_PREFIX) :]
+    if tiff[:2] == b"II":
+        order = "<"
+    elif tiff[:2] == b"MM":
+        order = ">"
+    else:
+        raise ValueError("Invalid EXIF byte order")
+
+    (ifd0_offset,) = struct.unpack_from(f"{order}I", tiff, 4)
+    ifd0 = _read_ifd(tiff, order, ifd0_offset)
+    exif = _read_ifd(tiff, order, ifd0[TAG_EXIF_IFD][0]) if TAG_EXIF_IFD in ifd0 else {}
+    gps = _read_ifd(tiff, order, ifd0[TAG_GPS_IFD][0]) if TAG_GPS_IFD in ifd0 else {}
+
+    metadata: dict[str, Any] = {
+        "latitude": _degrees(
+            gps.get(TAG_GPS_LATITUDE), gps.get(TAG_GPS_LATITUDE_REF), "S"
+        ),
+        "longitude": _degrees(
+            gps.get(TAG_GPS_LONGITUDE), gps.get(TAG_GPS_LONGITUDE_REF), "W"
+        ),
+    }
+
+    altitude = gps.get(TAG_GPS_ALTITUDE)
+    if altitude and altitude[0] is not None:
+        below_sea_level = gps.get(TAG_GPS_ALTITUDE_REF, (0,))[0] == 1
+        metadata["altitude"] = -altitude[0] if below_sea_level else altitude[0]
+
+    captured = exif.get(TAG_DATETIME_ORIGINAL) or ifd0.get(TAG_DATETIME)
+    if captured:
+        try:
+            metadata["captured_at"] = datetime.strptime(
+                captured, "%Y:%m:%d %H:%M:%S"
+            ).isoformat()
+        except ValueError:
+            pass
+
+    camera = " ".join(filter(None, (ifd0.get(TAG_MAKE), ifd0.get(TAG_MODEL))))
+    metadata["camera"] = camera or None
+    return metadata
+
+
+def _xmp_float(xmp: str, name: str) -> Optional[float]:
+    """Read a property of an XMP packet, as an attribute or an element."""
+    match = re.search(rf'[\w-]+:{name}\s*=\s*"([^"]*)"|<[\w-]+:{name}>([^<]*)<', xmp)
+    if not match:
+        return None
+    try:
+        return float(match.group(1) or match.group(2))
+    except ValueError:
+        return None
+
+
+def _parse_xmp(payload: bytes) -> dict[str, Any]:
+    """Read the gimbal pitch and altitudes from DJI's XMP packet."""
+    xmp = payload[len(XMP_PREFIX) :].decode("utf-8", "replace")
+    longitude = _xmp_float(xmp, "GpsLongitude")
+    if longitude is None:
+        # Misspelt by DJI
+        longitude = _xmp_float(xmp, "GpsLongtitude")
+    return {
+        "gimbal_pitch": _xmp_float(xmp, "GimbalPitchDegree"),
+        "relative_altitude": _xmp_float(xmp, "RelativeAltitude"),
+        "altitude": _xmp_float(xmp, "AbsoluteAltitude"),
+        "latitude": _xmp_float(xmp, "GpsLatitude"),
+        "longitude": longitude,
+    }
+
+
+def parse_image_header(header: bytes) -> dict[str, Any]:
+    """Read the metadata of a drone image from its JPEG header.
+
+    EXIF values are preferred, with XMP ones used where EXIF has none.
+
+    Args:
+        header (bytes): The JPEG header, see `jpeg_header_end`.
+
+    Returns:
+        dict[str, Any]: The latitude, longitude, altitude (m above sea level),
+            relative_altitude (m above take off), gimbal_pitch (degrees),
+            captured_at (ISO format, camera local time) and camera of the
+            image, None where missing.
+    """
+    if header[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG image")
+
+    exif: dict[str, Any] = {}
+    xmp: dict[str, Any] = {}
+    try:
+        for payload in _app1_segments(header):
+            if payload.startswith(EXIF_PREFIX) and not exif:
+                exif = _parse_exif(payload)
+            elif payload.startswith(XMP_PREFIX) and not xmp:
+                xmp = _parse_xmp(payload)
+    except (struct.error, IndexError, KeyError) as e:
+        raise ValueError(f"Invalid image metadata: {e}") from e
+
+    fields = (
+        "latitude",
+        "longitude",
+        "altitude",
+        "relative_altitude",
+        "gimbal_pitch",
+        "captured_at",
+        "camera",
+    )
+    metadata = {}
+    for field in fields:
+        value = exif.get(field)
+        metadata[field] = value if value is not None else xmp.get(field)
+    return metadata
+
+
+def parse_image_headers(headers: list[bytes]) -> list[dict[str, Any]]:
+    """Read the metadata of a batch of images, in a worker process.
+
+    Returns:
+        list[dict[str, Any]]: The metadata of each image, see
+            `parse_image_header`, or its `error` if it could not be read.
+    """
+    results = []
+    for header in headers:
+        try:
+            results.append(parse_image_header(header))
+        except ValueError as e:
+            results.append({"error": str(e)})
+    return results
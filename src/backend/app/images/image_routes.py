@@ -0,0 +1,126 @@
+import secrets
+import uuid
+from typing import Optional
+from urllib.parse import unquote_plus
+
+from databases import Database
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from app.config import settings
+from app.db import database
+from app.images import image_crud, image_schemas
+from app.images.image_ingest import image_ingestor
+from app.models.enums import HTTPStatus
+from app.projects import project_crud
+from app.users.user_deps import login_required
+from app.users.user_schemas import AuthUser
+from app.utils import RawJSONResponse
+
+
+router = APIRouter(
+    prefix=f"{settings.API_PREFIX}/images",
+    tags=["images"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.post("/webhook")
+async def bucket_notification(
+    event: image_schemas.S3Event,
+    authorization: Optional[str] = Header(None),
+    db: Database = Depends(database.get_db),
+):
+    """Add uploaded images to ingest, from S3 bucket notifications.
+
+    Set as the webhook target of the bucket's object created events, with
+    settings.IMAGE_WEBHOOK_TOKEN as its auth token.
+    """
+    if not settings.IMAGE_WEBHOOK_TOKEN:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Not found")
+    if not secrets.compare_digest(
+        authorization or "", f"Bearer {settings.IMAGE_WEBHOOK_TOKEN}"
+    ):
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED, detail="Invalid token")
+
+    objects = [
+        (
+            unquote_plus(record.s3.object.key),
+            record.s3.object.eTag,
+            record.s3.object.size,
+        )
+        for record in event.Records
+        if record.eventName.startswith("s3:ObjectCreated:")
+        and record.s3.bucket.name == settings.S3_BUCKET_NAME
+    ]
+    queued = await image_crud.enqueue_images(db, objects)
+    if queued:
+        image_ingestor.wake()
+    return {"queued": queued}
+
+
+@router.post("/{project_id}/scan")
+async def scan_project_uploads(
+    project_id: uuid.UUID,
+    db: Database = Depends(database.get_db),
+    user_data: AuthUser = Depends(login_required),
+):
+    """List the images uploaded for a project, and ingest those not yet ingested."""
+    project = await project_crud.get_project_by_id(db, project_id)
+    if not project:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Project not found."
+        )
+    if user_data.id != project["author_id"]:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="Only the project creator can scan its uploads.",
+        )
+    queued = await image_crud.scan_uploads(db, project_id)
+    if queued is None:
+        raise HTTPException(
+            status_code=HTTPStatus.CONFLICT,
+            detail="The uploads of this project are already being scanned.",
+        )
+    if queued:
+        image_ingestor.wake()
+    return {"queued": queued}
+
+
+@router.post("/{project_id}/assign")
+async def assign_project_images(
+    project_id: uuid.UUID,
+    db: Database = Depends(database.get_db),
+    user_data: AuthUser = Depends(login_required),
+):
+    """Move each ingested image of a project to the task containing it.
+
+    Images are uploaded under a task chosen by the client, which may not be
+    the task where they were taken. Returns the number of images moved, and
+    the orphans, without position or outside every task.
+    """
+    project = await project_crud.get_project_by_id(db, project_id)
+    if not project:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Project not found."
+        )
+    if user_data.id != project["author_id"]:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="Only the project creator can assign its images.",
+        )
+    return await image_crud.assign_images_to_tasks(db, project_id)
+
+
+@router.get("/{project_id}")
+async def read_project_images(
+    project_id: uuid.UUID,
+    task_id: Optional[uuid.UUID] = None,
+    db: Database = Depends(database.get_db),
+    user_data: AuthUser = Depends(login_required),
+):
+    """Get the ingested images of a project, or of one of its tasks.
+
+    Returns a GeoJSON FeatureCollection of the image positions, with their
+    altitude, gimbal pitch, capture time and camera as properties.
+    """
+    return RawJSONResponse(await image_crud.get_images_geojson(db, project_id, task_id))
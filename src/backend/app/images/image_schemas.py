@@ -0,0 +1,28 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+
+class S3EventObject(BaseModel):
+    key: str  # URL encoded
+    size: Optional[int] = None
+    eTag: Optional[str] = None
+
+
+class S3EventBucket(BaseModel):
+    name: str
+
+
+class S3EventEntity(BaseModel):
+    bucket: S3EventBucket
+    object: S3EventObject
+
+
+class S3EventRecord(BaseModel):
+    eventName: str
+    s3: S3EventEntity
+
+
+class S3Event(BaseModel):
+    """Bucket notification, as sent by the S3 server's webhook target."""
+
+    Records: List[S3EventRecord] = []
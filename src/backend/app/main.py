@@ -6,7 +6,7 @@ from loguru import logger as log
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse, JSONResponse
 
 from app.config import settings
 from app.projects import project_routes
@@ -14,7 +14,14 @@ from app.drones import drone_routes
 from app.waypoints import waypoint_routes
 from app.users import user_routes
 from app.tasks import task_routes
+from app.images import image_routes
 from app.db.database import db_connection
+from app.workers import process_pool
+from app.s3 import async_s3
+from app.tasks.task_stream import task_state_broker
+from app.email_outbox import email_dispatcher
+from app.images.image_ingest import image_ingestor
+from app.utils import preload_email_templates
 
 
 root = os.path.dirname(os.path.abspath(__file__))
@@ -81,6 +88,8 @@ def get_application() -> FastAPI:
         docs_url="/api/docs",
         openapi_url="/api/openapi.json",
         redoc_url="/api/redoc",
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
     )
 
     # Set custom logger
@@ -92,13 +101,14 @@ def get_application() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
-        expose_headers=["Content-Disposition"],
+        expose_headers=["Content-Disposition", "X-Next-Cursor"],
     )
     _app.include_router(drone_routes.router)
     _app.include_router(project_routes.router)
     _app.include_router(waypoint_routes.router)
     _app.include_router(user_routes.router)
     _app.include_router(task_routes.router)
+    _app.include_router(image_routes.router)
 
     return _app
 
@@ -110,11 +120,21 @@ async def lifespan(
     """FastAPI startup/shutdown event."""
     log.debug("Starting up FastAPI server.")
     await db_connection.connect()
+    process_pool.start()
+    await task_state_broker.start()
+    preload_email_templates()
+    email_dispatcher.start()
+    image_ingestor.start()
 
     yield
 
     # Shutdown events
     log.debug("Shutting down FastAPI server.")
+    await email_dispatcher.stop()
+    await image_ingestor.stop()
+    await task_state_broker.stop()
+    process_pool.shutdown()
+    async_s3.shutdown()
     await db_connection.disconnect()
 
 
@@ -0,0 +1,34 @@
+"""render outbox emails at dispatch
+
+Revision ID: a3d8e1f5c902
+Revises: f1a6c3e8d527
+Create Date: 2024-08-19 10:41:07.516224
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "a3d8e1f5c902"
+down_revision: Union[str, None] = "f1a6c3e8d527"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "email_outbox", sa.Column("template_name", sa.String(), nullable=True)
+    )
+    op.add_column(
+        "email_outbox",
+        sa.Column("context", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("email_outbox", "context")
+    op.drop_column("email_outbox", "template_name")
@@ -0,0 +1,99 @@
+"""add project task state counts
+
+Revision ID: b6f2d4a8c1e7
+Revises: a3d8e1f5c902
+Create Date: 2024-08-20 09:12:38.274051
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "b6f2d4a8c1e7"
+down_revision: Union[str, None] = "a3d8e1f5c902"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "project_task_state_counts",
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column(
+            "state",
+            postgresql.ENUM(name="state", create_type=False),
+            nullable=False,
+        ),
+        sa.Column("task_count", sa.Integer(), server_default="0", nullable=False),
+        sa.ForeignKeyConstraint(["project_id"], ["projects.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("project_id", "state"),
+    )
+    op.create_index("idx_projects_author_id", "projects", ["author_id"], unique=False)
+
+    # Move a task between the counters of its old and new state, within the
+    # transaction updating the current state
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION update_project_task_state_counts() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE project_task_state_counts
+                SET task_count = task_count - 1
+                WHERE project_id = OLD.project_id AND state = OLD.state;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO project_task_state_counts (project_id, state, task_count)
+                VALUES (NEW.project_id, NEW.state, 1)
+                ON CONFLICT (project_id, state) DO UPDATE
+                SET task_count = project_task_state_counts.task_count + 1;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER task_current_state_counts
+        AFTER INSERT OR DELETE ON task_current_state
+        FOR EACH ROW EXECUTE FUNCTION update_project_task_state_counts();
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER task_current_state_counts_update
+        AFTER UPDATE OF state, project_id ON task_current_state
+        FOR EACH ROW
+        WHEN (
+            OLD.state IS DISTINCT FROM NEW.state
+            OR OLD.project_id IS DISTINCT FROM NEW.project_id
+        )
+        EXECUTE FUNCTION update_project_task_state_counts();
+        """
+    )
+
+    # Backfill from the current state of each task
+    op.execute(
+        """
+        INSERT INTO project_task_state_counts (project_id, state, task_count)
+        SELECT project_id, state, COUNT(*)
+        FROM task_current_state
+        GROUP BY project_id, state;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        "DROP TRIGGER IF EXISTS task_current_state_counts_update ON task_current_state;"
+    )
+    op.execute(
+        "DROP TRIGGER IF EXISTS task_current_state_counts ON task_current_state;"
+    )
+    op.execute("DROP FUNCTION IF EXISTS update_project_task_state_counts();")
+    op.drop_index("idx_projects_author_id", table_name="projects")
+    op.drop_table("project_task_state_counts")
@@ -0,0 +1,31 @@
+"""add task elevation stats
+
+Revision ID: b7e3c5a1d9f2
+Revises: 2b92f8a9bbec
+Create Date: 2024-08-12 09:24:51.318207
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b7e3c5a1d9f2"
+down_revision: Union[str, None] = "2b92f8a9bbec"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("tasks", sa.Column("min_elevation", sa.Float(), nullable=True))
+    op.add_column("tasks", sa.Column("max_elevation", sa.Float(), nullable=True))
+    op.add_column("tasks", sa.Column("mean_elevation", sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("tasks", "mean_elevation")
+    op.drop_column("tasks", "max_elevation")
+    op.drop_column("tasks", "min_elevation")
@@ -0,0 +1,65 @@
+"""add no fly zones table
+
+Revision ID: c41f8e2a7b6d
+Revises: b7e3c5a1d9f2
+Create Date: 2024-08-13 11:02:37.541830
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "c41f8e2a7b6d"
+down_revision: Union[str, None] = "b7e3c5a1d9f2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "no_fly_zones",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column(
+            "outline",
+            geoalchemy2.types.Geometry(
+                geometry_type="MULTIPOLYGON",
+                srid=4326,
+                from_text="ST_GeomFromEWKT",
+                name="geometry",
+                spatial_index=False,
+            ),
+            nullable=True,
+        ),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["project_id"], ["projects.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_no_fly_zones_project_id"),
+        "no_fly_zones",
+        ["project_id"],
+        unique=False,
+    )
+    op.create_index(
+        "idx_no_fly_zones_outline",
+        "no_fly_zones",
+        ["outline"],
+        unique=False,
+        postgresql_using="gist",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "idx_no_fly_zones_outline",
+        table_name="no_fly_zones",
+        postgresql_using="gist",
+    )
+    op.drop_index(op.f("ix_no_fly_zones_project_id"), table_name="no_fly_zones")
+    op.drop_table("no_fly_zones")
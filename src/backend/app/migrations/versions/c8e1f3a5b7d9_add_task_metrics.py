@@ -0,0 +1,118 @@
+"""add task metrics
+
+Revision ID: c8e1f3a5b7d9
+Revises: b6f2d4a8c1e7
+Create Date: 2024-08-21 11:03:16.842390
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "c8e1f3a5b7d9"
+down_revision: Union[str, None] = "b6f2d4a8c1e7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("tasks", sa.Column("area_m2", sa.Float(), nullable=True))
+    op.add_column("tasks", sa.Column("perimeter_m", sa.Float(), nullable=True))
+    op.add_column(
+        "tasks", sa.Column("bbox", postgresql.ARRAY(sa.Float()), nullable=True)
+    )
+    op.add_column(
+        "tasks",
+        sa.Column(
+            "centroid",
+            geoalchemy2.types.Geometry(
+                geometry_type="POINT",
+                srid=4326,
+                from_text="ST_GeomFromEWKT",
+                name="geometry",
+                spatial_index=False,
+            ),
+            nullable=True,
+        ),
+    )
+    op.add_column("tasks", sa.Column("waypoint_count", sa.Integer(), nullable=True))
+    op.add_column("tasks", sa.Column("flight_time_minutes", sa.Float(), nullable=True))
+
+    # Backfill existing tasks. Spacings follow the project flight parameters
+    # and drone_flightplan's calculate_parameters, as used at task creation.
+    op.execute(
+        """
+        WITH flight AS (
+            SELECT
+                id AS project_id,
+                COALESCE(
+                    NULLIF(altitude_from_ground, 0), NULLIF(gsd_cm_px, 0) * 29.7, 115
+                ) AS altitude,
+                COALESCE(NULLIF(front_overlap, 0), 70) AS forward_overlap,
+                COALESCE(NULLIF(side_overlap, 0), 70) AS side_overlap
+            FROM projects
+        ),
+        spacing AS (
+            SELECT
+                project_id,
+                round(CAST(altitude * 0.71 * (1 - forward_overlap / 100) AS numeric), 2)
+                    AS forward,
+                round(CAST(altitude * 1.26 * (1 - side_overlap / 100) AS numeric), 2)
+                    AS side,
+                round(CAST(altitude * 0.71 * (1 - forward_overlap / 100) / 2 AS numeric), 2)
+                    AS ground_speed
+            FROM flight
+        ),
+        plans AS (
+            SELECT
+                tasks.id,
+                CAST(spacing.side AS float8) AS side,
+                CAST(spacing.ground_speed AS float8) AS ground_speed,
+                floor(
+                    (ST_YMax(mercator) - ST_YMin(mercator))
+                    / NULLIF(CAST(spacing.side AS float8), 0)
+                ) AS line_gaps,
+                ST_XMax(mercator) - ST_XMin(mercator) + 3 * CAST(spacing.forward AS float8)
+                    AS line_length,
+                sqrt(
+                    (ST_XMax(mercator) - ST_XMin(mercator)) ^ 2
+                    + (ST_YMax(mercator) - ST_YMin(mercator)) ^ 2
+                ) AS diagonal,
+                cos(radians(ST_Y(ST_Centroid(tasks.outline)))) AS scale
+            FROM tasks
+            JOIN spacing ON spacing.project_id = tasks.project_id
+            CROSS JOIN LATERAL ST_Transform(tasks.outline, 3857) AS mercator
+            WHERE tasks.outline IS NOT NULL
+        )
+        UPDATE tasks
+        SET area_m2 = ST_Area(tasks.outline::geography),
+            perimeter_m = ST_Perimeter(tasks.outline::geography),
+            bbox = ARRAY[
+                ST_XMin(tasks.outline), ST_YMin(tasks.outline),
+                ST_XMax(tasks.outline), ST_YMax(tasks.outline)
+            ],
+            centroid = ST_Centroid(tasks.outline),
+            waypoint_count = 6 + 4 * CAST(plans.line_gaps AS integer),
+            flight_time_minutes = (
+                (plans.line_gaps + 1) * plans.line_length
+                + plans.line_gaps * plans.side
+                + plans.diagonal
+            ) * plans.scale / NULLIF(plans.ground_speed, 0) / 60
+        FROM plans
+        WHERE plans.id = tasks.id;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("tasks", "flight_time_minutes")
+    op.drop_column("tasks", "waypoint_count")
+    op.drop_column("tasks", "centroid")
+    op.drop_column("tasks", "bbox")
+    op.drop_column("tasks", "perimeter_m")
+    op.drop_column("tasks", "area_m2")
@@ -0,0 +1,31 @@
+"""index projects created_at id
+
+Revision ID: d2f4a6c8e0b1
+Revises: c8e1f3a5b7d9
+Create Date: 2024-08-22 15:37:52.104688
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d2f4a6c8e0b1"
+down_revision: Union[str, None] = "c8e1f3a5b7d9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "idx_projects_created_at_id",
+        "projects",
+        ["created_at", "id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_projects_created_at_id", table_name="projects")
@@ -0,0 +1,107 @@
+"""add task current state
+
+Revision ID: d9a4b2e6f013
+Revises: c41f8e2a7b6d
+Create Date: 2024-08-14 10:17:45.902114
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "d9a4b2e6f013"
+down_revision: Union[str, None] = "c41f8e2a7b6d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "task_current_state",
+        sa.Column("task_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("project_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("event_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("user_id", sa.String(length=100), nullable=True),
+        sa.Column("comment", sa.String(), nullable=True),
+        sa.Column(
+            "state",
+            postgresql.ENUM(name="state", create_type=False),
+            nullable=False,
+        ),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["task_id"], ["tasks.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["project_id"], ["projects.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("task_id"),
+    )
+    op.create_index(
+        "idx_task_current_state_project_id",
+        "task_current_state",
+        ["project_id", "state"],
+        unique=False,
+    )
+    op.create_index(
+        "idx_task_event_project_task_created",
+        "task_events",
+        ["project_id", "task_id", sa.text("created_at DESC")],
+        unique=False,
+    )
+
+    # Keep the current state of a task in step with each new or updated event,
+    # within the same transaction
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION update_task_current_state() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO task_current_state (
+                task_id, project_id, event_id, user_id, comment, state, created_at
+            )
+            VALUES (
+                NEW.task_id, NEW.project_id, NEW.event_id, NEW.user_id,
+                NEW.comment, NEW.state, NEW.created_at
+            )
+            ON CONFLICT (task_id) DO UPDATE
+            SET project_id = EXCLUDED.project_id,
+                event_id = EXCLUDED.event_id,
+                user_id = EXCLUDED.user_id,
+                comment = EXCLUDED.comment,
+                state = EXCLUDED.state,
+                created_at = EXCLUDED.created_at
+            WHERE task_current_state.created_at IS NULL
+                OR task_current_state.created_at <= EXCLUDED.created_at;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER task_events_current_state
+        AFTER INSERT OR UPDATE ON task_events
+        FOR EACH ROW EXECUTE FUNCTION update_task_current_state();
+        """
+    )
+
+    # Backfill from the latest event of each task
+    op.execute(
+        """
+        INSERT INTO task_current_state (
+            task_id, project_id, event_id, user_id, comment, state, created_at
+        )
+        SELECT DISTINCT ON (task_id)
+            task_id, project_id, event_id, user_id, comment, state, created_at
+        FROM task_events
+        ORDER BY task_id, created_at DESC NULLS LAST;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS task_events_current_state ON task_events;")
+    op.execute("DROP FUNCTION IF EXISTS update_task_current_state();")
+    op.drop_index("idx_task_event_project_task_created", table_name="task_events")
+    op.drop_index("idx_task_current_state_project_id", table_name="task_current_state")
+    op.drop_table("task_current_state")
@@ -0,0 +1,84 @@
+"""add images
+
+Revision ID: e3b5d7f9a1c2
+Revises: d2f4a6c8e0b1
+Create Date: 2024-08-23 10:12:45.318804
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+
+# revision identifiers, used by Alembic.
+revision: str = "e3b5d7f9a1c2"
+down_revision: Union[str, None] = "d2f4a6c8e0b1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "images",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("project_id", sa.UUID(), nullable=False),
+        sa.Column("task_id", sa.UUID(), nullable=True),
+        sa.Column("s3_path", sa.String(), nullable=False),
+        sa.Column("etag", sa.String(), nullable=True),
+        sa.Column("size", sa.BigInteger(), nullable=True),
+        sa.Column(
+            "location",
+            geoalchemy2.types.Geometry(
+                geometry_type="POINT",
+                srid=4326,
+                from_text="ST_GeomFromEWKT",
+                name="geometry",
+                spatial_index=False,
+            ),
+            nullable=True,
+        ),
+        sa.Column("altitude", sa.Float(), nullable=True),
+        sa.Column("relative_altitude", sa.Float(), nullable=True),
+        sa.Column("gimbal_pitch", sa.Float(), nullable=True),
+        sa.Column("captured_at", sa.DateTime(), nullable=True),
+        sa.Column("camera", sa.String(), nullable=True),
+        sa.Column("attempts", sa.SmallInteger(), server_default="0", nullable=False),
+        sa.Column("last_error", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=True),
+        sa.Column("ingested_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["project_id"], ["projects.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["task_id"], ["tasks.id"], ondelete="SET NULL"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("idx_images_s3_path", "images", ["s3_path"], unique=True)
+    op.create_index(
+        "idx_images_project_id_task_id",
+        "images",
+        ["project_id", "task_id"],
+        unique=False,
+    )
+    op.create_index(
+        "idx_images_location",
+        "images",
+        ["location"],
+        unique=False,
+        postgresql_using="gist",
+    )
+    op.create_index(
+        "idx_images_pending",
+        "images",
+        ["next_attempt_at"],
+        unique=False,
+        postgresql_where=sa.text("ingested_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_images_pending", table_name="images")
+    op.drop_index("idx_images_location", table_name="images")
+    op.drop_index("idx_images_project_id_task_id", table_name="images")
+    op.drop_index("idx_images_s3_path", table_name="images")
+    op.drop_table("images")
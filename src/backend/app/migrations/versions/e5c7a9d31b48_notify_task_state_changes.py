@@ -0,0 +1,52 @@
+"""notify task state changes
+
+Revision ID: e5c7a9d31b48
+Revises: d9a4b2e6f013
+Create Date: 2024-08-15 09:41:06.284517
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e5c7a9d31b48"
+down_revision: Union[str, None] = "d9a4b2e6f013"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Notifications are only delivered once the event transaction commits
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_task_state() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'task_state',
+                json_build_object(
+                    'project_id', NEW.project_id,
+                    'task_id', NEW.task_id,
+                    'user_id', NEW.user_id,
+                    'state', NEW.state,
+                    'created_at', NEW.created_at
+                )::text
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER task_events_notify_state
+        AFTER INSERT OR UPDATE ON task_events
+        FOR EACH ROW EXECUTE FUNCTION notify_task_state();
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS task_events_notify_state ON task_events;")
+    op.execute("DROP FUNCTION IF EXISTS notify_task_state();")
@@ -0,0 +1,51 @@
+"""add email outbox
+
+Revision ID: f1a6c3e8d527
+Revises: e5c7a9d31b48
+Create Date: 2024-08-16 14:05:22.731908
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "f1a6c3e8d527"
+down_revision: Union[str, None] = "e5c7a9d31b48"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "email_outbox",
+        sa.Column("id", sa.BigInteger(), autoincrement=True, nullable=False),
+        sa.Column("dedup_key", sa.String(), nullable=False),
+        sa.Column("email_to", sa.String(), nullable=False),
+        sa.Column("subject", sa.String(), nullable=True),
+        sa.Column("html_content", sa.Text(), nullable=True),
+        sa.Column("attempts", sa.SmallInteger(), server_default="0", nullable=False),
+        sa.Column("last_error", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=True),
+        sa.Column("sent_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "idx_email_outbox_dedup_key", "email_outbox", ["dedup_key"], unique=True
+    )
+    op.create_index(
+        "idx_email_outbox_pending",
+        "email_outbox",
+        ["next_attempt_at"],
+        unique=False,
+        postgresql_where=sa.text("sent_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_email_outbox_pending", table_name="email_outbox")
+    op.drop_index("idx_email_outbox_dedup_key", table_name="email_outbox")
+    op.drop_table("email_outbox")
@@ -0,0 +1,118 @@
+"""notify project changes
+
+Revision ID: f4c6e8a0b2d3
+Revises: e3b5d7f9a1c2
+Create Date: 2024-08-26 11:27:38.904216
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f4c6e8a0b2d3"
+down_revision: Union[str, None] = "e3b5d7f9a1c2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Changes to the columns drawn in the vector tiles of projects and tasks,
+    # so that every worker drops the tiles cached before the change
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_project_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'project_change',
+                json_build_object(
+                    'project_id', CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END,
+                    'table', 'projects'
+                )::text
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER projects_notify_change
+        AFTER INSERT OR DELETE OR UPDATE OF outline, slug, name ON projects
+        FOR EACH ROW EXECUTE FUNCTION notify_project_change();
+        """
+    )
+
+    # Tasks are inserted and deleted in bulk, so they are notified once per
+    # statement and project, from the transition tables
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_tasks_change() RETURNS trigger AS $$
+        DECLARE
+            changed_project_ids uuid[];
+            changed_project_id uuid;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(DISTINCT project_id) INTO changed_project_ids
+                FROM new_tasks;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT array_agg(DISTINCT project_id) INTO changed_project_ids
+                FROM old_tasks;
+            ELSE
+                SELECT array_agg(DISTINCT new_tasks.project_id) INTO changed_project_ids
+                FROM new_tasks
+                JOIN old_tasks ON old_tasks.id = new_tasks.id
+                WHERE new_tasks.outline IS DISTINCT FROM old_tasks.outline
+                OR new_tasks.project_task_index IS DISTINCT FROM old_tasks.project_task_index;
+            END IF;
+
+            FOREACH changed_project_id IN ARRAY COALESCE(changed_project_ids, '{}')
+            LOOP
+                PERFORM pg_notify(
+                    'project_change',
+                    json_build_object(
+                        'project_id', changed_project_id,
+                        'table', 'tasks'
+                    )::text
+                );
+            END LOOP;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    # Transition tables need a trigger per event
+    op.execute(
+        """
+        CREATE TRIGGER tasks_notify_insert
+        AFTER INSERT ON tasks
+        REFERENCING NEW TABLE AS new_tasks
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_tasks_change();
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER tasks_notify_delete
+        AFTER DELETE ON tasks
+        REFERENCING OLD TABLE AS old_tasks
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_tasks_change();
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER tasks_notify_update
+        AFTER UPDATE ON tasks
+        REFERENCING OLD TABLE AS old_tasks NEW TABLE AS new_tasks
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_tasks_change();
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS tasks_notify_update ON tasks;")
+    op.execute("DROP TRIGGER IF EXISTS tasks_notify_delete ON tasks;")
+    op.execute("DROP TRIGGER IF EXISTS tasks_notify_insert ON tasks;")
+    op.execute("DROP FUNCTION IF EXISTS notify_tasks_change();")
+    op.execute("DROP TRIGGER IF EXISTS projects_notify_change ON projects;")
+    op.execute("DROP FUNCTION IF EXISTS notify_project_change();")
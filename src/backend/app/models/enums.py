@@ -107,10 +107,13 @@ class HTTPStatus(IntEnum):
     NOT_FOUND = 404
     CONFLICT = 409
     UNPROCESSABLE_ENTITY = 422
+    TOO_MANY_REQUESTS = 429
 
     # Server Error
     INTERNAL_SERVER_ERROR = 500
     NOT_IMPLEMENTED = 501
+    SERVICE_UNAVAILABLE = 503
+    GATEWAY_TIMEOUT = 504
 
 
 class DroneType(IntEnum):
@@ -1,19 +1,82 @@
+import asyncio
+import base64
+import hashlib
 import json
+import os
+import shutil
+import tempfile
 import uuid
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
+import geojson
+import numpy as np
+import orjson
+import shapely
 from app.projects import project_schemas
 from loguru import logger as log
-import shapely.wkb as wkblib
-from shapely.geometry import shape
+from minio.helpers import quote
 from fastapi import HTTPException, UploadFile
+from shapely import STRtree
+from shapely.geometry import GeometryCollection, mapping, shape
 from app.utils import merge_multipolygon
-from fmtm_splitter.splitter import split_by_square
 from fastapi.concurrency import run_in_threadpool
 from databases import Database
-from app.models.enums import ProjectStatus
+from app.models.enums import ProjectStatus, State
 from app.utils import generate_slug
-from io import BytesIO
-from app.s3 import add_obj_to_bucket
+from app.s3 import async_s3, s3_presigner
 from app.config import settings
+from app.dem import convert_to_cog, dem_cache, task_elevation_stats
+from app.models.enums import HTTPStatus
+from app.tasks.task_crud import get_project_tasks_geojson
+from app.tasks.task_stream import task_state_broker
+from app.waypoints import waypoint_crud
+from app.workers import process_pool
+from app.cache import LRUCache
+
+
+# Outline simplification for the projects listing, in degrees (about 10 m)
+PROJECT_LIST_SIMPLIFY_TOLERANCE = 0.0001
+
+split_preview_cache = LRUCache(settings.SPLIT_PREVIEW_CACHE_MAX_MB * 1024 * 1024)
+
+
+def geometry_nbytes(value) -> int:
+    """Approximate the memory used by geometries, from their coordinates."""
+    if isinstance(value, STRtree):
+        value = value.geometries
+    return int(np.sum(shapely.get_num_coordinates(value))) * 16
+
+
+no_fly_cache = LRUCache(
+    settings.NO_FLY_CACHE_MAX_MB * 1024 * 1024, sizeof=geometry_nbytes
+)
+
+
+# Vector tiles of projects and of each project's tasks, cached per worker and
+# keyed on the project id, or PROJECTS_TILE_NAMESPACE for the projects layer
+tile_cache = LRUCache(settings.TILE_CACHE_MAX_MB * 1024 * 1024)
+# Images signed per threadpool job when streaming presigned URLs
+PRESIGN_BATCH_SIZE = 500
+PROJECTS_TILE_NAMESPACE = "projects"
+MAX_TILE_ZOOM = 22
+
+
+def invalidate_tiles(change: Optional[dict]):
+    """Drop the cached tiles of a project whose tasks changed.
+
+    Changes are notified to every worker by the database, see
+    TaskStateBroker, so each drops its own tiles. The projects layer is
+    also dropped when the project itself changed.
+    """
+    if change is None:
+        tile_cache.clear()
+        return
+    tile_cache.invalidate(change["project_id"])
+    if change.get("table") == "projects":
+        tile_cache.invalidate(PROJECTS_TILE_NAMESPACE)
+
+
+task_state_broker.add_listener(invalidate_tiles)
 
 
 async def update_project_dem_url(db: Database, project_id: uuid.UUID, dem_url: str):
@@ -27,33 +90,165 @@ async def update_project_dem_url(db: Database, project_id: uuid.UUID, dem_url: s
     return True
 
 
+def image_upload_path(
+    project_id: uuid.UUID, task_id: uuid.UUID, image_name: str = ""
+) -> str:
+    """Return the S3 path of an image uploaded for a task."""
+    return f"publicuploads/{project_id}/{task_id}/{image_name}"
+
+
+def presign_image_uploads(
+    project_id: uuid.UUID,
+    task_id: uuid.UUID,
+    image_names: list[str],
+    expires: timedelta,
+) -> list[dict]:
+    """Presign the upload URLs of the images of a task."""
+    objects = (
+        (image_upload_path(project_id, task_id, name), None) for name in image_names
+    )
+    signed = s3_presigner().presign("PUT", settings.S3_BUCKET_NAME, objects, expires)
+    return [
+        {"image_name": name, "url": url} for name, (_, url) in zip(image_names, signed)
+    ]
+
+
+async def stream_presigned_image_uploads(
+    project_id: uuid.UUID,
+    task_id: uuid.UUID,
+    image_names: list[str],
+    expires: timedelta,
+) -> AsyncIterator[bytes]:
+    """Stream the signatures of image uploads, as newline delimited JSON.
+
+    The first line holds what every URL shares, `url_prefix` and `query`; each
+    following line an image, `[image_name, path, signature]`, whose upload URL
+    is `{url_prefix}{path}?{query}&X-Amz-Signature={signature}`. Images are
+    signed in batches, off the event loop, as the response is sent.
+    """
+    presigner = s3_presigner()
+    signed_at = datetime.now(timezone.utc)
+    prefix = (
+        f"/{settings.S3_BUCKET_NAME}/{quote(image_upload_path(project_id, task_id))}"
+    )
+
+    def sign_batch(names: list[str]) -> tuple[str, bytes]:
+        objects = (
+            (image_upload_path(project_id, task_id, name), None) for name in names
+        )
+        signed = presigner.sign(
+            "PUT", settings.S3_BUCKET_NAME, objects, expires, signed_at
+        )
+        query = ""
+        lines = []
+        for name, (_, path, query, signature) in zip(names, signed):
+            lines.append(orjson.dumps([name, path[len(prefix) :], signature]))
+        return query, b"\n".join(lines) + b"\n"
+
+    for start in range(0, len(image_names), PRESIGN_BATCH_SIZE):
+        query, lines = await run_in_threadpool(
+            sign_batch, image_names[start : start + PRESIGN_BATCH_SIZE]
+        )
+        if start == 0:
+            header = {
+                "url_prefix": f"{presigner.base_url}{prefix}",
+                "query": query,
+                "expires_at": (signed_at + expires).isoformat(),
+            }
+            yield orjson.dumps(header) + b"\n"
+        yield lines
+
+
 async def upload_dem_to_s3(project_id: uuid.UUID, dem_file: UploadFile) -> str:
-    """Upload dem into S3.
+    """Convert a DEM to a cloud optimised GeoTIFF and upload it into S3.
 
     Args:
         project_id (int): The organisation id in the database.
-        dem_file (UploadFile): The logo image uploaded to FastAPI.
+        dem_file (UploadFile): The DEM raster uploaded to FastAPI.
 
     Returns:
         dem_url(str): The S3 URL for the dem file.
     """
     dem_path = f"/dem/{project_id}/dem.tif"
 
-    file_bytes = await dem_file.read()
-    file_obj = BytesIO(file_bytes)
-
-    add_obj_to_bucket(
-        settings.S3_BUCKET_NAME,
-        file_obj,
-        dem_path,
-        content_type=dem_file.content_type,
-    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        upload_path = os.path.join(temp_dir, "upload.tif")
+        cog_path = os.path.join(temp_dir, "dem.tif")
+
+        # Spool the upload to disk, rather than holding it in memory
+        with open(upload_path, "wb") as buffer:
+            await run_in_threadpool(shutil.copyfileobj, dem_file.file, buffer)
+
+        try:
+            await process_pool.run(
+                convert_to_cog,
+                upload_path,
+                cog_path,
+                timeout=settings.DEM_INGEST_TIMEOUT,
+            )
+        except (RuntimeError, ValueError) as e:
+            log.warning(f"Failed to convert DEM for project {project_id}: {e}")
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"The DEM could not be read as a GeoTIFF: {e}",
+            ) from e
+
+        checksum = await async_s3.add_file_to_bucket(
+            settings.S3_BUCKET_NAME,
+            cog_path,
+            dem_path,
+            content_type="image/tiff",
+        )
+        log.info(f"Uploaded DEM of project {project_id}, sha256 {checksum}")
 
     dem_url = f"{settings.S3_DOWNLOAD_ROOT}/{settings.S3_BUCKET_NAME}{dem_path}"
 
     return dem_url
 
 
+async def update_task_elevation_stats(db: Database, project_id: uuid.UUID):
+    """Store the min, max and mean elevation of each task, from the project DEM.
+
+    Only the window of the DEM covering the tasks is read from S3.
+    Does nothing if the project has no tasks or no DEM.
+    """
+    tasks = await get_project_tasks_geojson(db, project_id)
+    if not tasks:
+        return
+
+    dem_s3_path = f"dem/{project_id}/dem.tif"
+    dem_etag = await async_s3.get_obj_etag(settings.S3_BUCKET_NAME, dem_s3_path)
+    if not dem_etag:
+        return
+
+    outlines = [task["outline"] for task in tasks]
+    bounds = shapely.total_bounds(shapely.from_geojson(outlines))
+    dem_window = await run_in_threadpool(
+        dem_cache.get_window,
+        settings.S3_BUCKET_NAME,
+        dem_s3_path,
+        dem_etag,
+        tuple(bounds.tolist()),
+    )
+    with dem_window as dem_path:
+        stats = await process_pool.run(
+            task_elevation_stats,
+            dem_path,
+            [(str(task["id"]), task["outline"]) for task in tasks],
+            timeout=settings.DEM_INGEST_TIMEOUT,
+        )
+
+    query = """
+        UPDATE tasks
+        SET min_elevation = :min_elevation,
+            max_elevation = :max_elevation,
+            mean_elevation = :mean_elevation
+        WHERE id = :id;
+    """
+    await db.execute_many(query, stats)
+    log.debug(f"Updated elevation stats of {len(stats)} tasks in project {project_id}")
+
+
 async def create_project_with_project_info(
     db: Database, author_id: uuid.UUID, project_metadata: project_schemas.ProjectIn
 ):
@@ -130,119 +325,674 @@ async def get_project_by_id(db: Database, project_id: uuid.UUID):
     return result
 
 
-async def get_project_info_by_id(db: Database, project_id: uuid.UUID):
-    """Get a single project &  all associated tasks by ID."""
+async def get_project_info_json(db: Database, project_id: uuid.UUID) -> Optional[str]:
+    """Get a single project & all associated tasks by ID, as JSON built by PostGIS.
+
+    The JSON has the shape of `project_schemas.ProjectOut`, so it can be sent
+    as is, without decoding the outlines in Python.
+    """
     query = """
-    SELECT
-        projects.id,
-        projects.slug,
-        projects.name,
-        projects.description,
-        projects.per_task_instructions,
-        projects.outline
-    FROM projects
-    WHERE projects.id = :project_id
-    LIMIT 1;
-    """
-
-    project_record = await db.fetch_one(query, {"project_id": project_id})
-    if not project_record:
-        return None
-    query = """ SELECT id, project_task_index, outline FROM tasks WHERE project_id = :project_id;"""
-    task_records = await db.fetch_all(query, {"project_id": project_id})
-    project_record.tasks = task_records if task_records is not None else []
-    project_record.task_count = len(task_records)
-    return project_record
+        SELECT json_build_object(
+            'id', projects.id,
+            'slug', projects.slug,
+            'name', projects.name,
+            'description', projects.description,
+            'per_task_instructions', projects.per_task_instructions,
+            'task_count', COALESCE(project_tasks.task_count, 0),
+            'tasks', COALESCE(project_tasks.tasks, '[]'),
+            'outline_geojson', CASE WHEN projects.outline IS NOT NULL THEN
+                json_build_object(
+                    'type', 'Feature',
+                    'geometry', CAST(ST_AsGeoJSON(projects.outline) AS json),
+                    'properties', json_build_object(
+                        'id', projects.id,
+                        'bbox', json_build_array(
+                            ST_XMin(projects.outline), ST_YMin(projects.outline),
+                            ST_XMax(projects.outline), ST_YMax(projects.outline)
+                        )
+                    ),
+                    'id', projects.id
+                )
+            END
+        )
+        FROM projects
+        LEFT JOIN LATERAL (
+            SELECT
+                COUNT(*) AS task_count,
+                json_agg(
+                    json_build_object(
+                        'id', tasks.id,
+                        'project_task_index', tasks.project_task_index,
+                        'state', NULL,
+                        'contributor', NULL,
+                        'min_elevation', tasks.min_elevation,
+                        'max_elevation', tasks.max_elevation,
+                        'mean_elevation', tasks.mean_elevation,
+                        'outline_geojson', CASE WHEN tasks.outline IS NOT NULL THEN
+                            json_build_object(
+                                'type', 'Feature',
+                                'geometry', CAST(ST_AsGeoJSON(tasks.outline) AS json),
+                                'properties', json_build_object(
+                                    'id', tasks.id,
+                                    'bbox', json_build_array(
+                                        ST_XMin(tasks.outline), ST_YMin(tasks.outline),
+                                        ST_XMax(tasks.outline), ST_YMax(tasks.outline)
+                                    )
+                                ),
+                                'id', tasks.id
+                            )
+                        END
+                    )
+                    ORDER BY tasks.project_task_index
+                ) AS tasks
+            FROM tasks
+            WHERE tasks.project_id = projects.id
+        ) project_tasks ON true
+        WHERE projects.id = :project_id;
+    """
+    return await db.fetch_val(query, {"project_id": project_id})
+
+
+def encode_project_cursor(created_at: datetime, project_id: uuid.UUID) -> str:
+    """Encode the position after a project in the listing as an opaque cursor."""
+    position = f"{created_at.isoformat()}|{project_id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_project_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    """Decode a cursor from `encode_project_cursor`."""
+    try:
+        created_at, project_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        )
+        return datetime.fromisoformat(created_at), uuid.UUID(project_id)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Invalid cursor"
+        ) from e
 
 
 async def get_projects(
     db: Database,
-    skip: int = 0,
     limit: int = 100,
-):
-    """Get all projects."""
-    raw_sql = """
-        SELECT id, slug, name, description, per_task_instructions, outline
-        FROM projects
-        ORDER BY created_at DESC
-        OFFSET :skip
+    cursor: Optional[str] = None,
+    skip: int = 0,
+) -> tuple[list, Optional[str]]:
+    """Get a page of projects, newest first.
+
+    Pages are selected by keyset on (created_at, id), from the cursor of the
+    previous page; `skip` is only used without a cursor. Projects come with a
+    simplified outline, their centroid and bounds, and the number of tasks
+    in each state, rather than their full geometry.
+
+    Returns:
+        tuple: The projects, and the cursor of the next page or None if this
+            is the last page.
+    """
+    values = {
+        "limit": limit + 1,
+        "tolerance": PROJECT_LIST_SIMPLIFY_TOLERANCE,
+    }
+    if cursor:
+        values["created_at"], values["id"] = decode_project_cursor(cursor)
+        page_filter = "WHERE (p.created_at, p.id) < (:created_at, :id)"
+        offset = ""
+    else:
+        values["skip"] = skip
+        page_filter = ""
+        offset = "OFFSET :skip"
+
+    raw_sql = f"""
+        SELECT
+            p.id,
+            p.slug,
+            p.name,
+            p.description,
+            p.per_task_instructions,
+            p.created_at,
+            ARRAY[ST_X(ST_Centroid(p.outline)), ST_Y(ST_Centroid(p.outline))] AS centroid,
+            ARRAY[ST_XMin(p.outline), ST_YMin(p.outline), ST_XMax(p.outline), ST_YMax(p.outline)] AS bbox,
+            ST_AsGeoJSON(ST_SimplifyPreserveTopology(p.outline, :tolerance), 6) AS outline,
+            COALESCE(counts.task_states, '{{}}') AS task_states
+        FROM projects p
+        LEFT JOIN LATERAL (
+            SELECT json_object_agg(c.state, c.task_count) AS task_states
+            FROM project_task_state_counts c
+            WHERE c.project_id = p.id AND c.task_count > 0
+        ) counts ON true
+        {page_filter}
+        ORDER BY p.created_at DESC, p.id DESC
+        {offset}
         LIMIT :limit;
         """
-    db_projects = await db.fetch_all(raw_sql, {"skip": skip, "limit": limit})
+    db_projects = await db.fetch_all(raw_sql, values)
 
-    return db_projects
+    next_cursor = None
+    if len(db_projects) > limit:
+        db_projects = db_projects[:limit]
+        last = db_projects[-1]
+        next_cursor = encode_project_cursor(last["created_at"], last["id"])
+    return db_projects, next_cursor
+
+
+def validate_tile(z: int, x: int, y: int):
+    """Check that tile coordinates exist at their zoom level."""
+    if not 0 <= z <= MAX_TILE_ZOOM or not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Invalid tile coordinates"
+        )
+
+
+async def cached_tile(db: Database, key: tuple, query: str, values: dict) -> bytes:
+    """Render a vector tile with PostGIS, or return it from the tile cache.
+
+    Tiles are only cached while the changes of tasks and projects are
+    received, see `invalidate_tiles`, so that they cannot go stale.
+    """
+    tile = tile_cache.get(key)
+    if tile is None:
+        tile = bytes(await db.fetch_val(query, values) or b"")
+        if task_state_broker.is_listening:
+            tile_cache.set(key, tile)
+    return tile
+
+
+async def get_projects_tile(db: Database, z: int, x: int, y: int) -> bytes:
+    """Get a Mapbox vector tile of the project outlines."""
+    validate_tile(z, x, y)
+    query = """
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+        ),
+        features AS (
+            SELECT
+                ST_AsMVTGeom(ST_Transform(p.outline, 3857), bounds.geom) AS geom,
+                CAST(p.id AS text) AS id,
+                p.slug,
+                p.name
+            FROM projects p, bounds
+            WHERE p.outline && ST_Transform(bounds.geom, 4326)
+        )
+        SELECT ST_AsMVT(features, 'projects', 4096, 'geom')
+        FROM features;
+    """
+    return await cached_tile(
+        db,
+        (PROJECTS_TILE_NAMESPACE, z, x, y),
+        query,
+        {"z": z, "x": x, "y": y},
+    )
+
+
+async def get_tasks_tile(
+    db: Database, project_id: uuid.UUID, z: int, x: int, y: int
+) -> bytes:
+    """Get a Mapbox vector tile of the tasks of a project, with their state."""
+    validate_tile(z, x, y)
+    query = """
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+        ),
+        features AS (
+            SELECT
+                ST_AsMVTGeom(ST_Transform(t.outline, 3857), bounds.geom) AS geom,
+                CAST(t.id AS text) AS id,
+                t.project_task_index,
+                COALESCE(CAST(s.state AS text), :unlocked_to_map_state) AS state
+            FROM tasks t
+            CROSS JOIN bounds
+            LEFT JOIN task_current_state s ON s.task_id = t.id
+            WHERE t.project_id = :project_id
+            AND t.outline && ST_Transform(bounds.geom, 4326)
+        )
+        SELECT ST_AsMVT(features, 'tasks', 4096, 'geom')
+        FROM features;
+    """
+    return await cached_tile(
+        db,
+        (str(project_id), z, x, y),
+        query,
+        {
+            "z": z,
+            "x": x,
+            "y": y,
+            "project_id": project_id,
+            "unlocked_to_map_state": State.UNLOCKED_TO_MAP.name,
+        },
+    )
 
 
 async def create_tasks_from_geojson(
     db: Database,
     project_id: uuid.UUID,
     boundaries: str,
-):
-    """Create tasks for a project, from provided task boundaries."""
+) -> int:
+    """Create tasks for a project, from provided task boundaries.
+
+    All tasks are inserted in a single transaction, by copying them into
+    a temporary staging table, so that large task grids are fast to insert.
+
+    Returns:
+        int: The number of tasks created.
+    """
+    if isinstance(boundaries, str):
+        boundaries = json.loads(boundaries)
+
+    if boundaries["type"] == "Feature":
+        polygons = [boundaries]
+    else:
+        polygons = boundaries["features"]
+    log.debug(f"Processing {len(polygons)} task geometries")
+
+    records = []
+    for index, polygon in enumerate(polygons):
+        geometry = polygon["geometry"]
+        # If the polygon is a MultiPolygon, convert it to a Polygon
+        if geometry["type"] == "MultiPolygon":
+            geometry = {"type": "Polygon", "coordinates": geometry["coordinates"][0]}
+        records.append((uuid.uuid4(), index + 1, json.dumps(geometry)))
+
     try:
-        if isinstance(boundaries, str):
-            boundaries = json.loads(boundaries)
-
-        # Update the boundary polyon on the database.
-        if boundaries["type"] == "Feature":
-            polygons = [boundaries]
-        else:
-            polygons = boundaries["features"]
-        log.debug(f"Processing {len(polygons)} task geometries")
-        for index, polygon in enumerate(polygons):
-            try:
-                # If the polygon is a MultiPolygon, convert it to a Polygon
-                if polygon["geometry"]["type"] == "MultiPolygon":
-                    log.debug("Converting MultiPolygon to Polygon")
-                    polygon["geometry"]["type"] = "Polygon"
-                    polygon["geometry"]["coordinates"] = polygon["geometry"][
-                        "coordinates"
-                    ][0]
-
-                task_id = str(uuid.uuid4())
-                query = """
-                    INSERT INTO tasks (id, project_id, outline, project_task_index)
-                    VALUES (:id, :project_id, :outline, :project_task_index);"""
-
-                result = await db.execute(
-                    query,
-                    values={
-                        "id": task_id,
-                        "project_id": project_id,
-                        "outline": wkblib.dumps(shape(polygon["geometry"]), hex=True),
-                        "project_task_index": index + 1,
-                    },
+        async with db.connection() as connection:
+            async with connection.transaction():
+                project = await connection.fetch_one(
+                    """
+                    SELECT altitude_from_ground, gsd_cm_px, front_overlap, side_overlap
+                    FROM projects
+                    WHERE id = :project_id
+                    """,
+                    {"project_id": project_id},
                 )
-
-                if result:
-                    log.debug(
-                        "Created database task | "
-                        f"Project ID {project_id} | "
-                        f"Task index {index}"
+                if project is None:
+                    raise HTTPException(
+                        status_code=HTTPStatus.NOT_FOUND, detail="Project not found"
                     )
-                    log.debug(
-                        "COMPLETE: creating project boundary, based on task boundaries"
+                spacing = waypoint_crud.flight_spacing(project)
+
+                raw_connection = connection.raw_connection
+                await raw_connection.execute(
+                    """
+                    CREATE TEMP TABLE tasks_staging (
+                        id UUID, project_task_index INTEGER, outline TEXT
+                    ) ON COMMIT DROP;
+                    """
+                )
+                await raw_connection.copy_records_to_table(
+                    "tasks_staging",
+                    records=records,
+                    columns=["id", "project_task_index", "outline"],
+                )
+                # The flight estimate follows drone_flightplan: flight lines
+                # side_spacing apart across the Web Mercator bounds, each
+                # extended by forward_spacing before and twice after, with two
+                # waypoints at both ends of each line, flown from and back to
+                # the centroid. Mercator distances are scaled to the ground at
+                # the task latitude.
+                task_count = await raw_connection.fetchval(
+                    """
+                    WITH spacing AS (
+                        SELECT
+                            CAST($2 AS float8) AS forward,
+                            CAST($3 AS float8) AS side,
+                            CAST($4 AS float8) AS ground_speed
+                    ),
+                    staged AS (
+                        SELECT
+                            id,
+                            project_task_index,
+                            ST_SetSRID(ST_GeomFromGeoJSON(outline), 4326) AS outline
+                        FROM tasks_staging
+                    ),
+                    plans AS (
+                        SELECT
+                            staged.*,
+                            spacing.*,
+                            floor((ST_YMax(mercator) - ST_YMin(mercator)) / NULLIF(spacing.side, 0)) AS line_gaps,
+                            ST_XMax(mercator) - ST_XMin(mercator) + 3 * spacing.forward AS line_length,
+                            sqrt(
+                                (ST_XMax(mercator) - ST_XMin(mercator)) ^ 2
+                                + (ST_YMax(mercator) - ST_YMin(mercator)) ^ 2
+                            ) AS diagonal,
+                            cos(radians(ST_Y(ST_Centroid(outline)))) AS scale
+                        FROM staged
+                        CROSS JOIN spacing
+                        CROSS JOIN LATERAL ST_Transform(outline, 3857) AS mercator
+                    ),
+                    inserted AS (
+                        INSERT INTO tasks (
+                            id, project_id, outline, project_task_index,
+                            area_m2, perimeter_m, bbox, centroid,
+                            waypoint_count, flight_time_minutes
+                        )
+                        SELECT
+                            id,
+                            $1,
+                            outline,
+                            project_task_index,
+                            ST_Area(outline::geography),
+                            ST_Perimeter(outline::geography),
+                            ARRAY[ST_XMin(outline), ST_YMin(outline), ST_XMax(outline), ST_YMax(outline)],
+                            ST_Centroid(outline),
+                            6 + 4 * line_gaps::integer,
+                            ((line_gaps + 1) * line_length + line_gaps * side + diagonal)
+                                * scale / NULLIF(ground_speed, 0) / 60
+                        FROM plans
+                        RETURNING 1
                     )
-                    return True
-            except Exception as e:
-                log.exception(e)
-                raise HTTPException(e) from e
+                    SELECT count(*) FROM inserted;
+                    """,
+                    project_id,
+                    spacing["forward_spacing"],
+                    spacing["side_spacing"],
+                    spacing["ground_speed"],
+                )
+    except HTTPException:
+        raise
     except Exception as e:
         log.exception(e)
-        raise HTTPException(e) from e
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Failed to create tasks: {e}",
+        ) from e
+
+    log.debug(f"Created {task_count} database tasks | Project ID {project_id}")
+    return task_count
+
+
+def parse_aoi(project_geojson: bytes):
+    """Parse the first geometry of an uploaded AOI."""
+    boundary = geojson.loads(project_geojson)
+    return shape(boundary["features"][0]["geometry"])
+
+
+def index_no_fly_zones(no_fly_zones_geojson: bytes) -> STRtree:
+    """Parse a GeoJSON no-fly zones layer into an STRtree of its geometries."""
+    collection = shapely.from_geojson(no_fly_zones_geojson)
+    return STRtree(shapely.get_parts(collection))
+
+
+def uploaded_no_fly_union(
+    no_fly_zones_geojson: bytes, layer_hash: str, aoi, aoi_hash: str
+):
+    """Union the no-fly zones of an uploaded layer which intersect the AOI.
+
+    The indexed layer and the union are cached, keyed on the layer hash.
+
+    Returns:
+        The union of the intersecting zones, empty if there are none.
+    """
+    tree = no_fly_cache.get((layer_hash, "index"))
+    if tree is None:
+        tree = index_no_fly_zones(no_fly_zones_geojson)
+        no_fly_cache.set((layer_hash, "index"), tree)
+
+    union = no_fly_cache.get((layer_hash, aoi_hash))
+    if union is None:
+        hits = tree.query(aoi, predicate="intersects")
+        log.debug(f"{len(hits)} of {len(tree)} no-fly zones intersect the AOI")
+        union = shapely.union_all(tree.geometries.take(hits))
+        no_fly_cache.set((layer_hash, aoi_hash), union)
+    return union
+
+
+async def no_fly_zones_version(db: Database, project_id: uuid.UUID) -> str:
+    """Return the version of the stored no-fly zones of a project.
+
+    Zones are only ever replaced all together, with new serial ids, so the
+    zone count and highest id change with every replacement, by any worker.
+    Caches of the zones are keyed on this version rather than invalidated.
+    """
+    query = """
+        SELECT count(*) AS zone_count, max(id) AS last_id
+        FROM no_fly_zones
+        WHERE project_id = :project_id;
+    """
+    result = await db.fetch_one(query, {"project_id": project_id})
+    return f"{result['zone_count']}:{result['last_id']}"
+
+
+async def project_no_fly_union(
+    db: Database, project_id: uuid.UUID, version: str, aoi, aoi_hash: str
+):
+    """Union the stored no-fly zones of a project which intersect the AOI.
+
+    Zones are filtered with their spatial index, and the union is cached
+    on the version of the zones, see `no_fly_zones_version`.
+
+    Returns:
+        The union of the intersecting zones, empty if there are none.
+    """
+    union = no_fly_cache.get((project_id, version, aoi_hash))
+    if union is None:
+        query = """
+            SELECT ST_AsBinary(ST_Union(outline)) AS outline
+            FROM no_fly_zones
+            WHERE project_id = :project_id
+            AND ST_Intersects(outline, ST_GeomFromText(:aoi, 4326));
+        """
+        result = await db.fetch_one(
+            query,
+            {"project_id": project_id, "aoi": shapely.force_2d(aoi).wkt},
+        )
+        outline = result["outline"] if result else None
+        union = shapely.from_wkb(outline) if outline else GeometryCollection()
+        no_fly_cache.set((project_id, version, aoi_hash), union)
+    return union
+
+
+def subtract_no_fly_zones(aoi, no_fly_zones=None):
+    """Remove no-fly zones from an AOI.
+
+    Returns:
+        Polygon: The AOI, merged into a single polygon.
+    """
+    if no_fly_zones is not None and not no_fly_zones.is_empty:
+        aoi = aoi.difference(no_fly_zones)
+
+    merged = merge_multipolygon(geojson.Feature(geometry=mapping(aoi)))
+    return shape(merged["features"][0]["geometry"])
+
+
+async def replace_project_no_fly_zones(
+    db: Database, project_id: uuid.UUID, no_fly_zones_geojson: bytes
+) -> int:
+    """Replace the stored no-fly zones of a project with an uploaded layer.
 
+    The GeoJSON is parsed by PostGIS, in a single transaction.
 
-async def preview_split_by_square(boundary: str, meters: int):
-    """Preview split by square for a project boundary.
+    Returns:
+        int: The number of no-fly zones stored.
+    """
+    async with db.transaction():
+        await db.execute(
+            "DELETE FROM no_fly_zones WHERE project_id = :project_id;",
+            {"project_id": project_id},
+        )
+        query = """
+            WITH inserted AS (
+                INSERT INTO no_fly_zones (project_id, outline, created_at)
+                SELECT
+                    :project_id,
+                    ST_Multi(
+                        ST_Force2D(
+                            ST_SetSRID(
+                                ST_GeomFromGeoJSON(feature->'geometry'), 4326
+                            )
+                        )
+                    ),
+                    CURRENT_TIMESTAMP
+                FROM jsonb_array_elements(CAST(:layer AS jsonb)->'features') AS feature
+                WHERE feature->'geometry'->>'type' IN ('Polygon', 'MultiPolygon')
+                RETURNING 1
+            )
+            SELECT count(*) FROM inserted;
+        """
+        zone_count = await db.fetch_val(
+            query,
+            {"project_id": project_id, "layer": no_fly_zones_geojson.decode()},
+        )
+
+    # Entries of other workers are keyed on the previous version, and aged out
+    no_fly_cache.invalidate(project_id)
+    split_preview_cache.invalidate(project_id)
+    return zone_count
+
+
+def square_grid(aoi, meters: int) -> tuple[np.ndarray, np.ndarray, float]:
+    """Return the cell origins of a square grid over the AOI bounds.
+
+    The grid is computed as by fmtm_splitter.split_by_square, so it is the
+    same for an AOI with the same coordinates, see `split_by_square`.
+    """
+    xmin, ymin, xmax, ymax = aoi.bounds
+    # 1 meter is this factor in degrees
+    size = float(meters) * 0.0000114
+    xs = np.arange(xmin, xmax + size, size)[:-1]
+    ys = np.arange(ymin, ymax + size, size)[:-1]
+    return xs, ys, size
 
-    Use a lambda function to remove the "z" dimension from each
-    coordinate in the feature's geometry.
+
+def round_coordinates(coords: np.ndarray) -> np.ndarray:
+    """Round coordinates to 6 decimals, with the exact rounding of round()."""
+    rounded = [round(value, 6) for value in coords.ravel().tolist()]
+    return np.array(rounded).reshape(coords.shape)
+
+
+def split_columns_by_square(aoi, meters: int, columns: range) -> list[str]:
+    """Clip a band of grid columns to the AOI.
+
+    Cells are ordered column by column, as in fmtm_splitter, and their
+    coordinates are rounded to 6 decimals, as by the geojson library.
+
+    Returns:
+        list[str]: GeoJSON geometries of the non empty cells.
     """
-    boundary = merge_multipolygon(boundary)
+    xs, ys, size = square_grid(aoi, meters)
+    x, y = (
+        grid.ravel()
+        for grid in np.meshgrid(xs[columns.start : columns.stop], ys, indexing="ij")
+    )
+
+    # Cells are built as fmtm_splitter does, counter clockwise from the lower
+    # left corner. Cells inside the AOI need no intersection, and are written
+    # as the overlay would output them, clockwise from the upper left corner.
+    ring_x = np.stack([x, x + size, x + size, x, x], axis=-1)
+    ring_y = np.stack([y, y, y + size, y + size, y], axis=-1)
+    cells = shapely.polygons(np.stack([ring_x, ring_y], axis=-1))
+
+    shapely.prepare(aoi)
+    hits = shapely.intersects(aoi, cells)
+    inside = hits & shapely.contains_properly(aoi, cells)
+    edge = hits & ~inside
+
+    clipped = np.empty(len(cells), dtype=object)
+    clockwise = [3, 2, 1, 0, 3]
+    clipped[inside] = shapely.polygons(
+        np.stack([ring_x[inside][:, clockwise], ring_y[inside][:, clockwise]], axis=-1)
+    )
+    clipped[edge] = shapely.intersection(cells[edge], aoi)
+    clipped = clipped[hits]
+    clipped = clipped[~shapely.is_empty(clipped)]
+    clipped = shapely.transform(clipped, round_coordinates)
+
+    return shapely.to_geojson(clipped).tolist()
+
 
-    return await run_in_threadpool(
-        lambda: split_by_square(
-            boundary,
-            meters=meters,
+async def split_by_square(aoi, meters: int) -> bytes:
+    """Split an AOI into a grid of squares, clipped to the AOI.
+
+    Produces the same output as fmtm_splitter.split_by_square, once the
+    AOI coordinates are rounded to 6 decimals as the geojson library does
+    when parsing the AOI for fmtm_splitter. Large grids are split in bands
+    of columns across the process pool.
+
+    Returns:
+        bytes: A GeoJSON FeatureCollection of the task boundaries.
+    """
+    # Both the grid and the clipped cells depend on the exact AOI vertices
+    aoi = shapely.transform(aoi, round_coordinates)
+    xs, ys, _ = square_grid(aoi, meters)
+    cols, rows = len(xs), len(ys)
+
+    band_cols = max(settings.SPLIT_BAND_CELLS // max(rows, 1), 1)
+    bands = [
+        range(start, min(start + band_cols, cols))
+        for start in range(0, cols, band_cols)
+    ]
+    log.debug(f"Splitting AOI into a {cols}x{rows} grid, in {len(bands)} bands")
+
+    if len(bands) == 1:
+        geometries = await run_in_threadpool(
+            split_columns_by_square, aoi, meters, bands[0]
+        )
+    else:
+        results = await asyncio.gather(
+            *[
+                process_pool.run(split_columns_by_square, aoi, meters, band)
+                for band in bands
+            ]
         )
+        geometries = [geometry for result in results for geometry in result]
+
+    if not geometries:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Failed to generate split features.",
+        )
+
+    # Stitch the GeoJSON of each cell, rather than parsing it again
+    features = ", ".join(
+        f'{{"type": "Feature", "geometry": {geometry}, "properties": {{}}}}'
+        for geometry in geometries
     )
+    return f'{{"type": "FeatureCollection", "features": [{features}]}}'.encode()
+
+
+async def preview_split_by_square(
+    db: Database,
+    project_geojson: bytes,
+    no_fly_zones_geojson: Optional[bytes],
+    meters: int,
+    project_id: Optional[uuid.UUID] = None,
+) -> bytes:
+    """Preview split by square for a project boundary, minus no-fly zones.
+
+    The no-fly zones are either uploaded, or stored for the given project.
+    Previews are cached on the uploaded files, or the version of the stored
+    zones, and the square size, as the same AOI is previewed repeatedly
+    while choosing a task size.
+
+    Returns:
+        bytes: The GeoJSON FeatureCollection of the task boundaries.
+    """
+    aoi_hash = hashlib.sha256(project_geojson).hexdigest()
+    layer_hash = (
+        hashlib.sha256(no_fly_zones_geojson).hexdigest()
+        if no_fly_zones_geojson
+        else None
+    )
+    zones_version = (
+        await no_fly_zones_version(db, project_id)
+        if project_id and not layer_hash
+        else None
+    )
+    cache_key = (project_id, aoi_hash, layer_hash, zones_version, meters)
+    if (cached := split_preview_cache.get(cache_key)) is not None:
+        return cached
+
+    aoi = await run_in_threadpool(parse_aoi, project_geojson)
+    no_fly_zones = None
+    if no_fly_zones_geojson:
+        no_fly_zones = await run_in_threadpool(
+            uploaded_no_fly_union, no_fly_zones_geojson, layer_hash, aoi, aoi_hash
+        )
+    elif project_id:
+        no_fly_zones = await project_no_fly_union(
+            db, project_id, zones_version, aoi, aoi_hash
+        )
+
+    aoi = await run_in_threadpool(subtract_no_fly_zones, aoi, no_fly_zones)
+    result = await split_by_square(aoi, meters)
+
+    split_preview_cache.set(cache_key, result)
+    return result
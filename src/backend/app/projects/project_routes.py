@@ -1,23 +1,28 @@
 import os
 import json
 import uuid
+from typing import Optional
 from app.users.user_deps import login_required
 from app.users.user_schemas import AuthUser
-import geojson
 from datetime import timedelta
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from loguru import logger as log
 from app.projects import project_schemas, project_crud
+from app.waypoints import waypoint_crud
+from app.images import image_crud
+from app.images.image_ingest import image_ingestor
 from app.db import database
 from app.models.enums import HTTPStatus
-from app.utils import multipolygon_to_polygon
-from app.s3 import s3_client
+from app.utils import RawJSONResponse, multipolygon_to_polygon
+from app.s3 import async_s3, s3_presigner
 from app.config import settings
 from databases import Database
-from shapely.geometry import shape, mapping
-from shapely.ops import unary_union
 
 
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
 router = APIRouter(
     prefix=f"{settings.API_PREFIX}/projects",
     responses={404: {"description": "Not found"}},
@@ -52,6 +57,10 @@ async def delete_project_by_id(
             DELETE FROM tasks
             WHERE project_id = :project_id
             RETURNING id
+        ), deleted_no_fly_zones AS (
+            DELETE FROM no_fly_zones
+            WHERE project_id = :project_id
+            RETURNING id
         ), deleted_task_events AS (
             DELETE FROM task_events
             WHERE project_id = :project_id
@@ -65,6 +74,10 @@ async def delete_project_by_id(
     if not result:
         raise HTTPException(status_code=404)
 
+    waypoint_crud.flightplan_cache.invalidate(project_id)
+    project_crud.no_fly_cache.invalidate(project_id)
+    project_crud.split_preview_cache.invalidate(project_id)
+
     return {"message": f"Project ID: {project_id} is deleted successfully."}
 
 
@@ -113,7 +126,7 @@ async def upload_project_task_boundaries(
         dict: JSON containing success message, project ID, and number of tasks.
     """
     # check the project in Database
-    raw_sql = f"""SELECT id FROM projects WHERE id = '{project_id}' LIMIT 1;"""
+    raw_sql = f"""SELECT id, dem_url FROM projects WHERE id = '{project_id}' LIMIT 1;"""
     project = await db.fetch_one(query=raw_sql)
     if not project:
         raise HTTPException(
@@ -125,9 +138,24 @@ async def upload_project_task_boundaries(
     task_boundaries = multipolygon_to_polygon(task_boundaries)
 
     log.debug("Creating tasks for each polygon in project")
-    await project_crud.create_tasks_from_geojson(db, project_id, task_boundaries)
+    task_count = await project_crud.create_tasks_from_geojson(
+        db, project_id, task_boundaries
+    )
+    if project.dem_url:
+        log.debug("Computing task elevations from project DEM")
+        try:
+            await project_crud.update_task_elevation_stats(db, project_id)
+        except Exception as e:
+            # The tasks are saved, their elevations are only informative
+            log.exception(
+                f"Failed to compute task elevations of project {project_id}: {e}"
+            )
 
-    return {"message": "Project Boundary Uploaded", "project_id": f"{project_id}"}
+    return {
+        "message": "Project Boundary Uploaded",
+        "project_id": f"{project_id}",
+        "task_count": task_count,
+    }
 
 
 @router.post("/preview-split-by-square/", tags=["Projects"])
@@ -135,9 +163,14 @@ async def preview_split_by_square(
     project_geojson: UploadFile = File(...),
     no_fly_zones: UploadFile = File(default=None),
     dimension: int = Form(100),
+    project_id: Optional[uuid.UUID] = Form(None),
+    db: Database = Depends(database.get_db),
     user: AuthUser = Depends(login_required),
 ):
-    """Preview splitting by square."""
+    """Preview splitting by square.
+
+    No-fly zones are either uploaded, or those stored for `project_id`.
+    """
 
     # Validating for .geojson File.
     file_name = os.path.splitext(project_geojson.filename)
@@ -146,29 +179,67 @@ async def preview_split_by_square(
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="Provide a valid .geojson file")
 
-    # read entire file
+    if project_id:
+        project = await project_crud.get_project_by_id(db, project_id)
+        if not project:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="Project not found."
+            )
+        if user.id != project["author_id"]:
+            raise HTTPException(
+                status_code=HTTPStatus.FORBIDDEN,
+                detail="Only the project creator can preview its no-fly zones.",
+            )
+
     content = await project_geojson.read()
-    boundary = geojson.loads(content)
-    project_shape = shape(boundary["features"][0]["geometry"])
+    no_fly_content = await no_fly_zones.read() if no_fly_zones else None
 
-    # If no_fly_zones is provided, read and parse it
-    if no_fly_zones:
-        no_fly_content = await no_fly_zones.read()
-        no_fly_zones_geojson = geojson.loads(no_fly_content)
-        no_fly_shapes = [
-            shape(feature["geometry"]) for feature in no_fly_zones_geojson["features"]
-        ]
-        no_fly_union = unary_union(no_fly_shapes)
+    result = await project_crud.preview_split_by_square(
+        db, content, no_fly_content, dimension, project_id
+    )
+    return Response(content=result, media_type="application/json")
 
-        # Calculate the difference between the project shape and no-fly zones
-        new_outline = project_shape.difference(no_fly_union)
-    else:
-        new_outline = project_shape
-    result_geojson = geojson.Feature(geometry=mapping(new_outline))
 
-    result = await project_crud.preview_split_by_square(result_geojson, dimension)
+@router.post("/{project_id}/no-fly-zones", tags=["Projects"])
+async def upload_project_no_fly_zones(
+    project_id: uuid.UUID,
+    no_fly_zones: UploadFile = File(...),
+    db: Database = Depends(database.get_db),
+    user: AuthUser = Depends(login_required),
+):
+    """Store a no-fly zones layer for a project, replacing any previous one.
+
+    The layer is indexed spatially, so that large airspace datasets can be
+    reused across split previews of the project.
+
+    Required Parameters:
+        project_id (id): ID for associated project.
+        no_fly_zones (UploadFile): GeoJSON FeatureCollection of (Multi)Polygons.
+
+    Returns:
+        dict: JSON containing success message, project ID, and number of zones.
+    """
+    project = await project_crud.get_project_by_id(db, project_id)
+    if not project:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Project not found."
+        )
+    if user.id != project["author_id"]:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="Only the project creator can upload its no-fly zones.",
+        )
+
+    content = await no_fly_zones.read()
+    zone_count = await project_crud.replace_project_no_fly_zones(
+        db, project_id, content
+    )
 
-    return result
+    return {
+        "message": "No-fly zones uploaded",
+        "project_id": f"{project_id}",
+        "zone_count": zone_count,
+    }
 
 
 @router.post("/generate-presigned-url/", tags=["Image Upload"])
@@ -185,27 +256,31 @@ async def generate_presigned_url(
 
         image_name: The name of the image you want to upload
         expiry : Expiry time in hours
+        compact: Stream the signatures as newline delimited JSON, see
+            project_crud.stream_presigned_image_uploads
 
     Returns:
 
-        str: The pre-signed URL to upload the image
+        The pre-signed URL to upload each image
     """
-    try:
-        # Generate a pre-signed URL for an object
-        client = s3_client()
-        urls = []
-        for image in data.image_name:
-            image_path = f"publicuploads/{data.project_id}/{data.task_id}/{image}"
-
-            url = client.get_presigned_url(
-                "PUT",
-                settings.S3_BUCKET_NAME,
-                image_path,
-                expires=timedelta(hours=data.expiry),
-            )
-            urls.append({"image_name": image, "url": url})
+    expires = timedelta(hours=data.expiry)
+    if data.compact:
+        return StreamingResponse(
+            project_crud.stream_presigned_image_uploads(
+                data.project_id, data.task_id, data.image_name, expires
+            ),
+            media_type="application/x-ndjson",
+        )
 
-        return urls
+    try:
+        # Signed in bulk, off the event loop
+        return await run_in_threadpool(
+            project_crud.presign_image_uploads,
+            data.project_id,
+            data.task_id,
+            data.image_name,
+            expires,
+        )
     except Exception as e:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
@@ -213,15 +288,171 @@ async def generate_presigned_url(
         )
 
 
-@router.get("/", tags=["Projects"], response_model=list[project_schemas.ProjectOut])
+@router.post(
+    "/multipart-upload/",
+    tags=["Image Upload"],
+    response_model=project_schemas.MultipartUploadOut,
+)
+async def create_multipart_upload(
+    data: project_schemas.MultipartUploadRequest,
+    user: AuthUser = Depends(login_required),
+):
+    """
+    Start a multipart upload of a large image or video to S3 Bucket.
+
+    Each part is uploaded with a PUT to its pre-signed URL; the ETag header
+    of each response is then sent to complete the upload. Parts are at least
+    5 MiB, except the last.
+
+    Args:
+
+        image_name: The name of the file you want to upload
+        part_count: The number of parts of the upload
+        expiry : Expiry time in hours
+
+    Returns:
+
+        The id of the upload, and the pre-signed URL of each part
+    """
+    s3_path = project_crud.image_upload_path(
+        data.project_id, data.task_id, data.image_name
+    )
+    try:
+        upload_id = await async_s3.create_multipart_upload(
+            settings.S3_BUCKET_NAME, s3_path, data.content_type
+        )
+        objects = (
+            (s3_path, {"partNumber": str(number), "uploadId": upload_id})
+            for number in range(1, data.part_count + 1)
+        )
+        signed = await run_in_threadpool(
+            lambda: [
+                url
+                for _, url in s3_presigner().presign(
+                    "PUT",
+                    settings.S3_BUCKET_NAME,
+                    objects,
+                    timedelta(hours=data.expiry),
+                )
+            ]
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Failed to start the multipart upload. {e}",
+        )
+    return {"image_name": data.image_name, "upload_id": upload_id, "urls": signed}
+
+
+@router.post("/multipart-upload/complete/", tags=["Image Upload"])
+async def complete_multipart_upload(
+    data: project_schemas.CompleteMultipartUploadRequest,
+    db: Database = Depends(database.get_db),
+    user: AuthUser = Depends(login_required),
+):
+    """Assemble the uploaded parts of a multipart upload into the file.
+
+    Images are then ingested, reading their position from their header.
+    """
+    s3_path = project_crud.image_upload_path(
+        data.project_id, data.task_id, data.image_name
+    )
+    try:
+        etag = await async_s3.complete_multipart_upload(
+            settings.S3_BUCKET_NAME,
+            s3_path,
+            data.upload_id,
+            [(part.part_number, part.etag) for part in data.parts],
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Failed to complete the multipart upload. {e}",
+        )
+
+    if await image_crud.enqueue_images(db, [(s3_path, etag, None)]):
+        image_ingestor.wake()
+    return {"image_name": data.image_name}
+
+
+@router.post("/multipart-upload/abort/", tags=["Image Upload"])
+async def abort_multipart_upload(
+    data: project_schemas.AbortMultipartUploadRequest,
+    user: AuthUser = Depends(login_required),
+):
+    """Abort a multipart upload, deleting the parts uploaded so far."""
+    s3_path = project_crud.image_upload_path(
+        data.project_id, data.task_id, data.image_name
+    )
+    try:
+        await async_s3.abort_multipart_upload(
+            settings.S3_BUCKET_NAME, s3_path, data.upload_id
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Failed to abort the multipart upload. {e}",
+        )
+    return {"image_name": data.image_name}
+
+
+@router.get("/tiles/{z}/{x}/{y}.mvt", tags=["Projects"])
+async def read_projects_tile(
+    z: int,
+    x: int,
+    y: int,
+    db: Database = Depends(database.get_db),
+    user_data: AuthUser = Depends(login_required),
+):
+    """Return a Mapbox vector tile of the project outlines."""
+    tile = await project_crud.get_projects_tile(db, z, x, y)
+    return Response(
+        content=tile,
+        media_type=MVT_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.get("/{project_id}/tiles/{z}/{x}/{y}.mvt", tags=["Projects"])
+async def read_project_tasks_tile(
+    project_id: uuid.UUID,
+    z: int,
+    x: int,
+    y: int,
+    db: Database = Depends(database.get_db),
+    user_data: AuthUser = Depends(login_required),
+):
+    """Return a Mapbox vector tile of a project's tasks.
+
+    Each task has its current state as a property, and cached tiles are
+    dropped as soon as a task of the project changes state.
+    """
+    tile = await project_crud.get_tasks_tile(db, project_id, z, x, y)
+    return Response(
+        content=tile,
+        media_type=MVT_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.get("/", tags=["Projects"], response_model=list[project_schemas.ProjectListOut])
 async def read_projects(
-    skip: int = 0,
+    response: Response,
     limit: int = 100,
+    cursor: Optional[str] = None,
+    skip: int = 0,
     db: Database = Depends(database.get_db),
     user_data: AuthUser = Depends(login_required),
 ):
-    "Return all projects"
-    projects = await project_crud.get_projects(db, skip, limit)
+    """Return a page of projects, newest first.
+
+    The cursor of the next page is returned in the `X-Next-Cursor` header,
+    absent on the last page. `skip` is kept for older clients, and ignored
+    when a cursor is given.
+    """
+    projects, next_cursor = await project_crud.get_projects(db, limit, cursor, skip)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return projects
 
 
@@ -233,8 +464,11 @@ async def read_project(
     db: Database = Depends(database.get_db),
     user_data: AuthUser = Depends(login_required),
 ):
-    """Get a specific project and all associated tasks by ID."""
-    project = await project_crud.get_project_info_by_id(db, project_id)
+    """Get a specific project and all associated tasks by ID.
+
+    The response is built as JSON by PostGIS and passed through untouched.
+    """
+    project = await project_crud.get_project_info_json(db, project_id)
     if project is None:
         raise HTTPException(status_code=404, detail="Project not found")
-    return project
+    return RawJSONResponse(project)
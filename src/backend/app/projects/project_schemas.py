@@ -98,6 +98,9 @@ class TaskOut(BaseModel):
     outline: Any = Field(exclude=True)
     state: Optional[State] = None
     contributor: Optional[str] = None
+    min_elevation: Optional[float] = None
+    max_elevation: Optional[float] = None
+    mean_elevation: Optional[float] = None
 
     @validator("state", pre=True, always=True)
     def validate_state(cls, v):
@@ -144,8 +147,79 @@ class ProjectOut(BaseModel):
         return str_to_geojson(self.outline, {"id": self.id, "bbox": bbox}, str(self.id))
 
 
+class ProjectListOut(BaseModel):
+    """Project in the projects listing, without its full geometry."""
+
+    id: uuid.UUID
+    slug: Optional[str] = None
+    name: str
+    description: str
+    per_task_instructions: Optional[str] = None
+    centroid: Optional[list[float]] = None
+    bbox: Optional[list[float]] = None
+    outline: Any = Field(exclude=True)
+    task_states: dict[str, int] = {}
+
+    @validator("task_states", pre=True, always=True)
+    def validate_task_states(cls, v):
+        if isinstance(v, str):
+            return json.loads(v)
+        return v or {}
+
+    @computed_field
+    @property
+    def outline_geojson(self) -> Optional[dict]:
+        """Feature of the simplified outline, selected as GeoJSON."""
+        if not self.outline:
+            return None
+        return {
+            "type": "Feature",
+            "id": str(self.id),
+            "geometry": json.loads(self.outline),
+            "properties": {"id": str(self.id), "bbox": self.bbox},
+        }
+
+
 class PresignedUrlRequest(BaseModel):
     project_id: uuid.UUID
     task_id: uuid.UUID
     image_name: List[str]
-    expiry: int  # Expiry time in hours
+    expiry: int = Field(ge=1, le=168)  # Expiry time in hours
+    # Stream the signatures as NDJSON, rather than a list of URLs
+    compact: bool = False
+
+
+class MultipartUploadRequest(BaseModel):
+    project_id: uuid.UUID
+    task_id: uuid.UUID
+    image_name: str
+    part_count: int = Field(ge=1, le=10000)
+    content_type: str = "application/octet-stream"
+    expiry: int = Field(ge=1, le=168)  # Expiry time in hours
+
+
+class MultipartUploadOut(BaseModel):
+    image_name: str
+    upload_id: str
+    # URL of part number i + 1 at index i
+    urls: List[str]
+
+
+class UploadedPart(BaseModel):
+    part_number: int = Field(ge=1, le=10000)
+    etag: str
+
+
+class CompleteMultipartUploadRequest(BaseModel):
+    project_id: uuid.UUID
+    task_id: uuid.UUID
+    image_name: str
+    upload_id: str
+    parts: List[UploadedPart] = Field(min_length=1)
+
+
+class AbortMultipartUploadRequest(BaseModel):
+    project_id: uuid.UUID
+    task_id: uuid.UUID
+    image_name: str
+    upload_id: str
@@ -1,19 +1,107 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from itertools import islice
 from app.config import settings
 from loguru import logger as log
 from minio import Minio
+from minio.commonconfig import Tags
+from minio.datatypes import Part
+from minio.error import S3Error
+from minio.helpers import queryencode, quote
 from io import BytesIO
-from typing import Any
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+)
+import certifi
+import urllib3
 
 
-def s3_client():
-    """Return the initialised S3 client with credentials."""
+class S3Metrics:
+    """Latency of S3 operations, per operation, across every thread."""
+
+    def __init__(self):
+        self.operations: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, operation: str):
+        """Record the duration of the enclosed S3 operation, and if it failed."""
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record(operation, time.perf_counter() - started, failed)
+
+    def record(self, operation: str, seconds: float, failed: bool = False):
+        with self._lock:
+            metrics = self.operations.setdefault(
+                operation,
+                {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            )
+            metrics["count"] += 1
+            metrics["errors"] += int(failed)
+            metrics["total_seconds"] += seconds
+            metrics["max_seconds"] = max(metrics["max_seconds"], seconds)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Return the count, errors, and total, mean and max seconds per operation."""
+        with self._lock:
+            return {
+                operation: {
+                    **metrics,
+                    "mean_seconds": metrics["total_seconds"] / metrics["count"],
+                }
+                for operation, metrics in self.operations.items()
+            }
+
+
+s3_metrics = S3Metrics()
+
+
+@lru_cache
+def s3_client() -> Minio:
+    """Return the S3 client shared by the process, with its connection pool.
+
+    Minio clients are thread safe, so a single client, and a single pool of
+    connections to the S3 server, serves every request and worker thread.
+    """
     minio_url, is_secure = is_connection_secure(settings.S3_ENDPOINT)
     log.debug("Connecting to Minio S3 server")
+    http_client = urllib3.PoolManager(
+        maxsize=settings.S3_POOL_MAXSIZE,
+        timeout=urllib3.Timeout(
+            connect=settings.S3_CONNECT_TIMEOUT, read=settings.S3_READ_TIMEOUT
+        ),
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+        ),
+    )
     return Minio(
         minio_url,
         settings.S3_ACCESS_KEY,
         settings.S3_SECRET_KEY,
         secure=is_secure,
+        http_client=http_client,
     )
 
 
@@ -30,8 +118,7 @@ def is_connection_secure(minio_url: str):
 
     else:
         err = (
-            "The S3_ENDPOINT is set incorrectly. "
-            "It must start with http:// or https://"
+            "The S3_ENDPOINT is set incorrectly. It must start with http:// or https://"
         )
         log.error(err)
         raise ValueError(err)
@@ -39,20 +126,94 @@ def is_connection_secure(minio_url: str):
     return stripped_url, secure
 
 
-def add_file_to_bucket(bucket_name: str, file_path: str, s3_path: str):
+class HashingReader:
+    """File-like wrapper computing the sha256 of the data read through it."""
+
+    def __init__(self, file_obj: BinaryIO):
+        self.file_obj = file_obj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file_obj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+def stream_to_bucket(
+    bucket_name: str,
+    file_obj: BinaryIO,
+    s3_path: str,
+    content_type: str = "application/octet-stream",
+) -> str:
+    """Upload a stream of unknown length to an S3 bucket, by multipart upload.
+
+    The stream is read one part of settings.S3_PART_SIZE at a time, so memory
+    use is bounded by the part size whatever the size of the object. Its
+    sha256 is computed as it is read, and tagged on the object.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        file_obj (BinaryIO): A readable binary file, e.g. an open file or
+            the file of an upload.
+        s3_path (str): The path in the S3 bucket where the data will be stored.
+        content_type (str, optional): The content type of the uploaded file.
+            Default application/octet-stream.
+
+    Returns:
+        str: The sha256 hex digest of the uploaded data.
+    """
+    # Strip "/" from start of s3_path (not required by put_object)
+    if s3_path.startswith("/"):
+        s3_path = s3_path.lstrip("/")
+
+    client = s3_client()
+    reader = HashingReader(file_obj)
+    with s3_metrics.timed("multipart_upload"):
+        result = client.put_object(
+            bucket_name,
+            s3_path,
+            reader,
+            length=-1,
+            content_type=content_type,
+            part_size=settings.S3_PART_SIZE,
+            # Parts are read from the stream in order
+            num_parallel_uploads=1,
+        )
+    checksum = reader.sha256.hexdigest()
+    tags = Tags.new_object_tags()
+    tags["sha256"] = checksum
+    client.set_object_tags(bucket_name, s3_path, tags)
+    log.debug(
+        f"Created {result.object_name} object; {reader.size} bytes, "
+        f"etag: {result.etag}, sha256: {checksum}"
+    )
+    return checksum
+
+
+def add_file_to_bucket(
+    bucket_name: str,
+    file_path: str,
+    s3_path: str,
+    content_type: str = "application/octet-stream",
+) -> str:
     """Upload a file from the filesystem to an S3 bucket.
 
+    Large files are uploaded in parts, without being read into memory.
+
     Args:
         bucket_name (str): The name of the S3 bucket.
         file_path (str): The path to the file on the local filesystem.
         s3_path (str): The path in the S3 bucket where the file will be stored.
-    """
-    # Ensure s3_path starts with a forward slash
-    if not s3_path.startswith("/"):
-        s3_path = f"/{s3_path}"
+        content_type (str, optional): The content type of the uploaded file.
+            Default application/octet-stream.
 
-    client = s3_client()
-    client.fput_object(bucket_name, file_path, s3_path)
+    Returns:
+        str: The sha256 hex digest of the file.
+    """
+    with open(file_path, "rb") as file_obj:
+        return stream_to_bucket(bucket_name, file_obj, s3_path, content_type)
 
 
 def add_obj_to_bucket(
@@ -81,9 +242,10 @@ def add_obj_to_bucket(
     # Set BytesIO object to start, prior to .read()
     file_obj.seek(0)
 
-    result = client.put_object(
-        bucket_name, s3_path, file_obj, file_obj.getbuffer().nbytes, **kwargs
-    )
+    with s3_metrics.timed("put_object"):
+        result = client.put_object(
+            bucket_name, s3_path, file_obj, file_obj.getbuffer().nbytes, **kwargs
+        )
     log.debug(
         f"Created {result.object_name} object; etag: {result.etag}, "
         f"version-id: {result.version_id}"
@@ -104,7 +266,32 @@ def get_file_from_bucket(bucket_name: str, s3_path: str, file_path: str):
         s3_path = f"/{s3_path}"
 
     client = s3_client()
-    client.fget_object(bucket_name, s3_path, file_path)
+    with s3_metrics.timed("fget_object"):
+        client.fget_object(bucket_name, s3_path, file_path)
+
+
+def get_obj_etag(bucket_name: str, s3_path: str) -> Optional[str]:
+    """Return the ETag of an S3 object, or None if it does not exist.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        s3_path (str): The path to the S3 object in the bucket.
+
+    Returns:
+        str: The ETag of the object, changed whenever the object is replaced.
+    """
+    # Strip "/" from start of s3_path (not required by stat_object)
+    if s3_path.startswith("/"):
+        s3_path = s3_path.lstrip("/")
+
+    client = s3_client()
+    try:
+        with s3_metrics.timed("stat_object"):
+            return client.stat_object(bucket_name, s3_path).etag
+    except S3Error as e:
+        if e.code == "NoSuchKey":
+            return None
+        raise
 
 
 def get_obj_from_bucket(bucket_name: str, s3_path: str) -> BytesIO:
@@ -124,8 +311,9 @@ def get_obj_from_bucket(bucket_name: str, s3_path: str) -> BytesIO:
     client = s3_client()
     response = None
     try:
-        response = client.get_object(bucket_name, s3_path)
-        return BytesIO(response.read())
+        with s3_metrics.timed("get_object"):
+            response = client.get_object(bucket_name, s3_path)
+            return BytesIO(response.read())
     except Exception as e:
         log.warning(f"Failed attempted download from S3 path: {s3_path}")
         raise ValueError(str(e)) from e
@@ -133,3 +321,396 @@ def get_obj_from_bucket(bucket_name: str, s3_path: str) -> BytesIO:
         if response:
             response.close()
             response.release_conn()
+
+
+def get_obj_range(bucket_name: str, s3_path: str, offset: int, length: int) -> bytes:
+    """Download a byte range of an S3 object, by a range request.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        s3_path (str): The path to the S3 object in the bucket.
+        offset (int): The first byte of the range.
+        length (int): The length of the range, shorter at the end of the object.
+
+    Returns:
+        bytes: The content of the range.
+    """
+    s3_path = s3_path.lstrip("/")
+    client = s3_client()
+    response = None
+    try:
+        with s3_metrics.timed("get_object_range"):
+            response = client.get_object(
+                bucket_name, s3_path, offset=offset, length=length
+            )
+            return response.read()
+    finally:
+        if response:
+            response.close()
+            response.release_conn()
+
+
+def list_objs_in_bucket(
+    bucket_name: str, prefix: str, batch_size: int
+) -> Iterator[list[tuple[str, Optional[str], int]]]:
+    """List the objects under a prefix of an S3 bucket, recursively, in batches.
+
+    Pages of the listing are only requested as batches are consumed, so a
+    large prefix is never held in memory at once.
+
+    Yields:
+        list[tuple[str, Optional[str], int]]: The (path, ETag, size) of up to
+            `batch_size` objects.
+    """
+    objects = s3_client().list_objects(
+        bucket_name, prefix=prefix.lstrip("/"), recursive=True
+    )
+    while True:
+        with s3_metrics.timed("list_objects"):
+            batch = [
+                (obj.object_name, obj.etag, obj.size)
+                for obj in islice(objects, batch_size)
+            ]
+        if not batch:
+            return
+        yield batch
+
+
+class MinioInternals:
+    """The private Minio methods used by this module, kept in one place.
+
+    Minio has no public API to look up the region of a bucket, nor for
+    multipart uploads whose parts are uploaded by clients. The signatures of
+    these methods are the same across the versions allowed by pyproject.toml
+    (7.2.7 to 7.2.20 were checked); check them again before raising that
+    bound.
+    """
+
+    def __init__(self, client: Minio):
+        self.client = client
+
+    def region(self, bucket_name: str) -> str:
+        """Return the region of a bucket."""
+        return self.client._get_region(bucket_name)
+
+    def create_multipart_upload(
+        self, bucket_name: str, s3_path: str, headers: dict[str, str]
+    ) -> str:
+        """Start a multipart upload, returning its id."""
+        return self.client._create_multipart_upload(bucket_name, s3_path, headers)
+
+    def complete_multipart_upload(
+        self, bucket_name: str, s3_path: str, upload_id: str, parts: list[Part]
+    ):
+        """Assemble the parts of a multipart upload into the object."""
+        return self.client._complete_multipart_upload(
+            bucket_name, s3_path, upload_id, parts
+        )
+
+    def abort_multipart_upload(self, bucket_name: str, s3_path: str, upload_id: str):
+        """Abort a multipart upload, deleting its parts."""
+        self.client._abort_multipart_upload(bucket_name, s3_path, upload_id)
+
+
+def create_multipart_upload(
+    bucket_name: str, s3_path: str, content_type: str = "application/octet-stream"
+) -> str:
+    """Start a multipart upload, whose parts are uploaded by clients.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        s3_path (str): The path in the S3 bucket where the object will be stored.
+        content_type (str, optional): The content type of the object.
+            Default application/octet-stream.
+
+    Returns:
+        str: The id of the upload.
+    """
+    s3_path = s3_path.lstrip("/")
+    client = MinioInternals(s3_client())
+    with s3_metrics.timed("create_multipart_upload"):
+        return client.create_multipart_upload(
+            bucket_name, s3_path, {"Content-Type": content_type}
+        )
+
+
+def complete_multipart_upload(
+    bucket_name: str, s3_path: str, upload_id: str, parts: list[tuple[int, str]]
+):
+    """Assemble the uploaded parts of a multipart upload into the object.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        s3_path (str): The path of the object in the S3 bucket.
+        upload_id (str): The id of the upload.
+        parts (list[tuple[int, str]]): The (part number, ETag) of every part.
+
+    Returns:
+        str: The ETag of the object.
+    """
+    s3_path = s3_path.lstrip("/")
+    client = MinioInternals(s3_client())
+    with s3_metrics.timed("complete_multipart_upload"):
+        result = client.complete_multipart_upload(
+            bucket_name,
+            s3_path,
+            upload_id,
+            [Part(number, etag) for number, etag in sorted(parts)],
+        )
+    log.debug(f"Created {result.object_name} object; etag: {result.etag}")
+    return result.etag
+
+
+def abort_multipart_upload(bucket_name: str, s3_path: str, upload_id: str):
+    """Abort a multipart upload, deleting the parts uploaded so far."""
+    s3_path = s3_path.lstrip("/")
+    client = MinioInternals(s3_client())
+    with s3_metrics.timed("abort_multipart_upload"):
+        client.abort_multipart_upload(bucket_name, s3_path, upload_id)
+
+
+class S3Presigner:
+    """Sign S3 URLs in bulk, with SigV4 query string authentication.
+
+    Produces the same URLs as Minio.get_presigned_url, without its per URL
+    overhead: the region is looked up once per bucket, and the signing key is
+    derived once per day and region, so each URL costs one hash and one HMAC.
+    URLs are path style, as used by Minio for S3 compatible servers.
+    """
+
+    def __init__(self, endpoint: str, access_key: str, secret_key: str):
+        host, secure = is_connection_secure(endpoint)
+        self.host = host.rstrip("/")
+        self.base_url = f"{'https' if secure else 'http'}://{self.host}"
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self._regions: dict[str, str] = {}
+        self._signing_keys: dict[tuple[str, str], bytes] = {}
+        self._lock = threading.Lock()
+
+    def region(self, bucket_name: str) -> str:
+        """Return the region of a bucket, looked up once."""
+        if bucket_name not in self._regions:
+            self._regions[bucket_name] = MinioInternals(s3_client()).region(bucket_name)
+        return self._regions[bucket_name]
+
+    def signing_key(self, datestamp: str, region: str) -> bytes:
+        """Return the signing key of a day and region, derived once."""
+        key = self._signing_keys.get((datestamp, region))
+        if key is None:
+            key = ("AWS4" + self.secret_key).encode()
+            for message in (datestamp, region, "s3", "aws4_request"):
+                key = hmac.new(key, message.encode(), hashlib.sha256).digest()
+            with self._lock:
+                # Only today's keys are used
+                self._signing_keys = {
+                    k: v for k, v in self._signing_keys.items() if k[0] == datestamp
+                }
+                self._signing_keys[(datestamp, region)] = key
+        return key
+
+    def sign(
+        self,
+        method: str,
+        bucket_name: str,
+        objects: Iterable[tuple[str, Optional[dict[str, str]]]],
+        expires: timedelta,
+        request_date: Optional[datetime] = None,
+    ) -> Iterator[tuple[str, str, str, str]]:
+        """Sign requests for several objects, with the same method and expiry.
+
+        Args:
+            method (str): The HTTP method of the URLs, e.g. PUT.
+            bucket_name (str): The name of the S3 bucket.
+            objects (Iterable[tuple[str, Optional[dict[str, str]]]]): The
+                (object name, extra query parameters) of each URL.
+            expires (timedelta): The validity of the URLs, up to 7 days.
+            request_date (datetime, optional): The signing time, default now.
+
+        Yields:
+            tuple[str, str, str, str]: The (object name, path, query,
+                signature) of each object. Its presigned URL is
+                `{base_url}{path}?{query}&X-Amz-Signature={signature}`.
+        """
+        seconds = int(expires.total_seconds())
+        if seconds < 1 or seconds > 604800:
+            raise ValueError("expires must be between 1 second to 7 days")
+
+        date = request_date or datetime.now(timezone.utc)
+        datestamp = date.strftime("%Y%m%d")
+        amz_date = date.strftime("%Y%m%dT%H%M%SZ")
+        region = self.region(bucket_name)
+        scope = f"{datestamp}/{region}/s3/aws4_request"
+        signing_key = self.signing_key(datestamp, region)
+
+        # Parameters shared by every URL, already encoded
+        common = [
+            ("X-Amz-Algorithm", "AWS4-HMAC-SHA256"),
+            ("X-Amz-Credential", queryencode(f"{self.access_key}/{scope}")),
+            ("X-Amz-Date", amz_date),
+            ("X-Amz-Expires", str(seconds)),
+            ("X-Amz-SignedHeaders", "host"),
+        ]
+        string_to_sign_prefix = f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+        canonical_suffix = f"host:{self.host}\n\nhost\nUNSIGNED-PAYLOAD"
+
+        for object_name, extra_query in objects:
+            path = f"/{bucket_name}/{quote(object_name)}"
+            params = [
+                (queryencode(k), queryencode(v)) for k, v in (extra_query or {}).items()
+            ]
+            params.extend(common)
+            query = "&".join(f"{k}={v}" for k, v in params)
+            canonical_query = "&".join(f"{k}={v}" for k, v in sorted(params))
+            canonical_request = (
+                f"{method}\n{path}\n{canonical_query}\n{canonical_suffix}"
+            )
+            signature = hmac.new(
+                signing_key,
+                (
+                    string_to_sign_prefix
+                    + hashlib.sha256(canonical_request.encode()).hexdigest()
+                ).encode(),
+                hashlib.sha256,
+            ).hexdigest()
+            yield object_name, path, query, signature
+
+    def presign(
+        self,
+        method: str,
+        bucket_name: str,
+        objects: Iterable[tuple[str, Optional[dict[str, str]]]],
+        expires: timedelta,
+        request_date: Optional[datetime] = None,
+    ) -> Iterator[tuple[str, str]]:
+        """Presign URLs of several objects, yielding (object name, URL) pairs.
+
+        See `sign` for the arguments.
+        """
+        for object_name, path, query, signature in self.sign(
+            method, bucket_name, objects, expires, request_date
+        ):
+            yield (
+                object_name,
+                f"{self.base_url}{path}?{query}&X-Amz-Signature={signature}",
+            )
+
+
+@lru_cache
+def s3_presigner() -> S3Presigner:
+    """Return the presigner shared by the process."""
+    return S3Presigner(
+        settings.S3_ENDPOINT, settings.S3_ACCESS_KEY, settings.S3_SECRET_KEY
+    )
+
+
+class AsyncS3:
+    """Run S3 operations from async code, on a bounded thread pool.
+
+    The S3 helpers above are blocking; running them on a dedicated pool keeps
+    them off the event loop, and bounds the number of concurrent transfers
+    independently of the threadpool shared by the rest of the app.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def shutdown(self):
+        """Stop the transfer threads, cancelling queued transfers."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func: Callable, *args: Any, **kwargs: Any):
+        """Run a blocking S3 call, `func(*args, **kwargs)`, on the pool."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="s3"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    async def add_file_to_bucket(self, *args: Any, **kwargs: Any):
+        """Async `add_file_to_bucket`."""
+        return await self.run(add_file_to_bucket, *args, **kwargs)
+
+    async def stream_to_bucket(self, *args: Any, **kwargs: Any) -> str:
+        """Async `stream_to_bucket`."""
+        return await self.run(stream_to_bucket, *args, **kwargs)
+
+    async def add_obj_to_bucket(self, *args: Any, **kwargs: Any):
+        """Async `add_obj_to_bucket`."""
+        return await self.run(add_obj_to_bucket, *args, **kwargs)
+
+    async def get_obj_range(self, *args: Any, **kwargs: Any) -> bytes:
+        """Async `get_obj_range`."""
+        return await self.run(get_obj_range, *args, **kwargs)
+
+    async def list_objs_in_bucket(
+        self, *args: Any, **kwargs: Any
+    ) -> AsyncIterator[list[tuple[str, Optional[str], int]]]:
+        """Async `list_objs_in_bucket`, each batch being listed on the pool."""
+        batches = list_objs_in_bucket(*args, **kwargs)
+        while (batch := await self.run(next, batches, None)) is not None:
+            yield batch
+
+    async def create_multipart_upload(self, *args: Any, **kwargs: Any) -> str:
+        """Async `create_multipart_upload`."""
+        return await self.run(create_multipart_upload, *args, **kwargs)
+
+    async def complete_multipart_upload(self, *args: Any, **kwargs: Any) -> str:
+        """Async `complete_multipart_upload`."""
+        return await self.run(complete_multipart_upload, *args, **kwargs)
+
+    async def abort_multipart_upload(self, *args: Any, **kwargs: Any):
+        """Async `abort_multipart_upload`."""
+        return await self.run(abort_multipart_upload, *args, **kwargs)
+
+    async def get_file_from_bucket(self, *args: Any, **kwargs: Any):
+        """Async `get_file_from_bucket`."""
+        return await self.run(get_file_from_bucket, *args, **kwargs)
+
+    async def get_obj_from_bucket(self, *args: Any, **kwargs: Any) -> BytesIO:
+        """Async `get_obj_from_bucket`."""
+        return await self.run(get_obj_from_bucket, *args, **kwargs)
+
+    async def get_obj_etag(self, *args: Any, **kwargs: Any) -> Optional[str]:
+        """Async `get_obj_etag`."""
+        return await self.run(get_obj_etag, *args, **kwargs)
+
+    async def get_objs_from_bucket(
+        self, bucket_name: str, s3_paths: list[str]
+    ) -> list[BytesIO]:
+        """Download several objects concurrently, in the order of `s3_paths`."""
+        return await asyncio.gather(
+            *(self.get_obj_from_bucket(bucket_name, path) for path in s3_paths)
+        )
+
+    async def get_files_from_bucket(
+        self, bucket_name: str, downloads: list[tuple[str, str]]
+    ):
+        """Download several objects concurrently, as (s3_path, file_path) pairs."""
+        await asyncio.gather(
+            *(
+                self.get_file_from_bucket(bucket_name, s3_path, file_path)
+                for s3_path, file_path in downloads
+            )
+        )
+
+    async def get_obj_etags(
+        self, bucket_name: str, s3_paths: list[str]
+    ) -> list[Optional[str]]:
+        """Get the ETags of several objects concurrently, None where missing."""
+        return await asyncio.gather(
+            *(self.get_obj_etag(bucket_name, path) for path in s3_paths)
+        )
+
+    def stats(self) -> dict[str, Any]:
+        """Return the pool size, and latency metrics per S3 operation."""
+        return {"workers": self.max_workers, "operations": s3_metrics.stats()}
+
+
+async_s3 = AsyncS3(settings.S3_MAX_WORKERS)
@@ -1,5 +1,6 @@
 import uuid
 import json
+from datetime import datetime
 from databases import Database
 from app.models.enums import HTTPStatus, State
 from fastapi import HTTPException
@@ -34,6 +35,17 @@ async def get_task_geojson(db: Database, task_id: uuid.UUID):
     return json.loads(data["geom"])
 
 
+async def get_project_tasks_geojson(db: Database, project_id: uuid.UUID):
+    """Get every task of a project, with its outline as a GeoJSON string."""
+    query = """
+        SELECT id, project_task_index, ST_AsGeoJSON(outline) AS outline
+        FROM tasks
+        WHERE project_id = :project_id
+        ORDER BY project_task_index;
+    """
+    return await db.fetch_all(query, {"project_id": str(project_id)})
+
+
 async def get_tasks_by_user(user_id: str, db: Database):
     try:
         query = """
@@ -41,7 +53,12 @@ async def get_tasks_by_user(user_id: str, db: Database):
                 SELECT
                     tasks.id AS task_id,
                     task_events.project_id AS project_id,
-                    ST_Area(ST_Transform(tasks.outline, 4326)) / 1000000 AS task_area,
+                    tasks.area_m2 / 1000000 AS task_area,
+                    tasks.perimeter_m,
+                    tasks.bbox,
+                    ARRAY[ST_X(tasks.centroid), ST_Y(tasks.centroid)] AS centroid,
+                    tasks.waypoint_count,
+                    tasks.flight_time_minutes,
                     task_events.created_at,
                     task_events.state
                 FROM
@@ -55,6 +72,11 @@ async def get_tasks_by_user(user_id: str, db: Database):
                 task_details.task_id,
                 task_details.project_id,
                 task_details.task_area,
+                task_details.perimeter_m,
+                task_details.bbox,
+                task_details.centroid,
+                task_details.waypoint_count,
+                task_details.flight_time_minutes,
                 task_details.created_at,
                 CASE
                     WHEN task_details.state = 'REQUEST_FOR_MAPPING' THEN 'request logs'
@@ -92,132 +114,306 @@ async def get_all_tasks(db: Database, project_id: uuid.UUID):
 
 
 async def all_tasks_states(db: Database, project_id: uuid.UUID):
+    """Get the current state of every task in a project.
+
+    Tasks without any event are unlocked for mapping.
+    """
     query = """
-        SELECT DISTINCT ON (task_id) project_id, task_id, state
-        FROM task_events
+        SELECT
+            tasks.project_id,
+            tasks.id AS task_id,
+            COALESCE(task_current_state.state::text, :unlocked_to_map_state) AS state
+        FROM tasks
+        LEFT JOIN task_current_state ON task_current_state.task_id = tasks.id
+        WHERE tasks.project_id = :project_id
+    """
+
+    records = await db.fetch_all(
+        query,
+        {
+            "project_id": str(project_id),
+            "unlocked_to_map_state": State.UNLOCKED_TO_MAP.name,
+        },
+    )
+    return [dict(record) for record in records]
+
+
+async def latest_task_state_change(db: Database, project_id: uuid.UUID):
+    """Get the time of the latest task state change in a project."""
+    query = """
+        SELECT max(created_at)
+        FROM task_current_state
         WHERE project_id = :project_id
-        ORDER BY task_id, created_at DESC
     """
+    return await db.fetch_val(query, {"project_id": str(project_id)})
 
-    r = await db.fetch_all(query, {"project_id": str(project_id)})
 
-    # Extract task_ids and corresponding states from the query result
-    existing_tasks = [dict(r) for r in r]
+async def task_states_since(db: Database, project_id: uuid.UUID, since: datetime):
+    """Get the tasks of a project whose state changed after the given time."""
+    query = """
+        SELECT project_id, task_id, user_id, state, created_at
+        FROM task_current_state
+        WHERE project_id = :project_id AND created_at > :since
+        ORDER BY created_at
+    """
+    records = await db.fetch_all(query, {"project_id": str(project_id), "since": since})
+    return [dict(record) for record in records]
 
-    # Get all task_ids from the tasks table
-    task_ids = await get_all_tasks(db, project_id)
 
-    # Create a set of existing task_ids for quick lookup
-    existing_task_ids = {task["task_id"] for task in existing_tasks}
+async def get_task_stats(db: Database, user_id: str):
+    """Count the tasks of the projects of an author, by current state.
 
-    # task ids that are not in task_events table
-    remaining_task_ids = [x for x in task_ids if x not in existing_task_ids]
+    Reads the per-project counters maintained by a trigger, so the cost does
+    not grow with the number of tasks or events.
+    """
+    query = """
+        SELECT
+            EXISTS (SELECT 1 FROM user_profile WHERE user_id = :user_id) AS has_profile,
+            COALESCE(SUM(c.task_count) FILTER (WHERE c.state = 'REQUEST_FOR_MAPPING'), 0) AS request_logs,
+            COALESCE(SUM(c.task_count) FILTER (WHERE c.state = 'LOCKED_FOR_MAPPING'), 0) AS ongoing_tasks,
+            COALESCE(SUM(c.task_count) FILTER (WHERE c.state = 'UNLOCKED_DONE'), 0) AS completed_tasks,
+            COALESCE(SUM(c.task_count) FILTER (WHERE c.state = 'UNFLYABLE_TASK'), 0) AS unflyable_tasks
+        FROM projects p
+        JOIN project_task_state_counts c ON c.project_id = p.id
+        WHERE p.author_id = :user_id;
+    """
+    return await db.fetch_one(query, {"user_id": user_id})
 
-    # Add missing tasks with state as "UNLOCKED_FOR_MAPPING"
-    remaining_tasks = [
-        {
-            "project_id": str(project_id),
-            "task_id": task_id,
-            "state": State.UNLOCKED_TO_MAP.name,
-        }
-        for task_id in remaining_task_ids
-    ]
 
-    # Combine both existing tasks and remaining tasks
-    combined_tasks = existing_tasks + remaining_tasks
+async def lock_task(db: Database, project_id: uuid.UUID, task_id: uuid.UUID):
+    """Lock a task until the end of the current transaction.
 
-    return combined_tasks
+    State transitions of a task are serialised by this lock, including its
+    first one, when it has no task_current_state row yet. The lock is taken
+    in its own statement, so that the state read by the next statement is
+    the one committed by the previous transition.
+    """
+    query = """
+        SELECT 1
+        FROM tasks
+        WHERE id = :task_id AND project_id = :project_id
+        FOR UPDATE;
+    """
+    await db.execute(query, {"project_id": str(project_id), "task_id": str(task_id)})
 
 
 async def request_mapping(
-    db: Database, project_id: uuid.UUID, task_id: uuid.UUID, user_id: str, comment: str
+    db: Database,
+    project_id: uuid.UUID,
+    task_id: uuid.UUID,
+    user_id: str,
+    user_email: str,
+    user_name: str,
 ):
+    """Request a task for mapping, in a single statement with the task locked.
+
+    The task is locked for the user straight away if the project does not
+    require approval; otherwise the request is recorded, and its email to the
+    requesting user is queued in the outbox within the same statement.
+
+    Args:
+        db (Database): The database connection.
+        project_id (uuid.UUID): The project of the task.
+        task_id (uuid.UUID): The task requested.
+        user_id (str): The requesting user.
+        user_email (str): The email address of the requesting user.
+        user_name (str): The name of the requesting user.
+
+    Returns:
+        Record: The state of the task after the request, None if the task
+            could not be requested, and whether an email was queued; or None
+            if the project does not exist.
+    """
     query = """
-            WITH last AS (
-                SELECT *
-                FROM task_events
-                WHERE project_id= :project_id AND task_id= :task_id
-                ORDER BY created_at DESC
-                LIMIT 1
-            ),
-            released AS (
-                SELECT COUNT(*) = 0 AS no_record
-                FROM task_events
-                WHERE project_id= :project_id AND task_id= :task_id AND state = :unlocked_to_map_state
-            )
+        WITH project AS (
+            SELECT
+                projects.name,
+                projects.description,
+                projects.requires_approval_from_manager_for_locking AS requires_approval,
+                users.name AS author_name
+            FROM projects
+            JOIN users ON users.id = projects.author_id
+            WHERE projects.id = :project_id
+        ),
+        last AS (
+            SELECT state
+            FROM task_current_state
+            WHERE project_id = :project_id AND task_id = :task_id
+        ),
+        inserted AS (
             INSERT INTO task_events (event_id, project_id, task_id, user_id, comment, state, created_at)
-
             SELECT
                 gen_random_uuid(),
                 :project_id,
                 :task_id,
                 :user_id,
-                :comment,
-                :request_for_map_state,
+                CASE WHEN project.requires_approval
+                    THEN 'Request for mapping'
+                    ELSE 'Request accepted automatically'
+                END,
+                CASE WHEN project.requires_approval
+                    THEN CAST(:request_for_map_state AS state)
+                    ELSE CAST(:locked_for_map_state AS state)
+                END,
                 now()
-            FROM last
-            RIGHT JOIN released ON true
-            WHERE (last.state = :unlocked_to_map_state OR released.no_record = true);
-            """
-
+            FROM project
+            LEFT JOIN last ON true
+            WHERE last.state IS NULL OR last.state = :unlocked_to_map_state
+            RETURNING event_id, task_id, state
+        ),
+        queued AS (
+            INSERT INTO email_outbox (dedup_key, email_to, subject, template_name, context, created_at, next_attempt_at)
+            SELECT
+                'mapping_request:' || inserted.event_id || ':' || CAST(:user_email AS text),
+                CAST(:user_email AS text),
+                'Request for mapping',
+                'mapping_requests.html',
+                jsonb_build_object(
+                    'name', project.author_name,
+                    'drone_operator_name', CAST(:user_name AS text),
+                    'task_id', inserted.task_id,
+                    'project_name', project.name,
+                    'description', project.description
+                ),
+                now(),
+                now()
+            FROM inserted, project
+            WHERE project.requires_approval
+            ON CONFLICT (dedup_key) DO NOTHING
+            RETURNING id
+        )
+        SELECT
+            inserted.state,
+            EXISTS (SELECT 1 FROM queued) AS email_queued
+        FROM project
+        LEFT JOIN inserted ON true;
+    """
     values = {
         "project_id": str(project_id),
         "task_id": str(task_id),
         "user_id": str(user_id),
-        "comment": comment,
+        "user_email": user_email,
+        "user_name": user_name,
         "unlocked_to_map_state": State.UNLOCKED_TO_MAP.name,
         "request_for_map_state": State.REQUEST_FOR_MAPPING.name,
+        "locked_for_map_state": State.LOCKED_FOR_MAPPING.name,
     }
+    async with db.transaction():
+        await lock_task(db, project_id, task_id)
+        return await db.fetch_one(query, values)
 
-    await db.fetch_one(query, values)
 
-    return {"project_id": project_id, "task_id": task_id, "comment": comment}
-
-
-async def update_task_state(
+async def review_mapping_request(
     db: Database,
     project_id: uuid.UUID,
     task_id: uuid.UUID,
     user_id: str,
     comment: str,
-    initial_state: State,
     final_state: State,
+    email_subject: str,
+    email_context: dict,
 ):
+    """Approve or reject the pending mapping request of a task, with the task locked.
+
+    Only the project author can review a request. The new state is recorded
+    for the requesting user, and the email telling them is queued in the
+    outbox within the same statement.
+
+    Args:
+        db (Database): The database connection.
+        project_id (uuid.UUID): The project of the task.
+        task_id (uuid.UUID): The requested task.
+        user_id (str): The reviewing user.
+        comment (str): The comment of the new task event.
+        final_state (State): The state of the task after the review.
+        email_subject (str): The subject of the email to the requesting user.
+        email_context (dict): The static context of the email template, to
+            which the project, author and requesting user names are added.
+
+    Returns:
+        Record: The project author, the requesting user, None if there is no
+            pending request, and whether the state changed; or None if the
+            project does not exist.
+    """
     query = """
-                WITH last AS (
-                    SELECT *
-                    FROM task_events
-                    WHERE project_id = :project_id AND task_id = :task_id
-                    ORDER BY created_at DESC
-                    LIMIT 1
+        WITH project AS (
+            SELECT
+                projects.name,
+                projects.description,
+                projects.author_id,
+                users.name AS author_name
+            FROM projects
+            JOIN users ON users.id = projects.author_id
+            WHERE projects.id = :project_id
+        ),
+        last AS (
+            SELECT state, user_id
+            FROM task_current_state
+            WHERE project_id = :project_id AND task_id = :task_id
+        ),
+        operator AS (
+            SELECT users.id, users.name, users.email_address
+            FROM last
+            JOIN users ON users.id = last.user_id
+            WHERE last.state = :request_for_map_state
+        ),
+        inserted AS (
+            INSERT INTO task_events (event_id, project_id, task_id, user_id, comment, state, created_at)
+            SELECT gen_random_uuid(), :project_id, :task_id, operator.id, :comment, :final_state, now()
+            FROM project, operator
+            WHERE project.author_id = :user_id
+            RETURNING event_id, task_id
+        ),
+        queued AS (
+            INSERT INTO email_outbox (dedup_key, email_to, subject, template_name, context, created_at, next_attempt_at)
+            SELECT
+                :dedup_prefix || ':' || inserted.event_id || ':' || operator.email_address,
+                operator.email_address,
+                :email_subject,
+                'mapping_approved_or_rejected.html',
+                CAST(:email_context AS jsonb) || jsonb_build_object(
+                    'name', project.author_name,
+                    'drone_operator_name', operator.name,
+                    'task_id', inserted.task_id,
+                    'project_name', project.name,
+                    'description', project.description
                 ),
-                locked AS (
-                    SELECT *
-                    FROM last
-                    WHERE user_id = :user_id AND state = :initial_state
-                )
-                INSERT INTO task_events(event_id, project_id, task_id, user_id, state, comment, created_at)
-                SELECT gen_random_uuid(), project_id, task_id, user_id, :final_state, :comment, now()
-                FROM last
-                WHERE user_id = :user_id
-                RETURNING project_id, task_id, user_id, state;
-        """
-
+                now(),
+                now()
+            FROM inserted, project, operator
+            ON CONFLICT (dedup_key) DO NOTHING
+            RETURNING id
+        )
+        SELECT
+            project.author_id,
+            operator.id AS requested_user_id,
+            inserted.event_id IS NOT NULL AS transitioned,
+            EXISTS (SELECT 1 FROM queued) AS email_queued
+        FROM project
+        LEFT JOIN operator ON true
+        LEFT JOIN inserted ON true;
+    """
     values = {
         "project_id": str(project_id),
         "task_id": str(task_id),
         "user_id": str(user_id),
         "comment": comment,
-        "initial_state": initial_state.name,
         "final_state": final_state.name,
+        "request_for_map_state": State.REQUEST_FOR_MAPPING.name,
+        "dedup_prefix": (
+            "mapping_approved"
+            if final_state == State.LOCKED_FOR_MAPPING
+            else "mapping_rejected"
+        ),
+        "email_subject": email_subject,
+        "email_context": json.dumps(email_context),
     }
+    async with db.transaction():
+        await lock_task(db, project_id, task_id)
+        return await db.fetch_one(query, values)
 
-    await db.fetch_one(query, values)
 
-    return {"project_id": project_id, "task_id": task_id, "comment": comment}
-
-
-async def update_or_create_task_state(
+async def update_task_state(
     db: Database,
     project_id: uuid.UUID,
     task_id: uuid.UUID,
@@ -226,33 +422,22 @@ async def update_or_create_task_state(
     initial_state: State,
     final_state: State,
 ):
-    # Update or insert task event
     query = """
-        WITH last AS (
-            SELECT *
-            FROM task_events
-            WHERE project_id = :project_id AND task_id = :task_id
-            ORDER BY created_at DESC
-            LIMIT 1
-        ),
-        updated AS (
-            UPDATE task_events
-            SET state = :final_state, comment = :comment, created_at = now()
-            WHERE EXISTS (
-                SELECT 1
-                FROM last
-                WHERE user_id = :user_id AND state = :initial_state
-            )
-            RETURNING project_id, task_id, user_id, state
-        )
-        INSERT INTO task_events (event_id, project_id, task_id, user_id, state, comment, created_at)
-        SELECT gen_random_uuid(), :project_id, :task_id, :user_id, :final_state, :comment, now()
-        WHERE NOT EXISTS (
-            SELECT 1
-            FROM updated
-        )
-        RETURNING project_id, task_id, user_id, state;
-    """
+                WITH last AS (
+                    SELECT *
+                    FROM task_current_state
+                    WHERE project_id = :project_id AND task_id = :task_id
+                ),
+                locked AS (
+                    SELECT *
+                    FROM last
+                    WHERE user_id = :user_id AND state = :initial_state
+                )
+                INSERT INTO task_events(event_id, project_id, task_id, user_id, state, comment, created_at)
+                SELECT gen_random_uuid(), project_id, task_id, user_id, :final_state, :comment, now()
+                FROM locked
+                RETURNING project_id, task_id, user_id, state;
+        """
 
     values = {
         "project_id": str(project_id),
@@ -263,35 +448,18 @@ async def update_or_create_task_state(
         "final_state": final_state.name,
     }
 
-    result = await db.fetch_one(query, values)
-
-    return {
-        "project_id": result["project_id"],
-        "task_id": result["task_id"],
-        "comment": comment,
-    }
+    async with db.transaction():
+        await lock_task(db, project_id, task_id)
+        result = await db.fetch_one(query, values)
 
-
-async def get_requested_user_id(
-    db: Database, project_id: uuid.UUID, task_id: uuid.UUID
-):
-    query = """
-        SELECT user_id
-        FROM task_events
-        WHERE project_id = :project_id AND task_id = :task_id and state = :request_for_map_state
-        ORDER BY created_at DESC
-        LIMIT 1
-        """
-    values = {
-        "project_id": str(project_id),
-        "task_id": str(task_id),
-        "request_for_map_state": State.REQUEST_FOR_MAPPING.name,
-    }
-
-    result = await db.fetch_one(query, values)
+    # The task was not in the initial state for the user
     if result is None:
-        raise ValueError("No user requested for mapping")
-    return result["user_id"]
+        raise HTTPException(
+            status_code=HTTPStatus.CONFLICT,
+            detail=f"Task is not in state {initial_state.name} for the user",
+        )
+
+    return {"project_id": project_id, "task_id": task_id, "comment": comment}
 
 
 async def get_project_task_by_id(db: Database, user_id: str):
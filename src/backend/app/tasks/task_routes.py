@@ -1,15 +1,23 @@
+import asyncio
 import uuid
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from datetime import datetime, timedelta
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from app.config import settings
 from app.models.enums import EventType, HTTPStatus, State, UserRole
 from app.tasks import task_schemas, task_crud
 from app.users.user_deps import login_required
 from app.users.user_schemas import AuthUser
-from app.users.user_crud import get_user_by_id
 from databases import Database
 from app.db import database
-from app.utils import send_notification_email, render_email_template
-from app.projects.project_crud import get_project_by_id
+from app.email_outbox import email_dispatcher
+from app.tasks.task_stream import (
+    KEEPALIVE_INTERVAL,
+    RESUME_OVERLAP_SECONDS,
+    format_event,
+    task_state_broker,
+)
 
 
 router = APIRouter(
@@ -29,7 +37,12 @@ async def read_task(
     try:
         query = """
             SELECT
-                ST_Area(ST_Transform(tasks.outline, 4326)) / 1000000 AS task_area,
+                tasks.area_m2 / 1000000 AS task_area,
+                tasks.perimeter_m,
+                tasks.bbox,
+                ARRAY[ST_X(tasks.centroid), ST_Y(tasks.centroid)] AS centroid,
+                tasks.waypoint_count,
+                tasks.flight_time_minutes,
                 task_events.created_at,
                 projects.name AS project_name,
                 project_task_index,
@@ -61,31 +74,22 @@ async def get_task_stats(
     user_data: AuthUser = Depends(login_required),
 ):
     "Retrieve statistics related to tasks for the authenticated user."
-    user_id = user_data.id
-    query = """SELECT role FROM user_profile WHERE user_id = :user_id"""
-    records = await db.fetch_all(query, {"user_id": user_id})
-
-    if not records:
-        raise HTTPException(status_code=404, detail="User profile not found")
-    raw_sql = """
-        SELECT
-        COUNT(CASE WHEN te.state = 'REQUEST_FOR_MAPPING' THEN 1 END) AS request_logs,
-        COUNT(CASE WHEN te.state = 'LOCKED_FOR_MAPPING' THEN 1 END) AS ongoing_tasks,
-        COUNT(CASE WHEN te.state = 'UNLOCKED_DONE' THEN 1 END) AS completed_tasks,
-        COUNT(CASE WHEN te.state = 'UNFLYABLE_TASK' THEN 1 END) AS unflyable_tasks
-        FROM tasks t
-        LEFT JOIN task_events te ON t.id = te.task_id
-        WHERE t.project_id IN (SELECT id FROM projects WHERE author_id = :user_id);
-        """
-
     try:
-        db_counts = await db.fetch_one(query=raw_sql, values={"user_id": user_id})
+        stats = await task_crud.get_task_stats(db, user_data.id)
     except Exception as e:
         raise HTTPException(
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
             detail=f"Failed to fetch task counts. {e}",
         )
-    return db_counts
+
+    if not stats["has_profile"]:
+        raise HTTPException(status_code=404, detail="User profile not found")
+    return {
+        "request_logs": stats["request_logs"],
+        "ongoing_tasks": stats["ongoing_tasks"],
+        "completed_tasks": stats["completed_tasks"],
+        "unflyable_tasks": stats["unflyable_tasks"],
+    }
 
 
 @router.get("/", response_model=list[task_schemas.UserTasksStatsOut])
@@ -102,13 +106,108 @@ async def list_tasks(
 @router.get("/states/{project_id}")
 async def task_states(project_id: uuid.UUID, db: Database = Depends(database.get_db)):
     """Get all tasks states for a project."""
+    # Serialised by orjson directly, rather than through jsonable_encoder
+    return ORJSONResponse(await task_crud.all_tasks_states(db, project_id))
+
+
+@router.get("/states/{project_id}/stream")
+async def task_states_stream(
+    project_id: uuid.UUID,
+    last_event_id: Optional[str] = Header(None),
+    db: Database = Depends(database.get_db),
+):
+    """Stream the task state changes of a project, as server-sent events.
+
+    A `snapshot` event with every task state is sent first, then a `state`
+    event per change. Reconnecting clients send the id of the last event
+    received as Last-Event-ID, and get the changes since then instead.
+    """
+    since = None
+    if last_event_id:
+        try:
+            since = datetime.fromisoformat(last_event_id)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST, detail="Invalid Last-Event-ID"
+            ) from e
+
+    # Subscribe before reading the current states, so no change is missed
+    queue = task_state_broker.subscribe(str(project_id))
+
+    async def events():
+        try:
+            if since is None:
+                states = await task_crud.all_tasks_states(db, project_id)
+                latest = await task_crud.latest_task_state_change(db, project_id)
+                yield format_event("snapshot", states, latest)
+            else:
+                changes = await task_crud.task_states_since(
+                    db, project_id, since - timedelta(seconds=RESUME_OVERLAP_SECONDS)
+                )
+                for change in changes:
+                    yield format_event("state", change, change["created_at"])
 
-    return await task_crud.all_tasks_states(db, project_id)
+            while True:
+                try:
+                    change = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if change is None:
+                    # Closed by the broker, the client will reconnect and resume
+                    break
+                yield format_event("state", change, change["created_at"])
+        finally:
+            task_state_broker.unsubscribe(str(project_id), queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def review_mapping_request(
+    db: Database,
+    project_id: uuid.UUID,
+    task_id: uuid.UUID,
+    user_id: str,
+    comment: str,
+    final_state: State,
+    email_subject: str,
+    email_context: dict,
+):
+    """Approve or reject a mapping request, and email the requesting user."""
+    result = await task_crud.review_mapping_request(
+        db,
+        project_id,
+        task_id,
+        user_id,
+        comment,
+        final_state,
+        email_subject,
+        email_context,
+    )
+    if result is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Project not found"
+        )
+    if user_id != result["author_id"]:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="Only the project creator can approve the mapping.",
+        )
+    if result["requested_user_id"] is None:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="No user requested for mapping"
+        )
+    if result["email_queued"]:
+        email_dispatcher.wake()
+    return {"project_id": project_id, "task_id": task_id, "comment": comment}
 
 
 @router.post("/event/{project_id}/{task_id}")
 async def new_event(
-    background_tasks: BackgroundTasks,
     project_id: uuid.UUID,
     task_id: uuid.UUID,
     detail: task_schemas.NewEvent,
@@ -119,131 +218,60 @@ async def new_event(
 
     match detail.event:
         case EventType.REQUESTS:
-            # TODO: Combine the logic of `update_or_create_task_state` and `request_mapping` functions into a single function if possible. Will do later.
-            project = await get_project_by_id(db, project_id)
-            if project["requires_approval_from_manager_for_locking"] is False:
-                data = await task_crud.update_or_create_task_state(
-                    db,
-                    project_id,
-                    task_id,
-                    user_id,
-                    "Request accepted automatically",
-                    State.REQUEST_FOR_MAPPING,
-                    State.LOCKED_FOR_MAPPING,
-                )
-            else:
-                data = await task_crud.request_mapping(
-                    db,
-                    project_id,
-                    task_id,
-                    user_id,
-                    "Request for mapping",
-                )
-                # email notification
-                author = await get_user_by_id(db, project.author_id)
-
-                html_content = render_email_template(
-                    template_name="mapping_requests.html",
-                    context={
-                        "name": author.name,
-                        "drone_operator_name": user_data.name,
-                        "task_id": task_id,
-                        "project_name": project.name,
-                        "description": project.description,
-                    },
-                )
-                background_tasks.add_task(
-                    send_notification_email,
-                    user_data.email,
-                    "Request for mapping",
-                    html_content,
+            result = await task_crud.request_mapping(
+                db, project_id, task_id, user_id, user_data.email, user_data.name
+            )
+            if result is None:
+                raise HTTPException(
+                    status_code=HTTPStatus.NOT_FOUND, detail="Project not found"
                 )
-            return data
-
-        case EventType.MAP:
-            project = await get_project_by_id(db, project_id)
-            if user_id != project.author_id:
+            if result["state"] is None:
                 raise HTTPException(
-                    status_code=403,
-                    detail="Only the project creator can approve the mapping.",
+                    status_code=HTTPStatus.CONFLICT,
+                    detail="Task is not available for mapping",
                 )
+            if result["email_queued"]:
+                email_dispatcher.wake()
+            if result["state"] == State.LOCKED_FOR_MAPPING.name:
+                comment = "Request accepted automatically"
+            else:
+                comment = "Request for mapping"
+            return {
+                "project_id": project_id,
+                "task_id": task_id,
+                "comment": comment,
+            }
 
-            requested_user_id = await task_crud.get_requested_user_id(
-                db, project_id, task_id
-            )
-            drone_operator = await get_user_by_id(db, requested_user_id)
-            html_content = render_email_template(
-                template_name="mapping_approved_or_rejected.html",
-                context={
-                    "email_subject": "Mapping Request Approved",
-                    "email_body": "We are pleased to inform you that your mapping request has been approved. Your contribution is invaluable to our efforts in improving humanitarian responses worldwide.",
-                    "task_status": "approved",
-                    "name": user_data.name,
-                    "drone_operator_name": drone_operator.name,
-                    "task_id": task_id,
-                    "project_name": project.name,
-                    "description": project.description,
-                },
-            )
-
-            background_tasks.add_task(
-                send_notification_email,
-                drone_operator.email_address,
-                "Task is approved",
-                html_content,
-            )
-
-            return await task_crud.update_task_state(
+        case EventType.MAP:
+            return await review_mapping_request(
                 db,
                 project_id,
                 task_id,
-                requested_user_id,
+                user_id,
                 "Request accepted for mapping",
-                State.REQUEST_FOR_MAPPING,
                 State.LOCKED_FOR_MAPPING,
-            )
-
-        case EventType.REJECTED:
-            project = await get_project_by_id(db, project_id)
-            if user_id != project.author_id:
-                raise HTTPException(
-                    status_code=403,
-                    detail="Only the project creator can approve the mapping.",
-                )
-
-            requested_user_id = await task_crud.get_requested_user_id(
-                db, project_id, task_id
-            )
-            drone_operator = await get_user_by_id(db, requested_user_id)
-            html_content = render_email_template(
-                template_name="mapping_approved_or_rejected.html",
-                context={
-                    "email_subject": "Mapping Request Rejected",
-                    "email_body": "We are sorry to inform you that your mapping request has been rejected.",
-                    "task_status": "rejected",
-                    "name": user_data.name,
-                    "drone_operator_name": drone_operator.name,
-                    "task_id": task_id,
-                    "project_name": project.name,
-                    "description": project.description,
+                "Task is approved",
+                {
+                    "email_subject": "Mapping Request Approved",
+                    "email_body": "We are pleased to inform you that your mapping request has been approved. Your contribution is invaluable to our efforts in improving humanitarian responses worldwide.",
+                    "task_status": "approved",
                 },
             )
 
-            background_tasks.add_task(
-                send_notification_email,
-                drone_operator.email_address,
-                "Task is Rejected",
-                html_content,
-            )
-
-            return await task_crud.update_task_state(
+        case EventType.REJECTED:
+            return await review_mapping_request(
                 db,
                 project_id,
                 task_id,
-                requested_user_id,
+                user_id,
                 "Request for mapping rejected",
-                State.REQUEST_FOR_MAPPING,
                 State.UNLOCKED_TO_MAP,
+                "Task is Rejected",
+                {
+                    "email_subject": "Mapping Request Rejected",
+                    "email_body": "We are sorry to inform you that your mapping request has been rejected.",
+                    "task_status": "rejected",
+                },
             )
         case EventType.FINISH:
             return await task_crud.update_task_state(
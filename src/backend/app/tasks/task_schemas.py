@@ -12,7 +12,12 @@ class NewEvent(BaseModel):
 
 class UserTasksStatsOut(BaseModel):
     task_id: uuid.UUID
-    task_area: float
+    task_area: Optional[float] = None
     created_at: datetime
     state: str
     project_id: uuid.UUID
+    perimeter_m: Optional[float] = None
+    bbox: Optional[list[float]] = None
+    centroid: Optional[list[float]] = None
+    waypoint_count: Optional[int] = None
+    flight_time_minutes: Optional[float] = None
@@ -0,0 +1,168 @@
+"""Fan out of task state changes, from Postgres notifications to subscribers."""
+
+import asyncio
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+import asyncpg
+from loguru import logger as log
+
+from app.config import settings
+
+# Channel notified by a trigger on task_events
+TASK_STATE_CHANNEL = "task_state"
+# Channel notified by triggers on projects and tasks, when their tiles change
+PROJECT_CHANGE_CHANNEL = "project_change"
+# Changes buffered per subscriber, before it is closed as too slow
+SUBSCRIBER_QUEUE_SIZE = 256
+RECONNECT_DELAY = 5  # seconds
+KEEPALIVE_INTERVAL = 15  # seconds
+# Events are timestamped when their transaction starts, so one may commit
+# after a later timestamped event; resuming slightly before the last event
+# replays a few idempotent changes instead of missing one.
+RESUME_OVERLAP_SECONDS = 5
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def format_event(event: str, data: Any, event_id: Optional[Any] = None) -> str:
+    """Format a server-sent event, with its id used as the resume token."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {_json_default(event_id)}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=_json_default)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class TaskStateBroker:
+    """Listen for task state notifications and fan them out per project.
+
+    A single connection per process listens on the channel, however many
+    clients are subscribed. Each subscriber gets a bounded queue of changes;
+    a subscriber which falls behind is sent None and dropped, so that it
+    reconnects and resumes from its last event instead.
+
+    Listeners, such as cache invalidation, are called with every change, or
+    with None when changes may have been missed. They are also called with
+    the changes of projects and tasks, which have a `table` and are not sent
+    to subscribers.
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        self.listeners: list[Callable[[Optional[dict]], None]] = []
+        self._connection: Optional[asyncpg.Connection] = None
+        self._reconnect: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self):
+        """Open the listening connection."""
+        self._closing = False
+        try:
+            self._connection = await asyncpg.connect(self.dsn)
+            self._connection.add_termination_listener(self._on_termination)
+            for channel in (TASK_STATE_CHANNEL, PROJECT_CHANGE_CHANNEL):
+                await self._connection.add_listener(channel, self._on_notify)
+            log.debug(
+                f"Listening for {TASK_STATE_CHANNEL} and {PROJECT_CHANGE_CHANNEL} "
+                "notifications"
+            )
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+            log.warning(f"Failed to listen for task state notifications: {e}")
+            self._schedule_reconnect()
+
+    async def stop(self):
+        """Close the listening connection and every subscription."""
+        self._closing = True
+        if self._reconnect:
+            self._reconnect.cancel()
+        if self._connection and not self._connection.is_closed():
+            await self._connection.close()
+        self._connection = None
+
+        for queues in self.subscribers.values():
+            for queue in queues:
+                self._close_queue(queue)
+        self.subscribers.clear()
+
+    @property
+    def is_listening(self) -> bool:
+        """Whether changes are currently received, so listeners are up to date."""
+        return self._connection is not None and not self._connection.is_closed()
+
+    def subscribe(self, project_id: str) -> asyncio.Queue:
+        """Subscribe to the task state changes of a project."""
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers[project_id].add(queue)
+        return queue
+
+    def unsubscribe(self, project_id: str, queue: asyncio.Queue):
+        """Remove a subscription, once its client is gone."""
+        queues = self.subscribers.get(project_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[project_id]
+
+    def add_listener(self, listener: Callable[[Optional[dict]], None]):
+        """Call a function with every change of every project, and of its tasks."""
+        self.listeners.append(listener)
+
+    def _notify_listeners(self, change: Optional[dict]):
+        for listener in self.listeners:
+            try:
+                listener(change)
+            except Exception as e:
+                log.exception(f"Task state listener failed: {e}")
+
+    def _on_notify(self, connection, pid, channel: str, payload: str):
+        change = json.loads(payload)
+        self._notify_listeners(change)
+        if channel != TASK_STATE_CHANNEL:
+            return
+        for queue in list(self.subscribers.get(change["project_id"], ())):
+            try:
+                queue.put_nowait(change)
+            except asyncio.QueueFull:
+                log.warning(f"Dropping slow subscriber of {change['project_id']}")
+                self.unsubscribe(change["project_id"], queue)
+                self._close_queue(queue)
+
+    def _on_termination(self, connection):
+        if not self._closing:
+            log.warning("Lost the task state notification connection")
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if not self._closing and (self._reconnect is None or self._reconnect.done()):
+            self._reconnect = asyncio.get_running_loop().create_task(
+                self._reconnect_later()
+            )
+
+    async def _reconnect_later(self):
+        await asyncio.sleep(RECONNECT_DELAY)
+        # Changes may have been missed, so subscribers must resume from the DB
+        self._notify_listeners(None)
+        for queues in self.subscribers.values():
+            for queue in queues:
+                self._close_queue(queue)
+        self.subscribers.clear()
+        await self.start()
+
+    @staticmethod
+    def _close_queue(queue: asyncio.Queue):
+        """Replace any pending change with None, to end the subscription."""
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+task_state_broker = TaskStateBroker(settings.DTM_DB_URL.unicode_string())
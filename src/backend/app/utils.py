@@ -10,10 +10,10 @@ from geoalchemy2 import WKBElement
 from geoalchemy2.shape import from_shape, to_shape
 from shapely.geometry import mapping, shape, MultiPolygon as ShapelyMultiPolygon
 from shapely.ops import unary_union
-from fastapi import HTTPException
+from fastapi import HTTPException, Response
 from app.config import settings
 from shapely import wkb
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from pathlib import Path
 from dataclasses import dataclass
 from slugify import slugify
@@ -24,6 +24,13 @@ from aiosmtplib import send as send_email
 
 log = logging.getLogger(__name__)
 
+# Templates are compiled once per process, and not checked for changes
+email_templates = Environment(
+    loader=FileSystemLoader(Path(__file__).parent / "email_templates"),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False,
+)
+
 
 def timestamp():
     """Get the current time.
@@ -33,6 +40,12 @@ def timestamp():
     return datetime.now(timezone.utc)
 
 
+class RawJSONResponse(Response):
+    """JSON already serialised, e.g. built by PostGIS, sent as is."""
+
+    media_type = "application/json"
+
+
 def str_to_geojson(
     result: str, properties: Optional[dict] = None, id: Optional[str] = None
 ) -> Union[Feature, dict]:
@@ -322,16 +335,17 @@ def render_email_template(template_name: str, context: dict[str, Any]) -> str:
             context={"username": "John Doe", "welcome_message": "Welcome to our service!"}
         )
 
-    This function reads the specified email template from the 'email-templates' directory,
-    then uses the `Template` class from the `jinja2` library to render the template with
-    the provided context variables.
+    This function gets the specified email template from the 'email_templates' directory,
+    compiled once per process by the `email_templates` Jinja environment, then renders it
+    with the provided context variables.
     """
+    return email_templates.get_template(template_name).render(context)
+
 
-    template_str = (
-        Path(__file__).parent / "email_templates" / template_name
-    ).read_text()
-    html_content = Template(template_str).render(context)
-    return html_content
+def preload_email_templates():
+    """Compile every email template, so that rendering needs no file access."""
+    for template_name in email_templates.list_templates():
+        email_templates.get_template(template_name)
 
 
 async def send_notification_email(email_to, subject, html_content):
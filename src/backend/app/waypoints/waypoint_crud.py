@@ -1,12 +1,52 @@
-import os
-import uuid
+import asyncio
+import io
+import json
 import zipfile
+from typing import Optional
 import xml.etree.ElementTree as ET
 from shapely.geometry import Polygon
+from drone_flightplan import create_wpml, flightplan, waypoints
+from app.cache import LRUCache, content_hash
+from app.config import settings
+from app.dem import DemWindow
 from app.models.enums import DroneType
+from app.workers import process_pool
 from math import radians, sin, cos, sqrt, atan2
 from xml.etree.ElementTree import Element
 
+# Constant to convert gsd to Altitude above ground level
+GSD_to_AGL_CONST = 29.7  # For DJI Mini 4 Pro
+
+
+def project_flight_parameters(project) -> tuple:
+    """Altitude, GSD and overlaps to fly a project's tasks with."""
+    forward_overlap = project.front_overlap if project.front_overlap else 70
+    side_overlap = project.side_overlap if project.side_overlap else 70
+
+    gsd = project.gsd_cm_px
+    altitude = project.altitude_from_ground
+    # TODO This should be fixed within the drone_flightplan (115 m altitude is static for now)
+    if not altitude:
+        altitude = gsd * GSD_to_AGL_CONST if gsd else 115
+
+    return altitude, gsd, forward_overlap, side_overlap
+
+
+def flight_spacing(project) -> dict:
+    """Spacing of the photos and flight lines of a project, and its ground speed.
+
+    Returns:
+        dict: forward_spacing and side_spacing in meters, ground_speed in m/s,
+            as used by drone_flightplan to lay out the waypoints of a task.
+    """
+    altitude, _, forward_overlap, side_overlap = project_flight_parameters(project)
+    parameters = waypoints.calculate_parameters(altitude, forward_overlap, side_overlap)
+    return {
+        "forward_spacing": parameters["forward_spacing"],
+        "side_spacing": parameters["side_spacing"],
+        "ground_speed": parameters["ground_speed"],
+    }
+
 
 def haversine_distance(coord1, coord2):
     # Haversine formula for great-circle distance
@@ -83,26 +123,10 @@ async def calculate_distance_between_2_lines(
     return overlap_distance_in_cm / 100  # return in metre
 
 
-def zip_directory(directory_path, zip_path):
-    with zipfile.ZipFile(zip_path, "w") as zipf:
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                zipf.write(
-                    os.path.join(root, file),
-                    os.path.relpath(
-                        os.path.join(root, file), os.path.join(directory_path, "..")
-                    ),
-                )
-
-
-def create_zip_file(waylines_path_uid):
-    # Create the wpmz folder if it doesn't exist
-    wpmz_path = f"/tmp/{waylines_path_uid}/wpmz"
-    os.makedirs(wpmz_path, exist_ok=True)
-
-    import xml.etree.ElementTree as ET
-
-    xml_string = """<?xml version="1.0" encoding="UTF-8"?>
+# DJI mission template, serialised once instead of per download
+TEMPLATE_KML = ET.tostring(
+    ET.fromstring(
+        """<?xml version="1.0" encoding="UTF-8"?>
     <kml xmlns="http://www.opengis.net/kml/2.2" xmlns:wpml="http://www.dji.com/wpmz/1.0.2">
       <Document>
         <wpml:author>fly</wpml:author>
@@ -122,29 +146,292 @@ def create_zip_file(waylines_path_uid):
       </Document>
     </kml>
     """
+    ),
+    encoding="utf-8",
+    xml_declaration=True,
+)
+
+WAYLINES_HEADER = (
+    b"<?xml version='1.0' encoding='UTF-8'?>\n"
+    b'<kml xmlns="http://www.opengis.net/kml/2.2" '
+    b'xmlns:wpml="http://www.dji.com/wpmz/1.0.2"><Document>'
+)
+WAYLINES_FOOTER = b"</Folder></Document></kml>"
+
+# Number of placemarks serialised between two chunks of the KMZ stream
+KMZ_CHUNK_PLACEMARKS = 500
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Unseekable, write-only sink that hands zip output over in chunks."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        """Return everything written since the last drain."""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def generate_placemarks(
+    project_area,
+    agl=None,
+    gsd=None,
+    forward_overlap=70.0,
+    side_overlap=70.0,
+    generate_each_points=False,
+    generate_3d=False,
+    terrain_follow=False,
+    input_raster=None,
+):
+    """Compute the placemarks of a flight plan without writing any file.
 
-    # Parse the XML string
-    root = ET.fromstring(xml_string)
+    Mirrors `drone_flightplan.flightplan.generate_flightplan`, up to the
+    point where it hands the placemarks to its file based KMZ writer.
 
-    # Create an ElementTree object
-    tree = ET.ElementTree(root)
+    Returns:
+        tuple: The list of placemark values and the altitude used.
+    """
+    if gsd:
+        agl = gsd * flightplan.GSD_to_AGL_CONST
+
+    parameters = waypoints.calculate_parameters(agl, forward_overlap, side_overlap)
+    flight_waypoints = waypoints.create_waypoint(
+        project_area,
+        agl,
+        forward_overlap,
+        side_overlap,
+        generate_each_points,
+        generate_3d,
+    )
 
-    # Write the ElementTree object to a file
-    with open(f"{wpmz_path}/template.kml", "wb") as file:
-        tree.write(file, encoding="utf-8", xml_declaration=True)
+    if terrain_follow:
+        grid_with_elevation = flightplan.process_waypoints_with_terrain_follow(
+            flight_waypoints, input_raster
+        )
+
+    placemarks = []
+    for placemark in flight_waypoints:
+        # 4th index is the elevation difference with reference to first point
+        agl_diff = grid_with_elevation[placemark["index"]][4] if terrain_follow else 0
+        placemarks.append(
+            [
+                f"{placemark['coordinates'][0]},{placemark['coordinates'][1]}",
+                str(agl + agl_diff),
+                str(parameters["ground_speed"]),
+                str(placemark["angle"]),
+                str(placemark["take_photo"]),
+                str(placemark["gimbal_angle"]),
+            ]
+        )
+
+    return placemarks, agl
+
+
+def stream_kmz(placemarks, finish_action, global_height):
+    """Stream a DJI KMZ (wpmz/template.kml and wpmz/waylines.wpml) in memory.
+
+    The waylines XML is serialised placemark by placemark straight into the
+    deflate stream of the zip, so nothing touches disk and only one chunk of
+    placemarks is held in memory at a time.
+
+    Args:
+        placemarks (list): Placemark values, as from `generate_placemarks`.
+        finish_action (str): Action once the mission is complete.
+        global_height (float): Return to home height.
+
+    Yields:
+        bytes: Consecutive chunks of the KMZ file.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as kmz:
+        kmz.writestr("wpmz/template.kml", TEMPLATE_KML)
+
+        with kmz.open("wpmz/waylines.wpml", "w", force_zip64=True) as waylines:
+            waylines.write(WAYLINES_HEADER)
+            waylines.write(
+                ET.tostring(
+                    create_wpml.create_mission_config(finish_action, global_height)
+                )
+            )
+            # Folder properties only, placemarks are appended one by one
+            folder = ET.tostring(create_wpml.create_folder([]))
+            waylines.write(folder[: -len(b"</Folder>")])
+
+            for index, placemark_data in enumerate(placemarks):
+                waylines.write(
+                    ET.tostring(create_wpml.create_placemark(index, *placemark_data))
+                )
+                if index % KMZ_CHUNK_PLACEMARKS == 0:
+                    yield buffer.drain()
 
-    # Read content of template.kml
-    with open(f"/tmp/{waylines_path_uid}/waylines.wpml", "r") as f:
-        wpml_content = f.read()
+            waylines.write(WAYLINES_FOOTER)
 
-    with open(f"{wpmz_path}/waylines.wpml", "w") as f:
-        f.write(wpml_content)
+    yield buffer.drain()
 
-    # Create a Zip file containing the contents of the wpmz folder directly
-    output_file_name = f"/tmp/{waylines_path_uid}/output.kmz"
-    zip_directory(wpmz_path, output_file_name)
 
-    return output_file_name
+flightplan_cache = LRUCache(settings.FLIGHTPLAN_CACHE_MAX_MB * 1024 * 1024)
+
+
+def flightplan_cache_key(
+    project_id,
+    task_outline: dict,
+    altitude,
+    gsd,
+    forward_overlap,
+    side_overlap,
+    terrain_follow: bool,
+    dem_etag: Optional[str],
+    output: str,
+) -> tuple:
+    """Content-addressed cache key for a generated flight plan.
+
+    Any change to the task outline, the flight parameters or the DEM
+    gives a new key, so cached plans can never be stale.
+
+    Args:
+        output (str): The cached representation, "kmz" or "waypoints".
+    """
+    return (
+        project_id,
+        content_hash(
+            task_outline,
+            altitude,
+            gsd,
+            forward_overlap,
+            side_overlap,
+            terrain_follow,
+            dem_etag,
+            output,
+        ),
+    )
+
+
+def cache_stream(cache_key: tuple, chunks):
+    """Pass chunks through, caching the joined bytes once fully sent."""
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    flightplan_cache.set(cache_key, b"".join(sent))
+
+
+def generate_kmz(
+    project_area,
+    agl=None,
+    gsd=None,
+    forward_overlap=70.0,
+    side_overlap=70.0,
+    generate_each_points=False,
+    generate_3d=False,
+    terrain_follow=False,
+    input_raster=None,
+) -> bytes:
+    """Generate a complete KMZ flight plan in memory, e.g. in a worker."""
+    placemarks, agl = generate_placemarks(
+        project_area,
+        agl,
+        gsd,
+        forward_overlap,
+        side_overlap,
+        generate_each_points,
+        generate_3d,
+        terrain_follow,
+        input_raster,
+    )
+    return b"".join(stream_kmz(placemarks, "goHome", agl))
+
+
+async def stream_kmz_bundle(
+    project_id,
+    tasks,
+    altitude,
+    gsd,
+    forward_overlap,
+    side_overlap,
+    terrain_follow: bool,
+    dem_window: Optional[DemWindow],
+    dem_etag: Optional[str],
+):
+    """Stream a zip of per-task KMZs, in the order the plans are finished.
+
+    Task plans are generated in parallel in the process pool, at most one
+    job per worker at a time, and reuse the flight plan cache.
+
+    Args:
+        tasks (list): Task records with `project_task_index` and `outline`
+            (GeoJSON string).
+        dem_window (DemWindow, optional): The DEM under all the tasks, closed
+            once the zip is streamed.
+
+    Yields:
+        bytes: Consecutive chunks of the zip file.
+    """
+    semaphore = asyncio.Semaphore(process_pool.max_workers)
+    loop = asyncio.get_running_loop()
+    # How long jobs may wait for other requests' jobs, once the stream started
+    deadline = loop.time() + settings.WORKER_JOB_TIMEOUT
+
+    async def plan(task):
+        feature = {"type": "Feature", "geometry": json.loads(task["outline"])}
+        cache_key = flightplan_cache_key(
+            project_id,
+            feature["geometry"],
+            altitude,
+            gsd,
+            forward_overlap,
+            side_overlap,
+            terrain_follow,
+            dem_etag,
+            "kmz",
+        )
+        if (kmz := flightplan_cache.get(cache_key)) is not None:
+            return task["project_task_index"], kmz
+
+        async with semaphore:
+            # Wait for other requests' jobs rather than failing mid-stream,
+            # until the deadline where `run` raises a 503 and aborts the stream
+            while process_pool.saturated and loop.time() < deadline:
+                await asyncio.sleep(0.5)
+            kmz = await process_pool.run(
+                generate_kmz,
+                feature,
+                altitude,
+                gsd,
+                forward_overlap,
+                side_overlap,
+                False,
+                False,
+                terrain_follow,
+                dem_window.path if dem_window else None,
+            )
+        flightplan_cache.set(cache_key, kmz)
+        return task["project_task_index"], kmz
+
+    jobs = [asyncio.create_task(plan(task)) for task in tasks]
+    buffer = ZipStreamBuffer()
+    try:
+        # KMZs are already compressed
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as bundle:
+            for finished in asyncio.as_completed(jobs):
+                task_index, kmz = await finished
+                bundle.writestr(f"task_{task_index}.kmz", kmz)
+                yield buffer.drain()
+        yield buffer.drain()
+    finally:
+        for job in jobs:
+            job.cancel()
+        if dem_window is not None:
+            dem_window.close()
 
 
 def take_photo_action(action_group_element: Element, index: str):
@@ -397,22 +684,6 @@ def create_kml(mission_config, folder):
     return kml
 
 
-def create_xml(placemarks, finish_action, generate_each_points: bool = False):
-    mission_config = create_mission_config(finish_action)
-    folder = create_folder(placemarks, generate_each_points)
-    kml = create_kml(mission_config, folder)
-
-    tree = ET.ElementTree(kml)
-
-    folder_name = str(uuid.uuid4())
-    os.makedirs(os.path.join("/tmp/", folder_name), exist_ok=True)
-    waylines_path = os.path.join("/tmp/", folder_name, "waylines.wpml")
-
-    tree.write(waylines_path, encoding="UTF-8", xml_declaration=True)
-    output_file_name = create_zip_file(folder_name)
-    return output_file_name
-
-
 async def generate_waypoints_within_polygon(
     aoi, distance_between_lines, generate_each_points
 ):
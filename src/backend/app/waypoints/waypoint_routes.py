@@ -1,22 +1,29 @@
+import json
+import os
+import tempfile
+from contextlib import nullcontext
 import uuid
 import geojson
+import shapely
 import shutil
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from app.config import settings
-from drone_flightplan import flightplan, waypoints
+from drone_flightplan import waypoints
 from app.models.enums import HTTPStatus
-from app.tasks.task_crud import get_task_geojson
+from app.tasks.task_crud import get_task_geojson, get_project_tasks_geojson
 from app.projects.project_crud import get_project_by_id
 from app.db import database
+from app.waypoints import waypoint_crud
+from app.workers import process_pool
 from app.utils import merge_multipolygon
-from app.s3 import get_file_from_bucket
+from app.s3 import async_s3
+from app.dem import dem_cache
 from databases import Database
+from shapely.geometry import shape
 
 
-# Constant to convert gsd to Altitude above ground level
-GSD_to_AGL_CONST = 29.7  # For DJI Mini 4 Pro
-
 router = APIRouter(
     prefix=f"{settings.API_PREFIX}/waypoint",
     tags=["waypoint"],
@@ -35,50 +42,158 @@ async def get_task_waypoint(
     features = task_geojson["features"][0]
     project = await get_project_by_id(db, project_id)
 
-    forward_overlap = (
-        project.forward_overlap_percent if project.forward_overlap_percent else 70
+    altitude, gsd, forward_overlap, side_overlap = (
+        waypoint_crud.project_flight_parameters(project)
     )
-    side_overlap = project.side_overlap_percent if project.side_overlap_percent else 70
     generate_each_points = False
     generate_3d = False
 
-    gsd = project.gsd_cm_px
-    altitude = project.altitude_from_ground
-    # TODO This should be fixed within the drone_flightplan (115 m altitude is static for now)
-    if not altitude:
-        altitude = gsd * GSD_to_AGL_CONST if gsd else 115
+    # Only the KMZ follows the terrain, the waypoints do not use the DEM
+    use_dem = download and project.is_terrain_follow
+    dem_s3_path = f"dem/{project_id}/dem.tif"
+    dem_etag = (
+        await async_s3.get_obj_etag(settings.S3_BUCKET_NAME, dem_s3_path)
+        if use_dem
+        else None
+    )
+    cache_key = waypoint_crud.flightplan_cache_key(
+        project_id,
+        features["geometry"],
+        altitude,
+        gsd,
+        forward_overlap,
+        side_overlap,
+        use_dem,
+        dem_etag,
+        "kmz" if download else "waypoints",
+    )
+    cached = waypoint_crud.flightplan_cache.get(cache_key)
 
     if not download:
-        return waypoints.create_waypoint(
+        if cached is None:
+            cached = json.dumps(
+                await process_pool.run(
+                    waypoints.create_waypoint,
+                    features,
+                    altitude,
+                    forward_overlap,
+                    side_overlap,
+                    generate_each_points,
+                    generate_3d,
+                )
+            ).encode()
+            waypoint_crud.flightplan_cache.set(cache_key, cached)
+        return Response(cached, media_type="application/json")
+
+    kmz_headers = {"Content-Disposition": 'attachment; filename="output.kmz"'}
+    if cached is not None:
+        return Response(cached, media_type="application/zip", headers=kmz_headers)
+
+    dem_window = None
+    if use_dem:
+        if not dem_etag:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="Project DEM not found"
+            )
+        dem_window = await run_in_threadpool(
+            dem_cache.get_window,
+            settings.S3_BUCKET_NAME,
+            dem_s3_path,
+            dem_etag,
+            shape(features["geometry"]).bounds,
+        )
+    with dem_window or nullcontext() as dem_path:
+        placemarks, agl = await process_pool.run(
+            waypoint_crud.generate_placemarks,
             features,
             altitude,
+            gsd,
             forward_overlap,
             side_overlap,
             generate_each_points,
             generate_3d,
+            use_dem,
+            dem_path,
+        )
+
+    return StreamingResponse(
+        waypoint_crud.cache_stream(
+            cache_key, waypoint_crud.stream_kmz(placemarks, "goHome", agl)
+        ),
+        media_type="application/zip",
+        headers=kmz_headers,
+    )
+
+
+@router.get("/project/{project_id}/")
+async def get_project_waypoints(
+    project_id: uuid.UUID,
+    db: Database = Depends(database.get_db),
+):
+    """Download the flight plans of every task in a project, as one zip.
+
+    Plans are generated in parallel in the process pool, with the DEM
+    downloaded once for the whole project. Each `task_<project_task_index>.kmz`
+    is streamed back as soon as it is ready.
+    """
+    project = await get_project_by_id(db, project_id)
+    if not project:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Project not found"
+        )
+    tasks = await get_project_tasks_geojson(db, project_id)
+    if not tasks:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Project has no tasks"
+        )
+    if process_pool.saturated:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="Server is busy generating flight plans, retry shortly.",
+            headers={"Retry-After": "5"},
         )
-    else:
-        if project.is_terrain_follow:
-            dem_path = f"/tmp/{uuid.uuid4()}/dem.tif"
-            get_file_from_bucket(
-                settings.S3_BUCKET_NAME, f"dem/{project_id}/dem.tif", dem_path
+
+    altitude, gsd, forward_overlap, side_overlap = (
+        waypoint_crud.project_flight_parameters(project)
+    )
+
+    dem_s3_path = f"dem/{project_id}/dem.tif"
+    dem_window = None
+    dem_etag = None
+    if project.is_terrain_follow:
+        dem_etag = await async_s3.get_obj_etag(settings.S3_BUCKET_NAME, dem_s3_path)
+        if not dem_etag:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="Project DEM not found"
             )
-        output_file = flightplan.generate_flightplan(
-            features,
+        # A single DEM window under all the tasks, shared by every job
+        dem_window = await run_in_threadpool(
+            dem_cache.get_window,
+            settings.S3_BUCKET_NAME,
+            dem_s3_path,
+            dem_etag,
+            tuple(
+                shapely.total_bounds(
+                    [shape(json.loads(task["outline"])) for task in tasks]
+                )
+            ),
+        )
+
+    return StreamingResponse(
+        waypoint_crud.stream_kmz_bundle(
+            project_id,
+            tasks,
             altitude,
             gsd,
             forward_overlap,
             side_overlap,
-            generate_each_points,
-            generate_3d,
             project.is_terrain_follow,
-            dem_path if project.is_terrain_follow else None,
-            f"/tmp/{uuid.uuid4()}",
-        )
-
-        return FileResponse(
-            output_file, media_type="application/zip", filename="output.kmz"
-        )
+            dem_window,
+            dem_etag,
+        ),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{project.slug}.zip"'},
+    )
 
 
 @router.post("/")
@@ -142,19 +257,16 @@ async def generate_kmz(
                 detail="DEM file should be in GeoTIFF format",
             )
 
-        dem_path = f"/tmp/{dem.filename}"
-        with open(dem_path, "wb") as buffer:
-            shutil.copyfileobj(dem.file, buffer)
-
     boundary = merge_multipolygon(geojson.loads(await project_geojson.read()))
     features = boundary["features"][0]
 
     if not download:
         # TODO This should be fixed within the drone_flightplan
         if gsd:
-            altitude = gsd * GSD_to_AGL_CONST
+            altitude = gsd * waypoint_crud.GSD_to_AGL_CONST
 
-        return waypoints.create_waypoint(
+        return await process_pool.run(
+            waypoints.create_waypoint,
             features,
             altitude,
             forward_overlap,
@@ -162,8 +274,19 @@ async def generate_kmz(
             generate_each_points,
             generate_3d,
         )
-    else:
-        output_file = flightplan.generate_flightplan(
+
+    # The placemarks are generated before the response is streamed, so the
+    # DEM is only kept on disk while they are
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dem_path = None
+        if terrain_follow:
+            # Spool the upload in chunks, off the event loop
+            dem_path = os.path.join(temp_dir, "dem.tif")
+            with open(dem_path, "wb") as buffer:
+                await run_in_threadpool(shutil.copyfileobj, dem.file, buffer)
+
+        placemarks, agl = await process_pool.run(
+            waypoint_crud.generate_placemarks,
             features,
             altitude,
             gsd,
@@ -172,10 +295,11 @@ async def generate_kmz(
             generate_each_points,
             generate_3d,
             terrain_follow,
-            dem_path if dem else None,
-            f"/tmp/{uuid.uuid4()}",
+            dem_path,
         )
 
-        return FileResponse(
-            output_file, media_type="application/zip", filename="output.kmz"
-        )
+    return StreamingResponse(
+        waypoint_crud.stream_kmz(placemarks, "goHome", agl),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="output.kmz"'},
+    )
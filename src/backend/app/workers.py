@@ -0,0 +1,157 @@
+"""Process pool for CPU heavy geometry and flight plan work."""
+
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException
+from loguru import logger as log
+
+from app.config import settings
+from app.models.enums import HTTPStatus
+
+
+def _timed_call(func: Callable, args: tuple, kwargs: dict):
+    """Run a job inside a worker, recording when it started and finished."""
+    started = time.time()
+    result = func(*args, **kwargs)
+    return started, time.time(), result
+
+
+class ProcessPool:
+    """Bounded process pool, to keep CPU bound jobs off the event loop.
+
+    Jobs beyond `max_workers + max_queue` are rejected with a 503, so a
+    saturated worker sheds load instead of queueing requests indefinitely.
+
+    A job which times out is only cancelled if it has not started yet. A
+    running job cannot be stopped without breaking the whole pool, so it
+    keeps its worker process busy until it finishes, and still counts
+    towards `saturated`; timeouts only bound how long a request waits.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, timeout: float):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self.metrics = {
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "queue_wait_seconds": 0.0,
+            "compute_seconds": 0.0,
+            "max_queue_wait_seconds": 0.0,
+            "max_compute_seconds": 0.0,
+        }
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        """Start the worker processes."""
+        if self._executor is None:
+            log.debug(f"Starting process pool with {self.max_workers} workers")
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    def shutdown(self):
+        """Stop the worker processes, cancelling any queued job."""
+        if self._executor is not None:
+            log.debug("Shutting down process pool")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def saturated(self) -> bool:
+        """Whether a new job would exceed the queue depth limit."""
+        return self.pending >= self.max_workers + self.max_queue
+
+    async def run(
+        self, func: Callable, *args: Any, timeout: Optional[float] = None, **kwargs
+    ):
+        """Run `func(*args, **kwargs)` in a worker process.
+
+        Args:
+            func (Callable): A picklable, module level function.
+            timeout (float, optional): Seconds before the job is abandoned,
+                see the class docstring for running jobs. Defaults to
+                settings.WORKER_JOB_TIMEOUT.
+
+        Raises:
+            HTTPException: 503 if the pool is saturated, 504 on timeout.
+        """
+        if self.saturated:
+            self.metrics["rejected"] += 1
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail="Server is busy generating flight plans, retry shortly.",
+                headers={"Retry-After": "5"},
+            )
+
+        timeout = timeout or self.timeout
+        self.start()
+        loop = asyncio.get_running_loop()
+        submitted = time.time()
+        future = self._executor.submit(_timed_call, func, args, kwargs)
+
+        # Only release the slot once the worker is actually free again
+        self.pending += 1
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+
+        try:
+            started, finished, result = await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout
+            )
+        except TimeoutError as e:
+            self.metrics["timed_out"] += 1
+            if future.cancel():
+                log.warning(f"Job {func.__name__} timed out after {timeout}s queued")
+            else:
+                log.warning(
+                    f"Job {func.__name__} timed out after {timeout}s, "
+                    "its worker stays busy until it finishes"
+                )
+            raise HTTPException(
+                status_code=HTTPStatus.GATEWAY_TIMEOUT,
+                detail="Timed out generating the result.",
+            ) from e
+        except Exception:
+            self.metrics["failed"] += 1
+            raise
+
+        self._record(func.__name__, started - submitted, finished - started)
+        return result
+
+    def _release(self):
+        self.pending -= 1
+
+    def _record(self, name: str, queue_wait: float, compute: float):
+        metrics = self.metrics
+        metrics["completed"] += 1
+        metrics["queue_wait_seconds"] += queue_wait
+        metrics["compute_seconds"] += compute
+        metrics["max_queue_wait_seconds"] = max(
+            metrics["max_queue_wait_seconds"], queue_wait
+        )
+        metrics["max_compute_seconds"] = max(metrics["max_compute_seconds"], compute)
+        log.debug(f"Job {name} | queue wait {queue_wait:.3f}s | compute {compute:.3f}s")
+
+    def stats(self) -> dict[str, Any]:
+        """Return pool usage, with queue wait and compute time metrics."""
+        return {
+            "workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            **self.metrics,
+        }
+
+
+process_pool = ProcessPool(
+    max_workers=settings.WORKER_PROCESSES,
+    max_queue=settings.WORKER_QUEUE_LIMIT,
+    timeout=settings.WORKER_JOB_TIMEOUT,
+)